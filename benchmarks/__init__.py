@@ -0,0 +1,35 @@
+"""Benchmarks for the example apps.
+
+Every benchmark is a module that can be run with ``python -m benchmarks.<name>``.
+The benchmarks configure Django with ``benchmarks.settings`` which uses the
+in-memory channel layer and a throwaway SQLite database, so they run offline and
+never touch the development database.
+"""
+
+import os
+
+
+def setup(fresh=True):
+    """Configures Django for a benchmark run and migrates the benchmark database."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+    import django
+    from django.conf import settings
+
+    if fresh and os.path.exists(settings.DATABASES["default"]["NAME"]):
+        os.remove(settings.DATABASES["default"]["NAME"])
+
+    django.setup()
+
+    from django.core.management import call_command
+
+    call_command("migrate", verbosity=0)
+
+
+def percentile(values, p):
+    """Returns the ``p``-th percentile of ``values`` (nearest-rank method)."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[k]
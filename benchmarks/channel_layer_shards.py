@@ -0,0 +1,109 @@
+"""Measures the group_send throughput of the sharded channel layer per number of shards.
+
+Usage::
+
+    python -m benchmarks.channel_layer_shards --hosts redis://127.0.0.1:6379 \\
+        redis://127.0.0.1:6380 redis://127.0.0.1:6381 redis://127.0.0.1:6382
+
+For 1, 2, ... up to all given hosts, a sending and a receiving layer, standing in
+for two processes, are configured with that many shards. The receiving layer adds one
+channel to each of `--groups` per-user groups and `--concurrency` senders send
+`--messages` messages round-robin to the groups, so every message goes through
+Redis. Since each Redis server executes commands on a single core, the throughput
+grows with the number of shards until the process itself is saturated. Without
+`--hosts` the shards are in-process fake Redis servers, which only shows the
+overhead of the layer because all shards share the CPU of the benchmark.
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks import setup
+
+
+def fake_redis(layer_class):
+    import fakeredis
+
+    class FakeRedisLayer(layer_class):
+        servers = {}
+
+        def connection(self, index):
+            loop = asyncio.get_running_loop()
+            address = self.host_key(self.hosts[index])
+            connections = self.__dict__.setdefault("connections", {})
+            if (loop, address) not in connections:
+                server = self.servers.setdefault(address, fakeredis.FakeServer())
+                connections[loop, address] = fakeredis.aioredis.FakeRedis(server=server)
+            return connections[loop, address]
+
+    return FakeRedisLayer
+
+
+async def run(layer_class, hosts, groups, concurrency, messages):
+    sender = layer_class(hosts=hosts, capacity=messages)
+    receiver = layer_class(hosts=hosts, capacity=messages)
+    channels = []
+    for i in range(groups):
+        channel = await receiver.new_channel()
+        await receiver.group_add(f"inbox_user{i}", channel)
+        channels.append(channel)
+
+    received = 0
+    done = asyncio.Event()
+
+    async def receive(channel):
+        nonlocal received
+        while True:
+            await receiver.receive(channel)
+            received += 1
+            if received == messages:
+                done.set()
+
+    async def send(offset):
+        for i in range(offset, messages, concurrency):
+            await sender.group_send(f"inbox_user{i % groups}", {"type": "private.message"})
+
+    receivers = [asyncio.create_task(receive(channel)) for channel in channels]
+    start = time.perf_counter()
+    await asyncio.gather(*(send(offset) for offset in range(concurrency)))
+    await asyncio.wait_for(done.wait(), timeout=120)
+    elapsed = time.perf_counter() - start
+
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    await receiver.flush()
+    await sender.flush()
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hosts", nargs="+", default=None)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+
+    setup()
+
+    from core.layers import ShardedChannelLayer
+
+    if args.hosts:
+        hosts, layer_class = args.hosts, ShardedChannelLayer
+    else:
+        hosts = [f"redis://shard{i}:6379" for i in range(args.shards)]
+        layer_class = fake_redis(ShardedChannelLayer)
+
+    print(f"{'shards':>6} {'messages/s':>11}")
+    for shards in range(1, len(hosts) + 1):
+        throughput = asyncio.run(
+            run(layer_class, hosts[:shards], args.groups, args.concurrency, args.messages)
+        )
+        print(f"{shards:>6} {throughput:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
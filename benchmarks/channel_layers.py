@@ -0,0 +1,88 @@
+"""Compares the same-node broadcast latency of the Redis and the hybrid channel layer.
+
+Usage::
+
+    python -m benchmarks.channel_layers --group-sizes 10 100 1000
+    python -m benchmarks.channel_layers --redis redis://127.0.0.1:6379/0
+
+All members of the group are channels of this process, each with a receiver task
+like the one of a consumer. Every `group_send` is timed until all members received
+the message. Without `--redis` the layers talk to an in-process fake Redis server,
+which leaves out the network round trips that the hybrid layer saves in addition to
+the serialization.
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks import percentile, setup
+
+
+def fake_redis(layer_class):
+    import fakeredis
+
+    class FakeRedisLayer(layer_class):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.server = fakeredis.FakeServer()
+            self.connections = {}
+
+        def connection(self, index):
+            loop = asyncio.get_running_loop()
+            if loop not in self.connections:
+                self.connections[loop] = fakeredis.aioredis.FakeRedis(server=self.server)
+            return self.connections[loop]
+
+    return FakeRedisLayer
+
+
+async def run(layer, size, messages):
+    channels = [await layer.new_channel() for _ in range(size)]
+    for channel in channels:
+        await layer.group_add("benchmark", channel)
+
+    timings = []
+    for _ in range(messages):
+        receivers = [asyncio.create_task(layer.receive(channel)) for channel in channels]
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        await layer.group_send("benchmark", {"type": "chat.message", "message": "x" * 100})
+        await asyncio.gather(*receivers)
+        timings.append(time.perf_counter() - start)
+
+    for channel in channels:
+        await layer.group_discard("benchmark", channel)
+    await layer.flush()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--group-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--redis", default=None)
+    args = parser.parse_args()
+
+    setup()
+
+    from channels_redis.core import RedisChannelLayer
+
+    from core.layers import HybridChannelLayer
+
+    print(f"{'group':>6} {'layer':>7} {'p50':>10} {'p99':>10}")
+    for size in args.group_sizes:
+        for name, layer_class in [("redis", RedisChannelLayer), ("hybrid", HybridChannelLayer)]:
+            if args.redis:
+                layer = layer_class(hosts=[args.redis], capacity=args.messages)
+            else:
+                layer = fake_redis(layer_class)(capacity=args.messages)
+            timings = asyncio.run(run(layer, size, args.messages))
+            print(
+                f"{size:>6} {name:>7} {percentile(timings, 50) * 1000:>8.2f}ms "
+                f"{percentile(timings, 99) * 1000:>8.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
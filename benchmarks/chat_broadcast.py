@@ -0,0 +1,84 @@
+"""Measures the CPU cost of delivering one chat broadcast as the room grows.
+
+Usage::
+
+    python -m benchmarks.chat_broadcast --room-sizes 10 100 1000
+
+A `chat.message` event is passed to the `chat_message` handler of every consumer of a
+room, whose socket output is discarded. Without a pre-encoded frame every consumer
+encodes the event itself, with the `json` module or with `orjson`; with the frame
+which `ChatConsumer.receive` adds through `pre_encode` the event is encoded once by
+the sender and every consumer forwards the same string.
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks import percentile, setup
+
+
+async def discard(message):
+    pass
+
+
+async def broadcast(consumers, event, frame, messages):
+    from core.codecs import pre_encode
+
+    timings = []
+    for _ in range(messages):
+        start = time.process_time()
+        # The sender encodes the frame once, the receivers forward it
+        message = pre_encode(event) if frame else event
+        for consumer in consumers:
+            await consumer.chat_message(message)
+        timings.append(time.process_time() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--room-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.utils import timezone
+
+    import core.codecs
+    from chat.consumers import ChatConsumer
+
+    event = {
+        "type": "chat.message",
+        "user": "user0",
+        "message": "Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 4,
+        "timestamp": timezone.now().isoformat(),
+    }
+    modes = [
+        ("json", core.codecs.StdlibCodec(), False),
+        ("orjson", core.codecs.OrjsonCodec(), False),
+        ("frame", core.codecs.OrjsonCodec(), True),
+    ]
+
+    print(f"{'room':>6} {'mode':>7} {'cpu/msg p50':>12} {'cpu/msg p99':>12} {'per socket':>11}")
+    for size in args.room_sizes:
+        consumers = []
+        for _ in range(size):
+            consumer = ChatConsumer()
+            consumer.room_name = "benchmark"
+            consumer.base_send = discard
+            consumers.append(consumer)
+
+        for mode, codec, frame in modes:
+            core.codecs.codec = codec
+            timings = asyncio.run(broadcast(consumers, event, frame, args.messages))
+            p50 = percentile(timings, 50)
+            print(
+                f"{size:>6} {mode:>7} {p50 * 1000:>10.3f}ms "
+                f"{percentile(timings, 99) * 1000:>10.3f}ms {p50 / size * 1e6:>9.2f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
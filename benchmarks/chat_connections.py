@@ -0,0 +1,114 @@
+"""Measures how many concurrent chat WebSocket connections one process can hold.
+
+Usage::
+
+    python -m benchmarks.chat_connections --connections 2000 --rooms 20
+
+All sockets are opened against ``core.asgi.application`` in-process and stay open
+until a message has been broadcast into every room, so the numbers include the
+cost of the channel layer but not of the network stack.
+"""
+
+import argparse
+import asyncio
+import resource
+import threading
+import time
+
+from benchmarks import percentile, setup
+
+
+def drain(communicator):
+    while not communicator.output_queue.empty():
+        communicator.output_queue.get_nowait()
+
+
+async def receive_until(communicator, message_type):
+    while True:
+        response = await communicator.receive_json_from(timeout=60)
+        if response["type"] == message_type:
+            return response
+
+
+async def open_socket(application, room, user, timings):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(application, f"/ws/chat/{room.name}/")
+    communicator.scope["user"] = user
+    start = time.perf_counter()
+    connected, _ = await communicator.connect(timeout=60)
+    timings.append(time.perf_counter() - start)
+    return communicator if connected else None
+
+
+async def run(connections, rooms, batch):
+    from django.contrib.auth import get_user_model
+
+    from channels.db import database_sync_to_async
+    from chat.models import Room
+    from core.asgi import application
+
+    User = get_user_model()
+
+    @database_sync_to_async
+    def create_fixtures():
+        room_objs = Room.objects.bulk_create(
+            [Room(name=f"room{i}") for i in range(rooms)]
+        )
+        user_objs = User.objects.bulk_create(
+            [User(username=f"user{i}") for i in range(connections)]
+        )
+        return room_objs, user_objs
+
+    room_objs, user_objs = await create_fixtures()
+
+    timings = []
+    sockets = []
+    start = time.perf_counter()
+    for offset in range(0, connections, batch):
+        opened = await asyncio.gather(
+            *(
+                open_socket(application, room_objs[i % rooms], user_objs[i], timings)
+                for i in range(offset, min(offset + batch, connections))
+            )
+        )
+        sockets.extend(c for c in opened if c is not None)
+        for communicator in sockets:
+            drain(communicator)
+    connect_elapsed = time.perf_counter() - start
+
+    # Broadcast one message into every room and wait until every socket received it.
+    start = time.perf_counter()
+    for i in range(rooms):
+        await sockets[i].send_json_to({"message": "ping"})
+    await asyncio.gather(*(receive_until(c, "chat.message") for c in sockets))
+    broadcast_elapsed = time.perf_counter() - start
+
+    held = len(sockets)
+    threads = threading.active_count()
+    for communicator in sockets:
+        await communicator.disconnect(timeout=60)
+
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"connections held:     {held}/{connections} in {rooms} rooms")
+    print(f"connect rate:         {held / connect_elapsed:.0f} conn/s")
+    print(f"connect latency p50:  {percentile(timings, 50) * 1000:.1f} ms")
+    print(f"connect latency p99:  {percentile(timings, 99) * 1000:.1f} ms")
+    print(f"broadcast to all:     {broadcast_elapsed * 1000:.1f} ms")
+    print(f"threads while held:   {threads}")
+    print(f"max RSS:              {max_rss_mb:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+
+    setup()
+    asyncio.run(run(args.connections, args.rooms, args.batch))
+
+
+if __name__ == "__main__":
+    main()
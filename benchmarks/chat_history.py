@@ -0,0 +1,92 @@
+"""Measures the latency of the chat history replay as the message table grows.
+
+Usage::
+
+    python -m benchmarks.chat_history --rows 1000000 --rooms 100
+
+The table is filled in steps (10k, 100k, 1M, ... rows) and after each step the latest
+page and a page deep in the history of random rooms are fetched with
+`Message.objects.history`, which is the query `ChatConsumer` runs on connect and for
+`history.before` requests. Thanks to the `(room, timestamp, id)` index the latency
+stays flat while the table grows.
+"""
+
+import argparse
+import random
+import time
+from datetime import timedelta
+
+from benchmarks import percentile, setup
+
+
+def fill(start, stop, rooms, users, epoch):
+    from chat.models import Message
+
+    chunk = 50000
+    for offset in range(start, stop, chunk):
+        Message.objects.bulk_create(
+            [
+                Message(
+                    room=rooms[i % len(rooms)],
+                    user=users[i % len(users)],
+                    content=f"message {i}",
+                    timestamp=epoch + timedelta(milliseconds=i),
+                )
+                for i in range(offset, min(offset + chunk, stop))
+            ],
+            batch_size=1000,
+        )
+
+
+def measure(rooms, epoch, rows, queries):
+    from chat.models import Message
+
+    latest, deep = [], []
+    for _ in range(queries):
+        room = random.choice(rooms)
+        start = time.perf_counter()
+        Message.objects.history(room.pk)
+        latest.append(time.perf_counter() - start)
+
+        before = epoch + timedelta(milliseconds=random.randrange(rows))
+        start = time.perf_counter()
+        Message.objects.history(room.pk, before=before)
+        deep.append(time.perf_counter() - start)
+    return latest, deep
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+
+    from chat.models import Room
+
+    User = get_user_model()
+    rooms = Room.objects.bulk_create([Room(name=f"room{i}") for i in range(args.rooms)])
+    users = User.objects.bulk_create([User(username=f"user{i}") for i in range(10)])
+    epoch = timezone.now() - timedelta(milliseconds=args.rows)
+
+    steps = [10 ** e for e in range(4, 10) if 10 ** e < args.rows] + [args.rows]
+    filled = 0
+    print(f"{'rows':>10} {'latest p50':>11} {'latest p99':>11} {'deep p50':>9} {'deep p99':>9}")
+    for rows in steps:
+        fill(filled, rows, rooms, users, epoch)
+        filled = rows
+        latest, deep = measure(rooms, epoch, rows, args.queries)
+        print(
+            f"{rows:>10} "
+            f"{percentile(latest, 50) * 1000:>9.2f}ms {percentile(latest, 99) * 1000:>9.2f}ms "
+            f"{percentile(deep, 50) * 1000:>7.2f}ms {percentile(deep, 99) * 1000:>7.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Compares the async `ChecklistConsumer` with a sync consumer under concurrent load.
+
+Usage::
+
+    python -m benchmarks.checklist_connections --connections 100 500 --updates 10
+
+For every number of connections, one socket per user is opened against the async
+`ChecklistConsumer` and against an equivalent sync `JsonWebsocketConsumer` with the
+`ReceiverMixin`. Then every socket toggles its item `--updates` times and waits for
+the `item.update` broadcast, concurrently with all other sockets. The handlers of
+a sync consumer, including the delivery of every broadcast, run one at a time in the
+single thread which also runs the ORM calls. The async consumer only hands the ORM
+calls of an action to that thread and delivers broadcasts on the event loop, so the
+write throughput of the database is the remaining bound.
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+from benchmarks import percentile, setup
+
+
+def sync_consumer():
+    from asgiref.sync import async_to_sync
+    from channels.generic.websocket import JsonWebsocketConsumer
+
+    from checklist.receivers import (
+        ConflictError,
+        ItemReceiver,
+        ReceiverError,
+        ReceiverMixin,
+        TaskReceiver,
+    )
+    from checklist.sync import get_task_list
+
+    class SyncChecklistConsumer(ReceiverMixin, JsonWebsocketConsumer):
+        """The sync counterpart of the `AsyncReceiverMixin`, which broadcasts to a group
+        per user since every socket of the benchmark only changes its own task."""
+
+        def get_receiver(self, entity):
+            return self.receivers.get(entity)
+
+        def receive_json(self, data):
+            message_type = data.pop("type")
+            if message_type == "batch":
+                return self.receive_batch(data.get("operations"))
+            try:
+                receiver, action = self.get_receiver_action(message_type)
+                data = getattr(receiver, action)(data)
+                data["type"] = message_type
+                async_to_sync(self.channel_layer.group_send)(self.group_name, data)
+            except ConflictError as e:
+                self.send_json(self.get_conflict_message(message_type, e))
+            except ReceiverError as e:
+                msg = f"Message type '{message_type}' cannot be processed: " + str(e)
+                self.send_json({"type": "error", "message": msg})
+
+        def receive_batch(self, operations):
+            event, error, conflicts = self.process_batch(operations)
+            if event:
+                async_to_sync(self.channel_layer.group_send)(self.group_name, event)
+            for message in [*conflicts, error]:
+                if message:
+                    self.send_json(message)
+
+        def connect(self):
+            self.user = self.scope["user"]
+            self.group_name = f"checklist_{self.user.pk}"
+            self.accept()
+            async_to_sync(self.channel_layer.group_add)(self.group_name, self.channel_name)
+            self.send_json(get_task_list(self.user))
+            self.receivers = {
+                "task": TaskReceiver(user=self.user),
+                "item": ItemReceiver(user=self.user),
+            }
+
+        def disconnect(self, close_code):
+            async_to_sync(self.channel_layer.group_discard)(self.group_name, self.channel_name)
+
+        def item_update(self, event):
+            self.send_json(event)
+
+    return SyncChecklistConsumer
+
+
+async def open_socket(application, user, timings):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(application, "/ws/checklist/")
+    communicator.scope["user"] = user
+    start = time.perf_counter()
+    connected, _ = await communicator.connect(timeout=120)
+    if not connected:
+        return None
+    await communicator.receive_json_from(timeout=120)
+    timings.append(time.perf_counter() - start)
+    return communicator
+
+
+async def toggle(communicator, item, updates, timings):
+    for i in range(updates):
+        start = time.perf_counter()
+        await communicator.send_json_to({
+            "type": "item.update",
+            "id": item.pk,
+            "done_at": "2024-01-01T00:00:00Z" if i % 2 else None,
+        })
+        await communicator.receive_json_from(timeout=120)
+        timings.append(time.perf_counter() - start)
+
+
+async def run(mode, application, users, items, updates):
+    connect_timings = []
+    start = time.perf_counter()
+    sockets = await asyncio.gather(
+        *(open_socket(application, user, connect_timings) for user in users)
+    )
+    connect_elapsed = time.perf_counter() - start
+    held = [c for c in sockets if c is not None]
+    threads = threading.active_count()
+
+    update_timings = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(toggle(c, item, updates, update_timings) for c, item in zip(sockets, items) if c)
+    )
+    update_elapsed = time.perf_counter() - start
+
+    for communicator in held:
+        await communicator.disconnect(timeout=120)
+
+    print(
+        f"{mode:>6} {len(held):>6} {len(held) / connect_elapsed:>8.0f}/s "
+        f"{percentile(connect_timings, 99) * 1000:>9.1f}ms "
+        f"{percentile(update_timings, 50) * 1000:>9.1f}ms "
+        f"{percentile(update_timings, 99) * 1000:>9.1f}ms "
+        f"{len(update_timings) / update_elapsed:>8.0f}/s {threads:>8}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, nargs="+", default=[100, 500])
+    parser.add_argument("--updates", type=int, default=10)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.contrib.auth import get_user_model
+
+    from checklist.consumers import ChecklistConsumer
+    from checklist.models import Item, Task
+
+    User = get_user_model()
+    applications = {
+        "sync": sync_consumer().as_asgi(),
+        "async": ChecklistConsumer.as_asgi(),
+    }
+
+    print(
+        f"{'mode':>6} {'held':>6} {'connects':>10} {'conn p99':>11} "
+        f"{'upd p50':>11} {'upd p99':>11} {'updates':>10} {'threads':>8}"
+    )
+    for n, connections in enumerate(args.connections):
+        users = User.objects.bulk_create(
+            [User(username=f"user{n}_{i}") for i in range(connections)]
+        )
+        tasks = Task.objects.bulk_create([Task(user=user, name="Task") for user in users])
+        items = Item.objects.bulk_create([Item(task=task, name="Item") for task in tasks])
+        for mode, application in applications.items():
+            asyncio.run(run(mode, application, users, items, args.updates))
+
+
+if __name__ == "__main__":
+    main()
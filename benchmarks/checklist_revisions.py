@@ -0,0 +1,85 @@
+"""Measures the cost of the global `Revision` counter for concurrent checklist writes.
+
+Usage::
+
+    python -m benchmarks.checklist_revisions --threads 1 2 4 8 --updates 200
+
+Every thread renames the item of its own task `--updates` times, once with
+`Item.save`, which takes the next revision from the counter row in the transaction of
+the write, and once with an `UPDATE` of the item alone in a transaction of the same
+shape. Since the counter row stays locked until the transaction commits, the saves of
+all threads are serialized even though they touch different tasks, while the plain
+updates only contend on the database itself. On SQLite the database lock serializes
+both, so the difference only shows on a server like PostgreSQL, which is selected with
+`DJANGO_SETTINGS_MODULE`.
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks import percentile, setup
+
+
+def run(items, updates, write):
+    from django.db import connection
+
+    timings = [[] for _ in items]
+
+    def work(index, item):
+        try:
+            for i in range(updates):
+                start = time.perf_counter()
+                write(item, f"Item {i}")
+                timings[index].append(time.perf_counter() - start)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=work, args=pair) for pair in enumerate(items)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return [t for thread_timings in timings for t in thread_timings], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--updates", type=int, default=200)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.contrib.auth import get_user_model
+    from django.db import transaction
+
+    from checklist.models import Item, Task
+
+    def save(item, name):
+        item.name = name
+        item.save(update_fields=["name", "revision"])
+
+    def update(item, name):
+        with transaction.atomic():
+            Item.objects.filter(pk=item.pk).update(name=name)
+
+    user = get_user_model().objects.create(username="user")
+    print(f"{'threads':>7} {'mode':>8} {'p50':>10} {'p99':>10} {'writes/s':>9}")
+    for count in args.threads:
+        items = [
+            Item.objects.create(task=Task.objects.create(user=user, name="Task"), name="Item")
+            for _ in range(count)
+        ]
+        for mode, write in [("revision", save), ("plain", update)]:
+            timings, elapsed = run(items, args.updates, write)
+            print(
+                f"{count:>7} {mode:>8} {percentile(timings, 50) * 1000:>8.2f}ms "
+                f"{percentile(timings, 99) * 1000:>8.2f}ms {len(timings) / elapsed:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Reports the fan-out of updates of a shared checklist for growing organisations.
+
+Usage::
+
+    python -m benchmarks.checklist_sharing --users 100 1000 --members 10 --updates 20
+
+For every number of users, one socket per user is opened against the `ChecklistConsumer`
+and one task is shared with `--members` of them. The owner toggles an item of the task
+`--updates` times and waits until every member received the `item.update`. Since the
+events of a task are only sent to the group of the task, the latency and the number of
+delivered frames follow the number of members, while the other sockets receive nothing
+however many there are.
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks import percentile, setup
+
+
+async def open_socket(application, user):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(application, "/ws/checklist/")
+    communicator.scope["user"] = user
+    await communicator.connect(timeout=120)
+    await communicator.receive_json_from(timeout=120)
+    return communicator
+
+
+async def count_frames(communicator):
+    count = 0
+    while not await communicator.receive_nothing(0.01):
+        await communicator.receive_output()
+        count += 1
+    return count
+
+
+async def run(application, users, members, item, updates):
+    sockets = [await open_socket(application, user) for user in users]
+    owner, shared, others = sockets[0], sockets[1 : members + 1], sockets[members + 1 :]
+
+    timings = []
+    for i in range(updates):
+        start = time.perf_counter()
+        await owner.send_json_to({
+            "type": "item.update",
+            "id": item.pk,
+            "done_at": "2024-01-01T00:00:00Z" if i % 2 else None,
+        })
+        await owner.receive_json_from(timeout=120)
+        await asyncio.gather(*(c.receive_json_from(timeout=120) for c in shared))
+        timings.append(time.perf_counter() - start)
+
+    delivered = (1 + len(shared)) * updates
+    leaked = sum(await asyncio.gather(*(count_frames(c) for c in others)))
+    for communicator in sockets:
+        await communicator.disconnect(timeout=120)
+
+    print(
+        f"{len(users):>6} {members:>8} {percentile(timings, 50) * 1000:>9.1f}ms "
+        f"{percentile(timings, 99) * 1000:>9.1f}ms {delivered:>10} {leaked:>7}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--updates", type=int, default=20)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.contrib.auth import get_user_model
+
+    from checklist.consumers import ChecklistConsumer
+    from checklist.models import Item, Task, TaskMembership
+
+    User = get_user_model()
+    application = ChecklistConsumer.as_asgi()
+
+    print(
+        f"{'users':>6} {'members':>8} {'upd p50':>11} {'upd p99':>11} "
+        f"{'frames':>10} {'leaked':>7}"
+    )
+    for n, count in enumerate(args.users):
+        users = User.objects.bulk_create([User(username=f"user{n}_{i}") for i in range(count)])
+        members = min(args.members, count - 1)
+        task = Task.objects.create(user=users[0], name="Shared Task")
+        item = Item.objects.create(task=task, name="Item")
+        TaskMembership.objects.bulk_create(
+            [TaskMembership(task=task, user=user) for user in users[1 : members + 1]]
+        )
+        asyncio.run(run(application, users, members, item, args.updates))
+
+
+if __name__ == "__main__":
+    main()
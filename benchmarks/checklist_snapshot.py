@@ -0,0 +1,82 @@
+"""Compares the cost of the initial `task.list` snapshot with and without prefetching
+and from the cache of task trees.
+
+Usage::
+
+    python -m benchmarks.checklist_snapshot --tasks 10 100 500 --items 20
+
+For every size the snapshot is serialized with the plain queryset, which runs one
+query per task and per item, and with `Task.objects.with_items()`, which runs two
+queries regardless of the number of tasks and items, and with `get_task_list` once the
+tree of the user is cached in `checklist.cache.task_trees`, which runs none.
+"""
+
+import argparse
+import time
+
+from benchmarks import percentile, setup
+
+
+def measure(snapshot, repeat):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    snapshot()
+    with CaptureQueriesContext(connection) as context:
+        snapshot()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        snapshot()
+        timings.append(time.perf_counter() - start)
+    return len(context.captured_queries), timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.contrib.auth import get_user_model
+
+    from checklist.models import Item, Task
+    from checklist.serializers import TaskSerializer
+    from checklist.sync import get_task_list
+
+    User = get_user_model()
+
+    print(f"{'tasks':>6} {'items':>7} {'mode':>9} {'queries':>8} {'p50':>10} {'p99':>10}")
+    for i, tasks in enumerate(args.tasks):
+        user = User.objects.create(username=f"user{i}")
+        task_objs = Task.objects.bulk_create(
+            [Task(user=user, name=f"Task {j}") for j in range(tasks)]
+        )
+        Item.objects.bulk_create(
+            [
+                Item(task=task, name=f"Item {k}", done_by=user)
+                for task in task_objs
+                for k in range(args.items)
+            ]
+        )
+
+        plain = Task.objects.filter(user=user)
+        prefetch = Task.objects.filter(user=user).with_items()
+        for mode, snapshot in [
+            ("plain", lambda: TaskSerializer(plain.all(), many=True).data),
+            ("prefetch", lambda: TaskSerializer(prefetch.all(), many=True).data),
+            ("cached", lambda: get_task_list(user)),
+        ]:
+            queries, timings = measure(snapshot, args.repeat)
+            print(
+                f"{tasks:>6} {tasks * args.items:>7} {mode:>9} {queries:>8} "
+                f"{percentile(timings, 50) * 1000:>8.2f}ms {percentile(timings, 99) * 1000:>8.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
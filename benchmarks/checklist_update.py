@@ -0,0 +1,82 @@
+"""Compares the latency of an `item.update` through the full, the partial and the
+conditional update path.
+
+Usage::
+
+    python -m benchmarks.checklist_update --updates 1000
+
+The full path validates the whole `ItemSerializer`, which looks up the `done_by` user and
+the task, and fetches the item with a join on the task table. The partial path validates
+only `done_at`, checks the owner against the task ids cached by the receiver and writes
+only the changed columns. The conditional path, which clients take by sending the
+`revision` they have seen, writes the changes with one `UPDATE` on the id and revision
+without reading the item.
+"""
+
+import argparse
+import time
+
+from benchmarks import percentile, setup
+
+
+def measure(receiver, items, updates, conditional=False):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from checklist.models import Item
+
+    revisions = dict(Item.objects.values_list("pk", "revision"))
+
+    def update(pk, done_at):
+        data = {"id": pk, "done_at": done_at}
+        if conditional:
+            data["revision"] = revisions[pk]
+        revisions[pk] = receiver.update(data)["revision"]
+
+    # The first update fills the task ids cached by the receiver
+    update(items[0].pk, None)
+    with CaptureQueriesContext(connection) as context:
+        update(items[0].pk, None)
+
+    timings = []
+    for i in range(updates):
+        done_at = "2024-01-01T00:00:00Z" if i % 2 else None
+        start = time.perf_counter()
+        update(items[i % len(items)].pk, done_at)
+        timings.append(time.perf_counter() - start)
+    return len(context.captured_queries), timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=100)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.contrib.auth import get_user_model
+
+    from checklist.models import Item, Task
+    from checklist.receivers import ItemReceiver
+
+    user = get_user_model().objects.create(username="user")
+    task = Task.objects.create(user=user, name="Task")
+    items = Item.objects.bulk_create(
+        [Item(task=task, name=f"Item {i}") for i in range(args.items)]
+    )
+
+    print(f"{'mode':>11} {'queries':>8} {'p50':>10} {'p99':>10}")
+    for mode in ["full", "partial", "conditional"]:
+        receiver = ItemReceiver(user=user)
+        if mode == "full":
+            receiver.partial_update_fields = ()
+        queries, timings = measure(receiver, items, args.updates, mode == "conditional")
+        print(
+            f"{mode:>11} {queries:>8} "
+            f"{percentile(timings, 50) * 1000:>8.2f}ms {percentile(timings, 99) * 1000:>8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Reports bytes on the wire and CPU per message for each WebSocket frame format.
+
+Usage::
+
+    python -m benchmarks.frame_formats --tasks 10 100 --repeat 200
+
+The messages are a `chat.message` event, a `history` replay and `task.list` snapshots
+of the given number of tasks with 20 items each, serialized by the checklist
+serializers. Each message is encoded and decoded with every format of
+`core.codecs.frame_formats`, i.e. every subprotocol a client can select.
+"""
+
+import argparse
+import time
+
+from benchmarks import percentile, setup
+
+
+def measure(frame_format, message, repeat):
+    encode, decode = [], []
+    for _ in range(repeat):
+        start = time.process_time()
+        text_data, bytes_data = frame_format.encode(message)
+        encode.append(time.process_time() - start)
+        start = time.process_time()
+        frame_format.decode(text_data, bytes_data)
+        decode.append(time.process_time() - start)
+    size = len(text_data.encode()) if text_data is not None else len(bytes_data)
+    return size, encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+
+    from checklist.models import Item, Task
+    from checklist.sync import get_task_list
+    from core.codecs import frame_formats
+
+    now = timezone.now().isoformat()
+    messages = {
+        "chat.message": {
+            "type": "chat.message",
+            "user": "user0",
+            "message": "Hello!",
+            "timestamp": now,
+        },
+        "history": {
+            "type": "history",
+            "before": None,
+            "messages": [[f"user{i % 10}", f"Message number {i}", now] for i in range(50)],
+            "more": True,
+        },
+    }
+    for n, tasks in enumerate(args.tasks):
+        user = get_user_model().objects.create(username=f"user{n}")
+        task_objs = Task.objects.bulk_create(
+            [Task(user=user, name=f"Task {j}") for j in range(tasks)]
+        )
+        Item.objects.bulk_create(
+            [
+                Item(task=task, name=f"Item {k}", done_by=user)
+                for task in task_objs
+                for k in range(20)
+            ]
+        )
+        messages[f"task.list/{tasks}"] = get_task_list(user)
+
+    print(f"{'message':>14} {'format':>13} {'bytes':>8} {'encode p50':>11} {'decode p50':>11}")
+    for label, message in messages.items():
+        for name, frame_format in frame_formats.items():
+            size, encode, decode = measure(frame_format, message, args.repeat)
+            print(
+                f"{label:>14} {name:>13} {size:>8} "
+                f"{percentile(encode, 50) * 1e6:>9.1f}us {percentile(decode, 50) * 1e6:>9.1f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
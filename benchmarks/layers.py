@@ -0,0 +1,27 @@
+"""Channel layers for running the benchmarks against a Redis stand-in."""
+
+import asyncio
+
+import fakeredis
+
+from core.layers import HybridChannelLayer
+
+
+class FakeRedisChannelLayer(HybridChannelLayer):
+    """`HybridChannelLayer` on an in-process fake Redis server, so the serialization and
+    the Redis commands of the layer are part of a benchmark without a Redis server."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.server = fakeredis.FakeServer()
+        self.connections = {}
+
+    def connection(self, index):
+        loop = asyncio.get_running_loop()
+        if loop not in self.connections:
+            # Like a client of a real server, the pool is not limited to the 100
+            # connections of a default fake client
+            self.connections[loop] = fakeredis.aioredis.FakeRedis(
+                server=self.server, max_connections=2**31
+            )
+        return self.connections[loop]
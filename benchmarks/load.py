@@ -0,0 +1,498 @@
+"""Load tests both apps with thousands of simulated WebSocket clients.
+
+Usage::
+
+    python -m benchmarks.load --clients 1000 --rooms 20 --output before.json
+    python -m benchmarks.load --server daphne --layer fakeredis --output after.json
+    python -m benchmarks.load --compare before.json after.json
+
+The clients connect to `core.asgi.application` in this process through the
+`WebsocketCommunicator` or, with `--server daphne`, over TCP to a Daphne process that
+serves the application with the benchmark settings and authenticates the clients by
+their session cookies. `--layer` selects the in-memory channel layer, the hybrid Redis
+layer on an in-process fake Redis server or a Redis server given by its URL.
+
+Scenarios:
+
+- join_storm: all chat clients join their rooms at once (`rate` is connections/s,
+  the latency is the time until the history of the room arrived).
+- chat_traffic: one client per room sends `--messages` messages at `--rate` messages
+  per second into its room.
+- pm_burst: every chat client sends `--messages` private messages to the next client
+  without waiting.
+- checklist_storm: every user has two checklist sockets. The first one sends
+  `--messages` item updates without waiting and the second one receives the broadcasts.
+
+For the message scenarios `rate` is the number of delivered messages per second and
+the latency is the fan-out latency from sending a message until a receiving client got
+it. `missing` counts the deliveries which did not arrive within `--timeout` seconds.
+`--output` saves the results together with the commit they were measured on as JSON
+and `--compare` prints the change between two of these files.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+from datetime import timedelta
+
+from benchmarks import percentile, setup
+
+SCENARIOS = ["join_storm", "chat_traffic", "pm_burst", "checklist_storm"]
+
+
+class InProcessClient:
+    """Client of the application in this process."""
+
+    def __init__(self, application, path, user):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, path)
+        self.communicator.scope["user"] = user
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=120)
+        return connected
+
+    async def send_json(self, data):
+        await self.communicator.send_json_to(data)
+
+    async def receive_json(self, timeout=None):
+        if timeout is not None:
+            # Raises the error of the application if it failed
+            return await self.communicator.receive_json_from(timeout)
+        # Reads the output queue directly, since cancelling `receive_json_from` would
+        # cancel the application as well
+        message = await self.communicator.output_queue.get()
+        if message["type"] == "websocket.close":
+            raise ConnectionError("Closed by the server")
+        return json.loads(message["text"])
+
+    async def close(self):
+        await self.communicator.disconnect(timeout=120)
+
+
+class DaphneClient:
+    """Minimal WebSocket client of a Daphne server, authenticated with the session cookie
+    of the user. It only sends and receives unfragmented text frames."""
+
+    def __init__(self, port, path, session_key):
+        self.port = port
+        self.path = path
+        self.session_key = session_key
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((
+            f"GET {self.path} HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{self.port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            f"Cookie: sessionid={self.session_key}\r\n\r\n"
+        ).encode())
+        response = await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), 120)
+        return response.startswith(b"HTTP/1.1 101")
+
+    def write_frame(self, opcode, payload):
+        # Frames of a client are masked
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+        elif length < 2**16:
+            header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, length)
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.writer.write(header + mask + masked)
+
+    async def send_json(self, data):
+        self.write_frame(0x1, json.dumps(data).encode())
+
+    async def receive_json(self, timeout=None):
+        return await asyncio.wait_for(self.receive_frame(), timeout)
+
+    async def receive_frame(self):
+        while True:
+            try:
+                first, second = await self.reader.readexactly(2)
+                length = second & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+                payload = await self.reader.readexactly(length)
+            except (asyncio.IncompleteReadError, OSError) as e:
+                raise ConnectionError("Closed by the server") from e
+            opcode = first & 0x0F
+            if opcode == 0x8:
+                raise ConnectionError("Closed by the server")
+            if opcode == 0x9:
+                self.write_frame(0xA, payload)
+            elif opcode in (0x1, 0x2):
+                return json.loads(payload)
+
+    async def close(self):
+        try:
+            self.write_frame(0x8, struct.pack("!H", 1000))
+            await self.writer.drain()
+        except OSError:
+            pass
+        self.writer.close()
+
+
+class Harness:
+    """Opens clients of the chosen server and dispatches the messages they receive to
+    the handlers of the running scenario by message type."""
+
+    def __init__(self, server, fixtures, port=None, concurrency=200):
+        self.server = server
+        self.fixtures = fixtures
+        self.port = port
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.handlers = {}
+        self.readers = []
+
+    def client(self, path, user):
+        if self.server == "daphne":
+            return DaphneClient(self.port, path, self.fixtures["sessions"][user.pk])
+        from core.asgi import application
+
+        return InProcessClient(application, path, user)
+
+    async def open(self, index, path, user, ready_type, timings):
+        """Connects a client, waits for the message of type `ready_type` and starts
+        reading its messages. Returns `None` if the client could not connect."""
+        async with self.semaphore:
+            client = self.client(path, user)
+            start = time.perf_counter()
+            try:
+                if not await client.connect():
+                    return None
+                while (await client.receive_json(timeout=120))["type"] != ready_type:
+                    pass
+            except Exception:
+                return None
+            timings.append(time.perf_counter() - start)
+        self.readers.append(asyncio.create_task(self.read(index, client)))
+        return client
+
+    async def read(self, index, client):
+        while True:
+            try:
+                message = await client.receive_json()
+            except ConnectionError:
+                return
+            handler = self.handlers.get(message.get("type"))
+            if handler is not None:
+                handler(index, message)
+
+    async def close(self, clients):
+        for reader in self.readers:
+            reader.cancel()
+        await asyncio.gather(*self.readers, return_exceptions=True)
+        self.readers = []
+        await asyncio.gather(*(client.close() for client in clients if client is not None))
+
+
+class Deliveries:
+    """Collects the fan-out latencies of a scenario until `expected` messages arrived."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.latencies = []
+        self.done = asyncio.Event()
+
+    def add(self, sent_at):
+        self.latencies.append(time.perf_counter() - sent_at)
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+    async def wait(self, start, timeout):
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return result(
+            self.expected, len(self.latencies), time.perf_counter() - start, self.latencies
+        )
+
+
+def result(expected, count, elapsed, latencies):
+    return {
+        "count": count,
+        "rate": count / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "missing": expected - count,
+    }
+
+
+async def join_storm(harness, args):
+    users, rooms = harness.fixtures["users"], harness.fixtures["rooms"]
+    timings = []
+    start = time.perf_counter()
+    clients = await asyncio.gather(*(
+        harness.open(i, f"/ws/chat/{rooms[i % len(rooms)].name}/", user, "history", timings)
+        for i, user in enumerate(users)
+    ))
+    elapsed = time.perf_counter() - start
+    return clients, result(len(users), len(timings), elapsed, timings)
+
+
+async def chat_traffic(harness, clients, args):
+    rooms = len(harness.fixtures["rooms"])
+    members = [0] * rooms
+    for i, client in enumerate(clients):
+        if client is not None:
+            members[i % rooms] += 1
+    # The first client of each room sends, the messages reach all clients of the room
+    senders = [i for i in range(min(rooms, len(clients))) if clients[i] is not None]
+    deliveries = Deliveries(sum(members[i] for i in senders) * args.messages)
+    harness.handlers = {"chat.message": lambda i, m: deliveries.add(float(m["message"]))}
+
+    async def send(client):
+        for _ in range(args.messages):
+            await client.send_json({"message": str(time.perf_counter())})
+            await asyncio.sleep(1 / args.rate if args.rate else 0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(clients[i]) for i in senders))
+    return await deliveries.wait(start, args.timeout)
+
+
+async def pm_burst(harness, clients, args):
+    users = harness.fixtures["users"]
+    online = [i for i, client in enumerate(clients) if client is not None]
+    deliveries = Deliveries(len(online) * args.messages)
+    harness.handlers = {"private.message": lambda i, m: deliveries.add(float(m["message"]))}
+
+    async def send(position):
+        client = clients[online[position]]
+        target = users[online[(position + 1) % len(online)]].username
+        for _ in range(args.messages):
+            await client.send_json({"message": f"/pm {target} {time.perf_counter()}"})
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(position) for position in range(len(online))))
+    return await deliveries.wait(start, args.timeout)
+
+
+async def checklist_storm(harness, args):
+    users, items = harness.fixtures["users"], harness.fixtures["items"]
+    users = users[: max(1, len(users) // 2)]
+    timings = []
+    clients = await asyncio.gather(*(
+        harness.open(i, "/ws/checklist/", users[i // 2], "task.list", timings)
+        for i in range(len(users) * 2)
+    ))
+    pairs = [
+        (clients[2 * n], n) for n in range(len(users))
+        if clients[2 * n] is not None and clients[2 * n + 1] is not None
+    ]
+    # The updates of a user are broadcast in the order in which they were sent
+    sent_at = {n: [] for _, n in pairs}
+    deliveries = Deliveries(len(pairs) * args.messages)
+
+    def receive(index, message):
+        if index % 2 and sent_at.get(index // 2):
+            deliveries.add(sent_at[index // 2].pop(0))
+
+    harness.handlers = {"item.update": receive}
+
+    async def send(client, n):
+        for k in range(args.messages):
+            sent_at[n].append(time.perf_counter())
+            await client.send_json({
+                "type": "item.update",
+                "id": items[n].pk,
+                "done_at": "2024-01-01T00:00:00Z" if k % 2 == 0 else None,
+            })
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(client, n) for client, n in pairs))
+    results = await deliveries.wait(start, args.timeout)
+    await harness.close(clients)
+    return results
+
+
+async def run(args, fixtures, port):
+    from chat.persistence import message_writer
+
+    harness = Harness(args.server, fixtures, port, args.concurrency)
+    results = {}
+    if {"join_storm", "chat_traffic", "pm_burst"} & set(args.scenarios):
+        clients, results["join_storm"] = await join_storm(harness, args)
+        for name, scenario in [("chat_traffic", chat_traffic), ("pm_burst", pm_burst)]:
+            if name in args.scenarios:
+                results[name] = await scenario(harness, clients, args)
+        await harness.close(clients)
+        await message_writer.flush()
+        if "join_storm" not in args.scenarios:
+            del results["join_storm"]
+    if "checklist_storm" in args.scenarios:
+        results["checklist_storm"] = await checklist_storm(harness, args)
+    return results
+
+
+def create_fixtures(clients, rooms, sessions):
+    from django.contrib.auth import (
+        BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model,
+    )
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.contrib.sessions.models import Session
+    from django.utils import timezone
+    from django.utils.crypto import get_random_string
+
+    from chat.models import Room
+    from checklist.models import Item, Task
+
+    users = get_user_model().objects.bulk_create(
+        [get_user_model()(username=f"load{i}", password="!") for i in range(clients)]
+    )
+    fixtures = {
+        "users": users,
+        "rooms": Room.objects.bulk_create([Room(name=f"load{i}") for i in range(rooms)]),
+        "items": Item.objects.bulk_create([
+            Item(task=task, name="Item")
+            for task in Task.objects.bulk_create([Task(user=user, name="Task") for user in users])
+        ]),
+        "sessions": {},
+    }
+    if sessions:
+        store = SessionStore()
+        expire_date = timezone.now() + timedelta(days=1)
+        session_objs = []
+        for user in users:
+            key = get_random_string(32)
+            session_objs.append(Session(
+                session_key=key,
+                session_data=store.encode({
+                    SESSION_KEY: str(user.pk),
+                    BACKEND_SESSION_KEY: "django.contrib.auth.backends.ModelBackend",
+                    HASH_SESSION_KEY: user.get_session_auth_hash(),
+                }),
+                expire_date=expire_date,
+            ))
+            fixtures["sessions"][user.pk] = key
+        Session.objects.bulk_create(session_objs)
+    return fixtures
+
+
+def start_daphne():
+    """Starts Daphne with the benchmark settings on a free port and returns the process
+    and the port once it accepts connections."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "daphne", "-b", "127.0.0.1", "-p", str(port), "core.asgi:application"],
+        env={**os.environ, "DJANGO_SETTINGS_MODULE": "benchmarks.settings"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(300):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Daphne did not start")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"{'scenario':>16} {'count':>8} {'rate':>10} {'p50':>10} {'p99':>10} {'missing':>8}")
+    for name, values in results.items():
+        print(
+            f"{name:>16} {values['count']:>8} {values['rate']:>8.0f}/s "
+            f"{values['p50_ms']:>8.1f}ms {values['p99_ms']:>8.1f}ms {values['missing']:>8}"
+        )
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old_path} ({old['commit']}) -> {new_path} ({new['commit']})")
+    print(f"{'scenario':>16} {'metric':>8} {'old':>10} {'new':>10} {'change':>8}")
+    for name, values in new["results"].items():
+        for metric in ["rate", "p50_ms", "p99_ms"]:
+            if name not in old["results"]:
+                continue
+            before, after = old["results"][name][metric], values[metric]
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "-"
+            print(f"{name:>16} {metric:>8} {before:>10.1f} {after:>10.1f} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=10, help="chat messages/s per room, 0 for no limit")
+    parser.add_argument("--concurrency", type=int, default=200, help="concurrent connects")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--server", choices=["inprocess", "daphne"], default="inprocess")
+    parser.add_argument("--layer", default="memory", help="memory, fakeredis or a redis:// URL")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), default=None)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # The layer is read by the benchmark settings of this process and of Daphne
+    os.environ["BENCHMARK_LAYER"] = args.layer
+    setup()
+
+    fixtures = create_fixtures(args.clients, args.rooms, sessions=args.server == "daphne")
+    process = port = None
+    if args.server == "daphne":
+        # Every client and its server side need a file descriptor
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        process, port = start_daphne()
+    try:
+        results = asyncio.run(run(args, fixtures, port))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+from core.settings import *  # noqa: F401,F403
+
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {
+            "capacity": 1000,
+        },
+    },
+}
+
+# `BENCHMARK_LAYER=fakeredis` runs the hybrid Redis layer on an in-process fake server,
+# `BENCHMARK_LAYER=redis://...` on a real one
+BENCHMARK_LAYER = os.environ.get("BENCHMARK_LAYER", "memory")
+if BENCHMARK_LAYER == "fakeredis":
+    CHANNEL_LAYERS["default"]["BACKEND"] = "benchmarks.layers.FakeRedisChannelLayer"
+    # The fake server only exists in this process, which serves all sockets
+    CHAT_PRESENCE = {**CHAT_PRESENCE, "BACKEND": "chat.presence.MemoryPresence"}  # noqa: F405
+elif BENCHMARK_LAYER.startswith("redis"):
+    CHANNEL_LAYERS["default"] = {
+        "BACKEND": "core.layers.HybridChannelLayer",
+        "CONFIG": {"hosts": [BENCHMARK_LAYER], "capacity": 1000},
+    }
+    CHAT_PRESENCE = {**CHAT_PRESENCE, "LOCATION": BENCHMARK_LAYER}  # noqa: F405
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ.get(
+            "BENCHMARK_DB",
+            os.path.join(tempfile.gettempdir(), "django-channels-examples-bench.sqlite3"),
+        ),
+    }
+}
+
+# The load benchmarks send faster than a client is allowed to
+WEBSOCKET_THROTTLING = {**WEBSOCKET_THROTTLING, "rate": None, "user_rate": None}  # noqa: F405
+
+# The load benchmarks count every update, which must not be merged
+CHECKLIST_COALESCING = {"window": None}
+
+DEBUG = False
@@ -0,0 +1,83 @@
+"""Measures the overhead of the `ThrottleMixin` on the receive and send path of a socket.
+
+Usage::
+
+    python -m benchmarks.throttling --frames 5000
+
+An echo consumer with the `CodecMixin` answers every frame of a client, once without
+and once with the `ThrottleMixin`, whose token buckets are set high enough to never
+throttle. The round trip of every frame is timed, so the throttled consumer pays for
+both token buckets. The cost of one `allow_frame` call is reported separately.
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks import percentile, setup
+
+
+def consumers():
+    from channels.generic.websocket import AsyncWebsocketConsumer
+
+    from core.codecs import CodecMixin
+    from core.throttling import ThrottleMixin, TokenBucket
+
+    class EchoConsumer(CodecMixin, AsyncWebsocketConsumer):
+        async def receive_json(self, content):
+            await self.send_json(content)
+
+    class ThrottledEchoConsumer(ThrottleMixin, EchoConsumer):
+        throttle_rate = throttle_burst = 1e9
+
+        async def connect(self):
+            self.user_bucket = TokenBucket(1e9, 1e9)
+            await self.accept()
+
+    return {"plain": EchoConsumer, "throttled": ThrottledEchoConsumer}
+
+
+async def run(consumer_class, frames):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(consumer_class.as_asgi(), "/ws/echo/")
+    await communicator.connect()
+    timings = []
+    start = time.perf_counter()
+    for i in range(frames):
+        frame_start = time.perf_counter()
+        await communicator.send_json_to({"type": "chat.message", "message": i})
+        await communicator.receive_json_from()
+        timings.append(time.perf_counter() - frame_start)
+    elapsed = time.perf_counter() - start
+    await communicator.disconnect()
+    return timings, frames / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=5000)
+    args = parser.parse_args()
+
+    setup()
+
+    from core.throttling import TokenBucket
+
+    print(f"{'consumer':>10} {'p50':>10} {'p99':>10} {'frames/s':>9}")
+    for name, consumer_class in consumers().items():
+        timings, throughput = asyncio.run(run(consumer_class, args.frames))
+        print(
+            f"{name:>10} {percentile(timings, 50) * 1e6:>8.1f}us "
+            f"{percentile(timings, 99) * 1e6:>8.1f}us {throughput:>9.0f}"
+        )
+
+    bucket, user_bucket = TokenBucket(1e9, 1e9), TokenBucket(1e9, 1e9)
+    start = time.process_time()
+    for _ in range(args.frames * 100):
+        bucket.consume() and user_bucket.consume()
+    elapsed = time.process_time() - start
+    print(f"allow_frame: {elapsed / (args.frames * 100) * 1e9:.0f}ns per frame")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import asyncio
+import fnmatch
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from core.codecs import pre_encode
+
+from .models import Room
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Spaces out calls of `wait` to at most `rate` per second, or does not limit them if
+    `rate` is not set."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next_slot = 0
+
+    async def wait(self):
+        if not self.rate:
+            return
+        now = asyncio.get_running_loop().time()
+        self.next_slot = max(self.next_slot, now)
+        delay = self.next_slot - now
+        self.next_slot += 1 / self.rate
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+@database_sync_to_async
+def match_rooms(pattern):
+    """Returns the names of the rooms which match the shell-style `pattern`."""
+    return fnmatch.filter(Room.objects.values_list("name", flat=True), pattern)
+
+
+async def broadcast(rooms, messages, user="ADMIN", concurrency=100, rate=None):
+    """Sends every message to every room as a `chat.message` from `user` and returns the
+    number of sent and failed messages and the elapsed seconds.
+
+    `messages` may be any iterable, e.g. the lines of a file, and is consumed while the
+    messages are sent. Up to `concurrency` sends are in flight at the same time and at
+    most `rate` messages are sent per second. All sends share the connections of the
+    channel layer for the running event loop.
+    """
+    channel_layer = get_channel_layer()
+    limiter = RateLimiter(rate)
+    rooms = list(rooms)
+    result = {"sent": 0, "failed": 0}
+
+    def events():
+        for message in messages:
+            event = pre_encode({"type": "chat.message", "user": user, "message": message})
+            for room in rooms:
+                yield room, event
+
+    pending = events()
+
+    async def worker():
+        for room, event in pending:
+            await limiter.wait()
+            try:
+                await channel_layer.group_send(f"chat_{room}", event)
+                result["sent"] += 1
+            except Exception:
+                logger.exception("Failed to send a message to room %s", room)
+                result["failed"] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result["seconds"] = time.perf_counter() - start
+    return result
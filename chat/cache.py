@@ -0,0 +1,234 @@
+import asyncio
+import bisect
+import time
+from collections import Counter, OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from chat.models import Room
+
+# Rough per-entry overhead of the list and strings on top of the characters
+ENTRY_OVERHEAD = 200
+
+
+def entry_size(entry):
+    # The id is `None` until the message is written and small otherwise
+    return sum(map(len, entry[:3])) + ENTRY_OVERHEAD
+
+
+class RoomBuffer:
+    """Ring buffer with the latest `[user, message, timestamp, id]` entries of a room,
+    ordered by timestamp. The same `chat.message` event is seen by every consumer of the
+    room, so entries are deduplicated by user and timestamp."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = []
+        self.keys = {}
+        self.nbytes = 0
+        self.loaded = False
+        # Whether the buffer holds every message of the room
+        self.complete = False
+
+    def add(self, entry):
+        key = (entry[2], entry[0])
+        if key in self.keys:
+            return 0
+        if self.entries and entry[2] < self.entries[-1][2]:
+            bisect.insort(self.entries, entry, key=lambda e: e[2])
+        else:
+            self.entries.append(entry)
+        self.keys[key] = entry
+        nbytes = entry_size(entry)
+
+        while len(self.entries) > self.size:
+            old = self.entries.pop(0)
+            self.complete = False
+            self.keys.pop((old[2], old[0]), None)
+            nbytes -= entry_size(old)
+
+        self.nbytes += nbytes
+        return nbytes
+
+    def set_id(self, user, timestamp, pk):
+        entry = self.keys.get((timestamp, user))
+        if entry is not None:
+            entry[3] = pk
+
+
+class RecentMessages:
+    """In-process cache of the most recent messages of each room, which serves the
+    history replay on connect without querying the `Message` table.
+
+    A room is loaded from the database on the first request and afterwards kept up to
+    date from the `chat.message` events which pass through the consumers of the room.
+    Since other processes may receive messages for a room as well, a room is only cached
+    while this process has at least one socket in it. Cold rooms are evicted in LRU
+    order if there are more than `max_rooms` rooms or the entries take more than
+    `max_bytes`.
+    """
+
+    def __init__(self, size=50, max_rooms=1000, max_bytes=16 * 1024 * 1024):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self.rooms = OrderedDict()
+        self.subscribers = Counter()
+        self.loading = {}
+        self.nbytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def subscribe(self, room):
+        self.subscribers[room] += 1
+
+    def unsubscribe(self, room):
+        self.subscribers[room] -= 1
+        if self.subscribers[room] <= 0:
+            del self.subscribers[room]
+            self.evict(room)
+
+    def evict(self, room):
+        buffer = self.rooms.pop(room, None)
+        if buffer is not None:
+            self.nbytes -= buffer.nbytes
+            self.stats["evictions"] += 1
+
+    def add(self, room, entry):
+        buffer = self.rooms.get(room)
+        if buffer is None:
+            return
+        self.rooms.move_to_end(room)
+        self.nbytes += buffer.add(entry)
+        self.shrink()
+
+    def is_complete(self, room):
+        """Returns whether the cached entries of `room` are all messages of the room."""
+        buffer = self.rooms.get(room)
+        return buffer is not None and buffer.loaded and buffer.complete
+
+    def set_ids(self, messages):
+        """Sets the ids of the entries of `Message` instances once they were written."""
+        for message in messages:
+            buffer = self.rooms.get(message.room.name)
+            if buffer is not None:
+                buffer.set_id(message.user.username, message.timestamp.isoformat(), message.pk)
+
+    def shrink(self):
+        while self.rooms and (len(self.rooms) > self.max_rooms or self.nbytes > self.max_bytes):
+            self.evict(next(iter(self.rooms)))
+
+    async def get(self, room, loader, limit):
+        """Returns the latest `limit` entries of `room`. On a miss the entries are loaded
+        by awaiting `loader()`; concurrent misses for the same room share one load."""
+        buffer = self.rooms.get(room)
+        if buffer is not None and buffer.loaded:
+            self.stats["hits"] += 1
+            self.rooms.move_to_end(room)
+            return buffer.entries[-limit:]
+
+        if room in self.loading:
+            self.stats["hits"] += 1
+            return (await asyncio.shield(self.loading[room]))[-limit:]
+
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self.loading[room] = future
+        if room in self.subscribers:
+            # Collects the events which arrive while the room is loaded
+            buffer = self.rooms[room] = RoomBuffer(self.size)
+        try:
+            entries = await loader()
+        except Exception as e:
+            self.evict(room)
+            future.set_exception(e)
+            raise
+        finally:
+            del self.loading[room]
+
+        if buffer is not None and self.rooms.get(room) is buffer:
+            # The loader returns at most `limit` entries, so fewer are all there are
+            buffer.complete = len(entries) < limit
+            for entry in entries:
+                self.nbytes += buffer.add(entry)
+            buffer.loaded = True
+            entries = buffer.entries
+            self.shrink()
+        future.set_result(entries)
+        return entries[-limit:]
+
+    def get_stats(self):
+        return {**self.stats, "rooms": len(self.rooms), "bytes": self.nbytes}
+
+
+class RoomCache:
+    """In-process cache of the primary keys of rooms by their name.
+
+    Entries are invalidated by the `post_save` and `post_delete` signals of `Room` and
+    expire after `timeout` seconds, which bounds how long other processes may see a
+    renamed or deleted room. Concurrent misses for the same name share one query, so a
+    reconnect storm into a popular room results in a single lookup.
+    """
+
+    def __init__(self, timeout=300):
+        self.timeout = timeout
+        self.ids = {}
+        self.names = {}
+        self.loading = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, name):
+        entry = self.ids.get(name)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        self.stats["hits"] += 1
+        return entry[0]
+
+    def set(self, name, pk):
+        if pk is not None:
+            self.ids[name] = (pk, time.monotonic() + self.timeout)
+            self.names[pk] = name
+
+    def invalidate(self, pk, name=None):
+        for name in [self.names.pop(pk, None), name]:
+            if name is not None:
+                self.ids.pop(name, None)
+
+    def query(self, name):
+        self.stats["misses"] += 1
+        return Room.objects.filter(name=name).values_list("pk", flat=True).first()
+
+    def get_id(self, name):
+        """Returns the primary key of the room with the given name or `None`."""
+        pk = self.get(name)
+        if pk is None:
+            pk = self.query(name)
+            self.set(name, pk)
+        return pk
+
+    async def aget_id(self, name):
+        pk = self.get(name)
+        if pk is not None:
+            return pk
+
+        if name in self.loading:
+            self.stats["hits"] += 1
+            return await asyncio.shield(self.loading[name])
+
+        future = asyncio.get_running_loop().create_future()
+        self.loading[name] = future
+        try:
+            pk = await database_sync_to_async(self.query)(name)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.loading[name]
+
+        self.set(name, pk)
+        future.set_result(pk)
+        return pk
+
+
+room_cache = RoomCache(**getattr(settings, "CHAT_ROOM_CACHE", {}))
+recent_messages = RecentMessages(**getattr(settings, "CHAT_RECENT_MESSAGES", {}))
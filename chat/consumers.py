@@ -1,122 +1,245 @@
-import json
+import asyncio
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
+from core.codecs import CodecMixin, pre_encode
+from core.metrics import MetricsMixin, database_seconds, timed
+from core.throttling import ThrottleMixin
+
+from .cache import recent_messages, room_cache
 from .models import Message, Room
+from .persistence import message_writer
+from .presence import presence
+
+HISTORY_LIMIT = getattr(settings, "CHAT_HISTORY_LIMIT", 50)
+
 
+def parse_cursor(data):
+    """Returns the `(before, before_id)` cursor of a `history.before` request, or `None`
+    if the timestamp is missing or malformed. The id is optional."""
+    before, before_id = data.get("before"), data.get("before_id")
+    if not isinstance(before, str):
+        return None
+    if before_id is not None and (not isinstance(before_id, int) or isinstance(before_id, bool)):
+        return None
+    try:
+        before = parse_datetime(before)
+    except ValueError:
+        return None
+    return (before, before_id) if before is not None else None
 
-class ChatConsumer(WebsocketConsumer):
+
+class ChatConsumer(MetricsMixin, ThrottleMixin, CodecMixin, AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(args, kwargs)
         self.room_name = None
         self.room_group_name = None
         self.room = None
         self.user = None
-        self.user_inbox = None
+        self.heartbeat = None
 
-    def connect(self):
+    async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = f"chat_{self.room_name}"
-        self.room = Room.objects.get(name=self.room_name)
+        self.room = await self.get_room()
         self.user = self.scope["user"]
-        self.user_inbox = f"inbox_{self.user.username}"
 
-        if not self.user.is_authenticated:
-            self.close()
+        if not self.user.is_authenticated or self.room is None:
+            await self.close()
         else:
-            self.accept()
-            async_to_sync(self.channel_layer.group_add)(
+            # Clients which pass `?batch=<milliseconds>` receive the events of the room
+            # in `batch` frames
+            self.batch_window = self.get_batch_window()
+            await self.accept()
+            await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
-            self.room.online.add(self.user)
-            self.send(json.dumps({
+            await presence.join(self.room_name, self.channel_name, self.user.username)
+            self.heartbeat = asyncio.create_task(self.keep_presence())
+            recent_messages.subscribe(self.room_name)
+            await self.send_json({
                 "type": "user.list",
-                "users": [user.username for user in self.room.online.all()]
-            }))
-        
-            async_to_sync(self.channel_layer.group_add)(
-                self.user_inbox,
-                self.channel_name
-            )
-            async_to_sync(self.channel_layer.group_send)(
+                "users": await presence.list(self.room_name)
+            })
+            await self.send_history()
+            for event in await presence.take_queued(self.user.username):
+                await self.send_json(event)
+
+            await self.channel_layer.group_send(
                 self.room_group_name,
-                {
+                pre_encode({
                     "type": "user.join",
                     "user": self.user.username
-                }
+                })
             )
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-        if self.user.is_authenticated:
-            async_to_sync(self.channel_layer.group_discard)(
-                self.user_inbox,
-                self.channel_name
-            )
-            async_to_sync(self.channel_layer.group_send)(
+        if self.user.is_authenticated and self.room is not None:
+            await self.channel_layer.group_send(
                 self.room_group_name,
-                {
+                pre_encode({
                     "type": "user.leave",
                     "user": self.user.username
-                }
+                })
             )
 
-            self.room.online.remove(self.user)
-
-    def receive(self, text_data=None, bytes_data=None):
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
+            self.heartbeat.cancel()
+            self.cancel_batch()
+            recent_messages.unsubscribe(self.room_name)
+            await presence.leave(self.room_name, self.channel_name, self.user.username)
 
+    async def receive_json(self, text_data_json):
         if not self.user.is_authenticated:
-            return 
+            return
+
+        if text_data_json.get("type") == "history.before":
+            cursor = parse_cursor(text_data_json)
+            if cursor is None:
+                await self.send_json(
+                    {"type": "error", "message": "'history.before' requires a timestamp"}
+                )
+                return
+            await self.send_history(*cursor)
+            return
+
+        message = text_data_json["message"]
 
         if message.startswith("/pm"):
             split = message.split(" ", 2)
             target = split[1]
             target_msg = split[2]
 
-            async_to_sync(self.channel_layer.group_send)(
-                f"inbox_{target}",
-                {
-                    "type": "private.message",
-                    "user": self.user.username,
-                    "message": target_msg
-                }
-            )
-            self.send(json.dumps({
+            status = await self.send_private_message({
+                "type": "private.message",
+                "user": self.user.username,
+                "message": target_msg,
+                "timestamp": timezone.now().isoformat()
+            }, target)
+            if status is None:
+                await self.send_json(
+                    {"type": "error", "message": f"No user found with name {target}"}
+                )
+                return
+            await self.send_json({
                 "type": "private.message.delivered",
                 "target": target,
-                "message": target_msg
-            }))
+                "message": target_msg,
+                "status": status
+            })
             return
 
-        async_to_sync(self.channel_layer.group_send)(
+        timestamp = timezone.now()
+        await self.channel_layer.group_send(
             self.room_group_name,
-            {
+            pre_encode({
                 "type": "chat.message",
                 "user": self.user.username,
-                "message": message
-            }
+                "message": message,
+                "timestamp": timestamp.isoformat()
+            })
+        )
+        stored = await message_writer.add(
+            Message(user=self.user, room=self.room, content=message, timestamp=timestamp)
+        )
+        if not stored:
+            await self.send_json({"type": "error", "message": "The message could not be stored"})
+
+    async def send_private_message(self, event, target):
+        """Sends a private message to the sockets of the target user, which are looked up
+        in the presence store, and queues it if the user is offline. Returns `"online"` if
+        a socket received the message, `"offline"` if it was queued and `None` if the user
+        does not exist."""
+        frame_event = pre_encode(event)
+        delivered = False
+        for channel_name in await presence.channels(target):
+            try:
+                await self.channel_layer.send(channel_name, frame_event)
+                delivered = True
+            except ChannelFull:
+                pass
+        if delivered:
+            return "online"
+        # Only existing users get an inbox, so clients cannot fill the store with names
+        if not await self.user_exists(target):
+            return None
+        await presence.queue(target, event)
+        return "offline"
+
+    @database_sync_to_async
+    def user_exists(self, username):
+        return get_user_model().objects.filter(username=username).exists()
+
+    async def get_room(self):
+        room_id = await room_cache.aget_id(self.room_name)
+        return Room(pk=room_id, name=self.room_name) if room_id is not None else None
+
+    async def send_history(self, before=None, before_id=None):
+        """Sends the latest messages of the room, or the messages before the
+        `(before, before_id)` cursor, in a single frame of `[user, message, timestamp, id]`
+        rows."""
+        if before is None:
+            messages = await recent_messages.get(
+                self.room_name, self.load_recent_history, HISTORY_LIMIT
+            )
+            # The ring buffer may hold fewer messages than the limit while older ones exist
+            more = len(messages) == HISTORY_LIMIT or not recent_messages.is_complete(self.room_name)
+        else:
+            messages = await self.get_history(before, before_id)
+            more = len(messages) == HISTORY_LIMIT
+        await self.send_json({
+            "type": "history",
+            "before": before.isoformat() if before else None,
+            "before_id": before_id,
+            "messages": messages,
+            "more": more
+        })
+
+    async def load_recent_history(self):
+        # Pending messages of the write-behind buffer must be part of the history
+        await message_writer.flush()
+        return await self.get_history(None, None)
+
+    @database_sync_to_async
+    @timed(database_seconds, "chat.history")
+    def get_history(self, before, before_id):
+        return Message.objects.history(
+            self.room.pk, before=before, before_id=before_id, limit=HISTORY_LIMIT
         )
-        Message.objects.create(user=self.user, room=self.room, content=message)
 
-    def chat_message(self, event):
-        self.send(text_data=json.dumps(event))
+    async def keep_presence(self):
+        """Refreshes the presence entry of this socket before it expires."""
+        while True:
+            await asyncio.sleep(presence.heartbeat)
+            await presence.join(self.room_name, self.channel_name, self.user.username)
+
+    async def chat_message(self, event):
+        if "timestamp" in event:
+            # The id is set by the write-behind buffer once the message is written
+            recent_messages.add(
+                self.room_name, [event["user"], event["message"], event["timestamp"], None]
+            )
+        await self.send_event(event)
 
-    def user_join(self, event):
-        self.send(text_data=json.dumps(event))
+    async def user_join(self, event):
+        await self.send_event(event)
 
-    def user_leave(self, event):
-        self.send(text_data=json.dumps(event))
+    async def user_leave(self, event):
+        await self.send_event(event)
 
-    def private_message(self, event):
-        self.send(text_data=json.dumps(event))
+    async def private_message(self, event):
+        await self.send_event(event)
 
-    def private_message_delivered(self, event):
-        self.send(text_data=json.dumps(event))
+    async def private_message_delivered(self, event):
+        await self.send_event(event)
@@ -0,0 +1,28 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from core.layers import ShardedChannelLayer
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the group memberships of the channel layer to the hosts the hash ring "
+        "assigns them to after the hosts of the layer changed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--old_host",
+            action="append",
+            required=True,
+            help="Address of a host of the previous configuration, e.g. redis://127.0.0.1:6379",
+        )
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        if not isinstance(channel_layer, ShardedChannelLayer):
+            raise CommandError("The channel layer is not a ShardedChannelLayer")
+
+        moved = async_to_sync(channel_layer.rebalance)(options["old_host"])
+        self.stdout.write(f"Moved {moved} groups")
@@ -1,14 +1,30 @@
+import sys
+
 from asgiref.sync import async_to_sync
-from django.core.management.base import BaseCommand
-from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.broadcast import broadcast, match_rooms
 
 
 class Command(BaseCommand):
+    help = (
+        "Sends messages to chat rooms. Every message is sent to every given room within "
+        "one process, so thousands of rooms can be reached in one run."
+    )
+
     def add_arguments(self, parser):
         parser.add_argument(
             "--room_name",
+            action="append",
+            type=str,
+            default=[],
+            help="Name of a room, may be repeated"
+        )
+        parser.add_argument(
+            "--room_pattern",
             action="store",
-            type=str
+            type=str,
+            help="Shell-style pattern of the room names, e.g. 'support_*'"
         )
 
         parser.add_argument(
@@ -16,16 +32,63 @@ class Command(BaseCommand):
             action="store",
             type=str
         )
-    
+        parser.add_argument(
+            "--file",
+            action="store",
+            type=str,
+            help="File with one message per line, or '-' for stdin"
+        )
+
+        parser.add_argument("--user", action="store", type=str, default="ADMIN")
+        parser.add_argument(
+            "--concurrency",
+            action="store",
+            type=int,
+            default=100,
+            help="Number of messages which are sent at the same time"
+        )
+        parser.add_argument(
+            "--rate",
+            action="store",
+            type=float,
+            default=None,
+            help="Maximum number of messages per second"
+        )
+
     def handle(self, *args, **options):
-        channel_layer = get_channel_layer()
+        if (options["message"] is None) == (options["file"] is None):
+            raise CommandError("Pass either --message or --file")
+        if not options["room_name"] and options["room_pattern"] is None:
+            raise CommandError("Pass --room_name or --room_pattern")
+
+        if options["file"] == "-":
+            self.send(options, sys.stdin)
+        elif options["file"] is not None:
+            with open(options["file"]) as f:
+                self.send(options, f)
+        else:
+            self.send(options, [options["message"]])
+
+    def send(self, options, messages):
+        # Lines are sent without their line break and empty lines are skipped
+        messages = (line.rstrip("\n") for line in messages if line.strip())
+        result = async_to_sync(self.broadcast)(options, messages)
+        seconds = result["seconds"]
+        self.stdout.write(
+            f"Sent {result['sent']} messages to {result['rooms']} rooms in {seconds:.2f}s "
+            f"({result['sent'] / seconds if seconds else 0:.0f} messages/s), "
+            f"{result['failed']} failed"
+        )
 
-        group_name = f"chat_{options['room_name']}"
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                "type": "chat.message", 
-                "user": "ADMIN",
-                "message": options["message"]
-            },
+    async def broadcast(self, options, messages):
+        rooms = set(options["room_name"])
+        if options["room_pattern"] is not None:
+            rooms.update(await match_rooms(options["room_pattern"]))
+        result = await broadcast(
+            sorted(rooms),
+            messages,
+            user=options["user"],
+            concurrency=options["concurrency"],
+            rate=options["rate"]
         )
+        return {**result, "rooms": len(rooms)}
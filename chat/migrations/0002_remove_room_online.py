@@ -0,0 +1,17 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="room",
+            name="online",
+        ),
+    ]
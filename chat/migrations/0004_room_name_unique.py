@@ -0,0 +1,36 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+def merge_duplicate_rooms(apps, schema_editor):
+    """Moves the messages of rooms with the same name to the oldest of these rooms and
+    deletes the others, so that the unique constraint can be added."""
+    Room = apps.get_model("chat", "Room")
+    Message = apps.get_model("chat", "Message")
+
+    duplicates = (
+        Room.objects.values("name")
+        .annotate(count=models.Count("id"), keep=models.Min("id"))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        others = Room.objects.filter(name=duplicate["name"]).exclude(id=duplicate["keep"])
+        Message.objects.filter(room__in=others).update(room_id=duplicate["keep"])
+        others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0003_message_history_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_rooms, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="room",
+            name="name",
+            field=models.CharField(max_length=128, unique=True),
+        ),
+    ]
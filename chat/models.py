@@ -1,31 +1,67 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 
+from chat.presence import presence
 
-class Room(models.Model):
-    name = models.CharField(max_length=128)
-    online = models.ManyToManyField(to=User, blank=True)
 
-    def get_online_count(self):
-        return self.online.count()
+class Room(models.Model):
+    name = models.CharField(max_length=128, unique=True)
 
-    def join(self, user):
-        self.online.add(user)
-        self.save()
+    # Number of online users, which views may set for many rooms with one lookup
+    online_count = None
 
-    def leave(self, user):
-        self.online.remove(user)
-        self.save()
+    def get_online_count(self):
+        if self.online_count is None:
+            return presence.count_sync(self.name)[self.name]
+        return self.online_count
 
     def __str__(self):
         return f'{self.name} ({self.get_online_count()})'
 
 
+class MessageQuerySet(models.QuerySet):
+    def history(self, room_id, before=None, before_id=None, limit=50):
+        """Returns the latest `limit` messages of a room, which precede the
+        `(before, before_id)` cursor, as `[username, content, timestamp, id]` rows,
+        oldest first. Without `before_id`, e.g. for a cached message which was not written
+        yet, all messages of the `before` timestamp are excluded.
+
+        The lookup and ordering are served by the `(room, timestamp, id)` index so
+        the cost does not depend on the number of messages in the table.
+        """
+        queryset = self.filter(room_id=room_id)
+        if before is not None and before_id is not None:
+            # Messages with the same timestamp are told apart by their id
+            queryset = queryset.filter(
+                Q(timestamp__lt=before) | Q(timestamp=before, id__lt=before_id)
+            )
+        elif before is not None:
+            queryset = queryset.filter(timestamp__lt=before)
+
+        rows = queryset.order_by("-timestamp", "-id").values_list(
+            "user__username", "content", "timestamp", "id"
+        )[:limit]
+        return [
+            [user, content, timestamp.isoformat(), pk]
+            for user, content, timestamp, pk in reversed(rows)
+        ]
+
+
 class Message(models.Model):
     user = models.ForeignKey(to=User, on_delete=models.CASCADE)
-    room = models.ForeignKey(to=Room, on_delete=models.CASCADE)
+    # The history index starts with the room, so no separate index is needed
+    room = models.ForeignKey(to=Room, on_delete=models.CASCADE, db_index=False)
     content = models.CharField(max_length=512)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "timestamp", "id"], name="chat_message_history_idx"),
+        ]
 
     def __str__(self):
         return f'{self.user.username}: {self.content} [{self.timestamp}]'
@@ -0,0 +1,176 @@
+import asyncio
+import atexit
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+
+from chat.cache import recent_messages
+from chat.models import Message
+from core.metrics import Counter, Gauge, collected, database_seconds, registry, timed
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """A write-behind buffer which collects `Message` instances of all consumers in a
+    process and stores them with a single `bulk_create`.
+
+    The buffer is flushed when it holds `batch_size` messages or `flush_interval` seconds
+    after the first message was added, whatever happens first. A producer which fills up
+    the buffer waits until its batch has been written, so a slow database slows down the
+    producers.
+
+    If a batch fails, its messages are written one by one. Messages which fail on their
+    own, e.g. because their room was deleted while they were buffered, are dropped and
+    logged, so they do not block the others. The ids of the written messages are set on
+    their entries in `recent_messages`. If the database fails altogether, the
+    remaining messages are kept and retried with the next flush, and new messages are
+    rejected while `max_pending` messages are waiting.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=0.5, max_pending=10_000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.stats = {
+            "enqueued": 0,
+            "written": 0,
+            "flushes": 0,
+            "failed_flushes": 0,
+            "dropped": 0,
+            "rejected": 0,
+            "backpressure_waits": 0,
+            "last_flush_seconds": 0.0,
+        }
+        self._loop = None
+        self._lock = None
+        self._timer = None
+        self._tasks = set()
+
+    def _bind(self):
+        """Binds the asyncio primitives to the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._timer = None
+        return loop
+
+    async def add(self, message):
+        """Buffers a message. Returns `False` if the message was rejected because the
+        buffer is full."""
+        loop = self._bind()
+        if len(self.pending) >= self.max_pending:
+            self.stats["rejected"] += 1
+            logger.warning("Rejected a chat message, %d messages are pending", self.max_pending)
+            return False
+        self.pending.append(message)
+        self.stats["enqueued"] += 1
+
+        if len(self.pending) >= self.batch_size:
+            if self._lock.locked():
+                self.stats["backpressure_waits"] += 1
+            await self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._flush_later)
+        return True
+
+    def _flush_later(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Writes all pending messages to the database."""
+        self._bind()
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self.pending = self.pending, []
+            if batch:
+                self.pending[:0] = await database_sync_to_async(self.write)(batch)
+                # The ids are the cursors of the history pages which start at these messages
+                recent_messages.set_ids(
+                    message for message in batch
+                    if message.pk is not None
+                    and Message.room.is_cached(message) and Message.user.is_cached(message)
+                )
+
+    def flush_sync(self):
+        """Writes all pending messages to the database from synchronous code, e.g. when
+        the process shuts down and no event loop is running anymore."""
+        batch, self.pending = self.pending, []
+        if batch:
+            self.pending[:0] = self.write(batch)
+
+    @timed(database_seconds, "chat.write")
+    def write(self, batch):
+        """Writes a batch and returns the messages which are retried with the next flush."""
+        start = time.perf_counter()
+        try:
+            Message.objects.bulk_create(batch)
+        except Exception:
+            self.stats["failed_flushes"] += 1
+            logger.exception("Failed to write %d chat messages", len(batch))
+            return self.write_each(batch)
+
+        self.stats["written"] += len(batch)
+        self.stats["flushes"] += 1
+        self.stats["last_flush_seconds"] = time.perf_counter() - start
+        return []
+
+    def write_each(self, batch):
+        for i, message in enumerate(batch):
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([message])
+            except (DataError, IntegrityError):
+                self.stats["dropped"] += 1
+                logger.exception("Dropped a chat message of room %s", message.room_id)
+            except Exception:
+                # The database is unavailable, so the remaining messages are retried
+                return batch[i:]
+            else:
+                self.stats["written"] += 1
+        return []
+
+    def get_stats(self):
+        return {**self.stats, "pending": len(self.pending)}
+
+
+message_writer = MessageWriter(**getattr(settings, "CHAT_MESSAGE_WRITER", {}))
+atexit.register(message_writer.flush_sync)
+
+
+@registry.collector
+def collect_stats():
+    stats = message_writer.get_stats()
+    return [
+        collected(
+            Counter,
+            "chat_messages_written_total",
+            "Chat messages written by the write-behind buffer",
+            [],
+            {(): stats["written"]},
+        ),
+        collected(
+            Counter,
+            "chat_messages_lost_total",
+            "Chat messages which were dropped as invalid or rejected by a full buffer",
+            ["reason"],
+            {("dropped",): stats["dropped"], ("rejected",): stats["rejected"]},
+        ),
+        collected(
+            Gauge,
+            "chat_messages_pending",
+            "Chat messages waiting in the write-behind buffer",
+            [],
+            {(): stats["pending"]},
+        ),
+    ]
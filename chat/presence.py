@@ -0,0 +1,272 @@
+import asyncio
+import time
+import weakref
+
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from core.codecs import codec
+
+
+class BasePresence:
+    """Keeps track of the users which are online in a chat room.
+
+    A presence entry is stored per socket (channel name) so that a user with several
+    open tabs stays online until the last tab is closed. Every entry expires after `ttl`
+    seconds unless it is refreshed by calling `join` again, which removes the entries of
+    sockets whose worker crashed without calling `leave`.
+
+    The store also routes private messages: `channels` returns the sockets of a user in
+    any room, and messages for users without a socket are kept in an inbox of at most
+    `inbox_size` messages, which expires `inbox_ttl` seconds after the last message.
+    Sockets refresh their entries every `heartbeat` seconds, so an entry which was not
+    refreshed within `ttl / 2` seconds most likely belongs to a socket which is gone and
+    is not used for private messages, which are queued instead.
+    """
+
+    def __init__(self, ttl=60, inbox_size=100, inbox_ttl=7 * 24 * 60 * 60):
+        self.ttl = ttl
+        self.inbox_size = inbox_size
+        self.inbox_ttl = inbox_ttl
+
+    @property
+    def heartbeat(self):
+        return self.ttl / 3
+
+    def fresh_after(self):
+        """Returns the expiry time after which entries count as fresh."""
+        return time.time() + self.ttl / 2
+
+    async def join(self, room, channel_name, username):
+        raise NotImplementedError
+
+    async def leave(self, room, channel_name, username):
+        raise NotImplementedError
+
+    async def list(self, room):
+        """Returns the sorted usernames of the users which are online in `room`."""
+        raise NotImplementedError
+
+    async def count(self, room):
+        return len(await self.list(room))
+
+    def count_sync(self, *rooms):
+        """Returns the number of online users of each room by name for sync code, e.g.
+        views, which would otherwise need a new event loop per call to await `count`."""
+        raise NotImplementedError
+
+    async def channels(self, username):
+        """Returns the channel names of the sockets of the user in all rooms, whose entries
+        were refreshed within the last `ttl / 2` seconds."""
+        raise NotImplementedError
+
+    async def queue(self, username, message):
+        """Keeps a message for a user who is offline until `take_queued` is called."""
+        raise NotImplementedError
+
+    async def take_queued(self, username):
+        """Removes and returns the queued messages of the user, oldest first."""
+        raise NotImplementedError
+
+
+class MemoryPresence(BasePresence):
+    """In-process presence store; only suitable if a single process serves all sockets."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.rooms = {}
+        self.users = {}
+        self.inboxes = {}
+
+    async def join(self, room, channel_name, username):
+        expires = time.time() + self.ttl
+        self.rooms.setdefault(room, {})[channel_name] = (username, expires)
+        self.users.setdefault(username, {})[channel_name] = expires
+
+    async def leave(self, room, channel_name, username):
+        entries = self.rooms.get(room, {})
+        entries.pop(channel_name, None)
+        if not entries:
+            self.rooms.pop(room, None)
+        channels = self.users.get(username, {})
+        channels.pop(channel_name, None)
+        if not channels:
+            self.users.pop(username, None)
+
+    async def list(self, room):
+        now = time.time()
+        entries = self.rooms.get(room, {})
+        for channel_name, (_, expires) in list(entries.items()):
+            if expires <= now:
+                del entries[channel_name]
+        return sorted({username for username, _ in entries.values()})
+
+    def count_sync(self, *rooms):
+        now = time.time()
+        return {
+            room: len({
+                username
+                for username, expires in list(self.rooms.get(room, {}).values())
+                if expires > now
+            })
+            for room in rooms
+        }
+
+    async def channels(self, username):
+        fresh_after = self.fresh_after()
+        return [
+            channel_name
+            for channel_name, expires in self.users.get(username, {}).items()
+            if expires > fresh_after
+        ]
+
+    async def queue(self, username, message):
+        now = time.time()
+        # Inboxes of users who did not come back are dropped once they expired
+        for name, (expires, _) in list(self.inboxes.items()):
+            if expires <= now:
+                del self.inboxes[name]
+        _, messages = self.inboxes.get(username, (None, []))
+        messages = [*messages, message][-self.inbox_size:]
+        self.inboxes[username] = (now + self.inbox_ttl, messages)
+
+    async def take_queued(self, username):
+        expires, messages = self.inboxes.pop(username, (0, []))
+        return messages if expires > time.time() else []
+
+
+class RedisPresence(BasePresence):
+    """Presence store which keeps a sorted set per room in Redis.
+
+    The members of the set are `<username>:<channel_name>` and their score is the time at
+    which the entry expires, so stale entries can be dropped with a single
+    `ZREMRANGEBYSCORE`. The set itself expires `ttl` seconds after the last join.
+    The sockets of each user are kept the same way in a sorted set of channel names and
+    the inbox of a user is a list of encoded messages.
+    """
+
+    def __init__(self, url="redis://127.0.0.1:6379/0", prefix="presence", **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.prefix = prefix
+        self._connections = weakref.WeakKeyDictionary()
+        self._sync_connection = None
+
+    def create_connection(self):
+        import redis.asyncio
+
+        return redis.asyncio.Redis.from_url(self.url)
+
+    def connection(self):
+        """Returns the Redis client of the running event loop, since clients cannot be
+        shared between event loops."""
+        loop = asyncio.get_running_loop()
+        if loop not in self._connections:
+            self._connections[loop] = self.create_connection()
+        return self._connections[loop]
+
+    def create_sync_connection(self):
+        import redis
+
+        return redis.Redis.from_url(self.url)
+
+    def sync_connection(self):
+        """Returns the Redis client of sync code, which is shared by all threads."""
+        if self._sync_connection is None:
+            self._sync_connection = self.create_sync_connection()
+        return self._sync_connection
+
+    def key(self, room):
+        return f"{self.prefix}:{room}"
+
+    def user_key(self, username):
+        return f"{self.prefix}:user:{username}"
+
+    def inbox_key(self, username):
+        return f"{self.prefix}:inbox:{username}"
+
+    async def join(self, room, channel_name, username):
+        key, user_key = self.key(room), self.user_key(username)
+        expires = time.time() + self.ttl
+        async with self.connection().pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {f"{username}:{channel_name}": expires})
+            pipe.expire(key, int(self.ttl) + 1)
+            pipe.zadd(user_key, {channel_name: expires})
+            pipe.expire(user_key, int(self.ttl) + 1)
+            await pipe.execute()
+
+    async def leave(self, room, channel_name, username):
+        async with self.connection().pipeline(transaction=False) as pipe:
+            pipe.zrem(self.key(room), f"{username}:{channel_name}")
+            pipe.zrem(self.user_key(username), channel_name)
+            await pipe.execute()
+
+    async def list(self, room):
+        key = self.key(room)
+        async with self.connection().pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, "-inf", time.time())
+            pipe.zrange(key, 0, -1)
+            _, members = await pipe.execute()
+        return sorted({member.decode().split(":", 1)[0] for member in members})
+
+    def count_sync(self, *rooms):
+        now = time.time()
+        with self.sync_connection().pipeline(transaction=False) as pipe:
+            for room in rooms:
+                pipe.zrangebyscore(self.key(room), now, "+inf")
+            results = pipe.execute()
+        return {
+            room: len({member.decode().split(":", 1)[0] for member in members})
+            for room, members in zip(rooms, results)
+        }
+
+    async def channels(self, username):
+        members = await self.connection().zrangebyscore(
+            self.user_key(username), self.fresh_after(), "+inf"
+        )
+        return [member.decode() for member in members]
+
+    async def queue(self, username, message):
+        key = self.inbox_key(username)
+        async with self.connection().pipeline(transaction=False) as pipe:
+            pipe.rpush(key, codec.dumps(message))
+            pipe.ltrim(key, -self.inbox_size, -1)
+            pipe.expire(key, int(self.inbox_ttl))
+            await pipe.execute()
+
+    async def take_queued(self, username):
+        key = self.inbox_key(username)
+        async with self.connection().pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            messages, _ = await pipe.execute()
+        return [codec.loads(message) for message in messages]
+
+
+def load_presence():
+    """Creates the presence store of the `CHAT_PRESENCE` setting. Without a `BACKEND`, the
+    store is kept in Redis if the channel layer uses Redis, since the sockets of a user
+    may then be served by other processes, and in memory otherwise. The Redis server is
+    the `LOCATION` of the setting and not one of the channel layer, whose groups and
+    channels may be sharded over several servers."""
+    config = getattr(settings, "CHAT_PRESENCE", {})
+    kwargs = config.get("CONFIG", {})
+    backend = config.get("BACKEND")
+    if backend is None:
+        layer_config = getattr(settings, "CHANNEL_LAYERS", {}).get("default", {})
+        layer = import_string(layer_config.get("BACKEND", "channels.layers.InMemoryChannelLayer"))
+        if issubclass(layer, RedisChannelLayer):
+            backend = "chat.presence.RedisPresence"
+        else:
+            backend = "chat.presence.MemoryPresence"
+    presence_class = import_string(backend)
+    if issubclass(presence_class, RedisPresence):
+        if "LOCATION" not in config:
+            raise ImproperlyConfigured("CHAT_PRESENCE requires the 'LOCATION' of a Redis server")
+        kwargs = {"url": config["LOCATION"], **kwargs}
+    return presence_class(**kwargs)
+
+
+presence = load_presence()
@@ -43,8 +43,26 @@ chatMessageSend.onclick = function() {
 
 let chatSocket = null;
 
+// timestamp and id of the oldest message in 'chatLog', used to page through the history
+let oldestTimestamp = null;
+let oldestId = null;
+let hasMoreHistory = false;
+
+// request older messages if the user scrolls to the top of 'chatLog'
+chatLog.onscroll = function() {
+    if (chatLog.scrollTop === 0 && hasMoreHistory && oldestTimestamp !== null) {
+        hasMoreHistory = false;
+        chatSocket.send(JSON.stringify({
+            "type": "history.before",
+            "before": oldestTimestamp,
+            "before_id": oldestId,
+        }));
+    }
+};
+
 function connect() {
-    chatSocket = new WebSocket("ws://" + window.location.host + "/ws/chat/" + roomName + "/");
+    // events which arrive within 25ms are sent in one 'batch' frame
+    chatSocket = new WebSocket("ws://" + window.location.host + "/ws/chat/" + roomName + "/?batch=25");
 
     chatSocket.onopen = function(e) {
         console.log("Successfully connected to the WebSocket.");
@@ -62,37 +80,11 @@ function connect() {
         const data = JSON.parse(e.data);
         console.log(data);
 
-        switch (data.type) {
-            case "chat.message":
-                chatLog.value += data.user + ":" + data.message + "\n";
-                break;
-            case "user.list":
-                for (let i = 0; i < data.users.length; i++) {
-                    onlineUsersSelectorAdd(data.users[i]);
-                }
-                break;
-            case "user.join":
-                chatLog.value += data.user + " joined the room.\n";
-                onlineUsersSelectorAdd(data.user);
-                break;
-            case "user.leave":
-                chatLog.value += data.user + " left the room.\n";
-                onlineUsersSelectorRemove(data.user);
-                break;
-
-            case "private.message":
-                chatLog.value += "PM from " + data.user + ": " + data.message + "\n";
-                break;
-            case "private.message.delivered":
-                chatLog.value += "PM to " + data.target + ": " + data.message + "\n";
-                break;
-            default:
-                console.error("Unknown message type!");
-                break;
+        if (data.type === "batch") {
+            data.events.forEach(handleMessage);
+        } else {
+            handleMessage(data);
         }
-
-        // scroll 'chatLog' to the bottom
-        chatLog.scrollTop = chatLog.scrollHeight;
     };
 
     chatSocket.onerror = function(err) {
@@ -102,6 +94,60 @@ function connect() {
     }
 }
 
+function handleMessage(data) {
+    switch (data.type) {
+        case "chat.message":
+            chatLog.value += data.user + ":" + data.message + "\n";
+            break;
+        case "history":
+            let lines = data.messages.map(function(m) {
+                return m[0] + ":" + m[1] + "\n";
+            }).join("");
+            if (data.messages.length > 0) {
+                oldestTimestamp = data.messages[0][2];
+                oldestId = data.messages[0][3];
+            }
+            hasMoreHistory = data.more;
+            if (data.before === null) {
+                chatLog.value = lines;
+                break;
+            }
+            // keep the scroll position when older messages are prepended
+            chatLog.value = lines + chatLog.value;
+            return;
+        case "user.list":
+            for (let i = 0; i < data.users.length; i++) {
+                onlineUsersSelectorAdd(data.users[i]);
+            }
+            break;
+        case "user.join":
+            chatLog.value += data.user + " joined the room.\n";
+            onlineUsersSelectorAdd(data.user);
+            break;
+        case "user.leave":
+            chatLog.value += data.user + " left the room.\n";
+            onlineUsersSelectorRemove(data.user);
+            break;
+
+        case "private.message":
+            chatLog.value += "PM from " + data.user + ": " + data.message + "\n";
+            break;
+        case "private.message.delivered":
+            chatLog.value += "PM to " + data.target + ": " + data.message
+                + (data.status === "offline" ? " (offline, delivered when " + data.target + " joins)" : "") + "\n";
+            break;
+        case "error":
+            chatLog.value += "Error: " + data.message + "\n";
+            break;
+        default:
+            console.error("Unknown message type!");
+            break;
+    }
+
+    // scroll 'chatLog' to the bottom
+    chatLog.scrollTop = chatLog.scrollHeight;
+}
+
 onlineUsersSelector.onchange = function() {
     chatMessageInput.value = "/pm " + onlineUsersSelector.value + " ";
     onlineUsersSelector.value = null;
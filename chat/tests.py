@@ -1,10 +1,31 @@
-from asgiref.sync import sync_to_async
+import asyncio
+import importlib.util
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+import fakeredis
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
 from django.contrib.auth import get_user_model
-from django.test import TransactionTestCase
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from channels.testing import WebsocketCommunicator
 
+from chat.broadcast import RateLimiter, broadcast, match_rooms
+from chat.cache import RecentMessages, RoomCache, recent_messages, room_cache
 from chat.models import Room, Message
+from chat.persistence import MessageWriter, message_writer
+from chat.presence import MemoryPresence, RedisPresence, load_presence, presence
 from core.asgi import application
+from core.layers import HybridChannelLayer, ShardedChannelLayer
+from core.codecs import CodecMixin, OrjsonCodec, StdlibCodec, frame_formats, pre_encode
+from core.metrics import Counter, Histogram, receive_seconds, registry, sent_messages
+from core.throttling import ThrottleMixin, TokenBucket, stats as throttling_stats
 
 User = get_user_model()
 
@@ -16,6 +37,10 @@ class ChatConsumerTestCase(TransactionTestCase):
         self.user2 = User.objects.create_user(username="user2", password="password")
         self.room = Room.objects.create(name="testroom")
     
+    def tearDown(self):
+        # Buffered messages of the consumers must not leak into the next test
+        message_writer.flush_sync()
+
     async def test_connect_unauthenticated_user(self):
         # Test WebSocket connection for an authenticated user
         communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
@@ -36,6 +61,10 @@ class ChatConsumerTestCase(TransactionTestCase):
         self.assertEqual(response["type"], "user.list")
         self.assertIn(self.user1.username, response["users"])
 
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "history")
+        self.assertEqual(response["messages"], [])
+
         response = await communicator.receive_json_from()
         self.assertEqual(response["type"], "user.join")
         self.assertEqual(response["user"], self.user1.username)
@@ -49,11 +78,12 @@ class ChatConsumerTestCase(TransactionTestCase):
         self.assertEqual(response["user"], "user1")
         self.assertEqual(response["message"], "Hello, World!")
 
-        # Verify that the message was saved to the database
+        await communicator.disconnect()
+
+        # Verify that the message is saved to the database with the next flush of the buffer
+        await message_writer.flush()
         exists = await sync_to_async(Message.objects.filter(user=self.user1, room=self.room, content="Hello, World!").exists)()
         self.assertTrue(exists)
-       
-        await communicator.disconnect()
 
     async def test_private_message(self):
         # Simulate private messaging between two authenticated users
@@ -62,12 +92,14 @@ class ChatConsumerTestCase(TransactionTestCase):
         await communicator_sender.connect()
         response = await communicator_sender.receive_json_from()
         response = await communicator_sender.receive_json_from()
+        response = await communicator_sender.receive_json_from()
 
         communicator_receiver = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
         communicator_receiver.scope["user"] = self.user2
         await communicator_receiver.connect()
         response = await communicator_receiver.receive_json_from()
         response = await communicator_receiver.receive_json_from()
+        response = await communicator_receiver.receive_json_from()
 
         # User1 sends a private message to User2
         pm_message = "/pm user2 Hello, this is a private message!"
@@ -79,9 +111,56 @@ class ChatConsumerTestCase(TransactionTestCase):
         self.assertEqual(response["user"], "user1")
         self.assertEqual(response["message"], "Hello, this is a private message!")
 
+        response = await communicator_sender.receive_json_from()
+        self.assertEqual(response["type"], "user.join")
+        response = await communicator_sender.receive_json_from()
+        self.assertEqual(response["type"], "private.message.delivered")
+        self.assertEqual(response["status"], "online")
+
         await communicator_sender.disconnect()
         await communicator_receiver.disconnect()
 
+    async def test_private_message_to_offline_user(self):
+        communicator_sender = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+        communicator_sender.scope["user"] = self.user1
+        await communicator_sender.connect()
+        for _ in range(3):
+            await communicator_sender.receive_json_from()
+
+        await communicator_sender.send_json_to({"message": "/pm user2 Read this later"})
+        response = await communicator_sender.receive_json_from()
+        self.assertEqual(response["type"], "private.message.delivered")
+        self.assertEqual(response["status"], "offline")
+
+        # The queued message is sent after the history when User2 connects
+        communicator_receiver = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+        communicator_receiver.scope["user"] = self.user2
+        await communicator_receiver.connect()
+        await communicator_receiver.receive_json_from()
+        await communicator_receiver.receive_json_from()
+        response = await communicator_receiver.receive_json_from()
+        self.assertEqual(response["type"], "private.message")
+        self.assertEqual(response["user"], "user1")
+        self.assertEqual(response["message"], "Read this later")
+        response = await communicator_receiver.receive_json_from()
+        self.assertEqual(response["type"], "user.join")
+
+        await communicator_sender.disconnect()
+        await communicator_receiver.disconnect()
+
+    async def test_private_message_to_unknown_user(self):
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+        communicator.scope["user"] = self.user1
+        await communicator.connect()
+        for _ in range(3):
+            await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "/pm nobody Hello"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "error")
+        self.assertEqual(await presence.take_queued("nobody"), [])
+        await communicator.disconnect()
+
     async def test_user_join_and_leave(self):
         # User1 joins the room
         communicator1 = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
@@ -89,6 +168,7 @@ class ChatConsumerTestCase(TransactionTestCase):
         await communicator1.connect()
         response = await communicator1.receive_json_from()
         response = await communicator1.receive_json_from()
+        response = await communicator1.receive_json_from()
 
         # User2 joins the room
         communicator2 = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
@@ -96,6 +176,7 @@ class ChatConsumerTestCase(TransactionTestCase):
         await communicator2.connect()
         response = await communicator2.receive_json_from()
         response = await communicator2.receive_json_from()
+        response = await communicator2.receive_json_from()
 
         # User1 should receive notification of User2 joining
         response = await communicator1.receive_json_from()
@@ -111,3 +192,954 @@ class ChatConsumerTestCase(TransactionTestCase):
         self.assertEqual(response["user"], "user1")
 
         await communicator2.disconnect()
+
+
+class ChatHistoryTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.room = Room.objects.create(name="testroom")
+        other_room = Room.objects.create(name="otherroom")
+        start = timezone.now() - timedelta(hours=1)
+        Message.objects.bulk_create(
+            [
+                Message(user=self.user, room=room, content=str(i), timestamp=start + timedelta(seconds=i))
+                for i in range(120)
+                for room in [self.room, other_room]
+            ]
+        )
+
+    def tearDown(self):
+        message_writer.flush_sync()
+
+    async def test_history_on_connect_and_pagination(self):
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "history")
+        self.assertIsNone(response["before"])
+        self.assertTrue(response["more"])
+        self.assertEqual([m[1] for m in response["messages"]], [str(i) for i in range(70, 120)])
+        self.assertEqual(response["messages"][0][0], "user1")
+        await communicator.receive_json_from()
+
+        contents = [m[1] for m in response["messages"]]
+        while response["more"]:
+            _, _, before, before_id = response["messages"][0]
+            await communicator.send_json_to(
+                {"type": "history.before", "before": before, "before_id": before_id}
+            )
+            response = await communicator.receive_json_from()
+            self.assertEqual(response["type"], "history")
+            contents = [m[1] for m in response["messages"]] + contents
+
+        self.assertEqual(contents, [str(i) for i in range(120)])
+        await communicator.disconnect()
+
+    async def test_pagination_with_equal_timestamps(self):
+        timestamp = timezone.now() - timedelta(hours=2)
+        await Message.objects.abulk_create(
+            [Message(user=self.user, room=self.room, content=f"tie{i}", timestamp=timestamp) for i in range(60)]
+        )
+        rows = await sync_to_async(Message.objects.history)(self.room.pk, limit=180)
+        _, _, before, before_id = rows[90]
+
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        for _ in range(3):
+            await communicator.receive_json_from()
+
+        contents = []
+        while before is not None:
+            await communicator.send_json_to(
+                {"type": "history.before", "before": before, "before_id": before_id}
+            )
+            response = await communicator.receive_json_from()
+            self.assertEqual(response["before_id"], before_id)
+            contents = [m[1] for m in response["messages"]] + contents
+            before, before_id = response["messages"][0][2:] if response["more"] else (None, None)
+
+        # No message which shares the timestamp of a page boundary is skipped
+        self.assertEqual(contents, [f"tie{i}" for i in range(60)] + [str(i) for i in range(30)])
+        await communicator.disconnect()
+
+    async def test_malformed_history_request(self):
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        for _ in range(3):
+            await communicator.receive_json_from()
+
+        for request in [
+            {},
+            {"before": None},
+            {"before": "yesterday"},
+            {"before": "2024-13-45T00:00:00Z"},
+            {"before": "2024-01-01T00:00:00Z", "before_id": "1"},
+        ]:
+            await communicator.send_json_to({"type": "history.before", **request})
+            response = await communicator.receive_json_from()
+            self.assertEqual(response["type"], "error")
+
+        # The socket is still open
+        await communicator.send_json_to({"type": "history.before", "before": timezone.now().isoformat()})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "history")
+        await communicator.disconnect()
+
+    async def test_history_served_from_cache(self):
+        async def connect():
+            communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+            communicator.scope["user"] = self.user
+            await communicator.connect()
+            await communicator.receive_json_from()
+            history = await communicator.receive_json_from()
+            await communicator.receive_json_from()
+            return communicator, history
+
+        communicator1, history = await connect()
+        await communicator1.send_json_to({"message": "new message"})
+        await communicator1.receive_json_from()
+        await message_writer.flush()
+
+        hits = recent_messages.get_stats()["hits"]
+        communicator2, history = await connect()
+        self.assertEqual(recent_messages.get_stats()["hits"], hits + 1)
+        self.assertEqual(history["messages"][-1][:2], ["user1", "new message"])
+        # The writer sets the id of the cached message, which can be used as a cursor
+        message = await Message.objects.alatest("id")
+        self.assertEqual(history["messages"][-1][3], message.pk)
+        self.assertEqual([m[1] for m in history["messages"][:-1]], [str(i) for i in range(71, 120)])
+
+        await communicator1.disconnect()
+        await communicator2.disconnect()
+
+    def test_history_uses_index(self):
+        with CaptureQueriesContext(connection) as context:
+            Message.objects.history(self.room.pk, before=timezone.now())
+            Message.objects.history(self.room.pk, before=timezone.now(), before_id=100)
+
+        for query in context.captured_queries:
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + query["sql"])
+                plan = " ".join(row[-1] for row in cursor.fetchall())
+            self.assertIn("chat_message_history_idx", plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+
+class RoomCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="testroom")
+        self.cache = RoomCache()
+
+    def test_lookup_is_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.cache.get_id("testroom"), self.room.pk)
+            self.assertEqual(self.cache.get_id("testroom"), self.room.pk)
+
+        # Missing rooms are not cached since the room view creates them on demand
+        with self.assertNumQueries(2):
+            self.assertIsNone(self.cache.get_id("missing"))
+            self.assertIsNone(self.cache.get_id("missing"))
+
+    def test_concurrent_lookups_share_one_query(self):
+        async def lookup():
+            return await asyncio.gather(*(self.cache.aget_id("testroom") for _ in range(20)))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(async_to_sync(lookup)(), [self.room.pk] * 20)
+
+    def test_invalidated_on_save_and_delete(self):
+        self.assertEqual(room_cache.get_id("testroom"), self.room.pk)
+        self.room.name = "renamed"
+        self.room.save()
+        self.assertIsNone(room_cache.get_id("testroom"))
+        self.assertEqual(room_cache.get_id("renamed"), self.room.pk)
+
+        self.room.delete()
+        self.assertIsNone(room_cache.get_id("renamed"))
+
+    def test_room_view_uses_cache(self):
+        self.client.get("/chat/testroom/")
+        with self.assertNumQueries(0):
+            response = self.client.get("/chat/testroom/")
+        self.assertContains(response, "Room: #testroom")
+
+        self.client.get("/chat/newroom/")
+        self.assertTrue(Room.objects.filter(name="newroom").exists())
+
+    async def test_connect_to_missing_room(self):
+        user = await sync_to_async(User.objects.create_user)(username="user1", password="password")
+        communicator = WebsocketCommunicator(application, "/ws/chat/missing/")
+        communicator.scope["user"] = user
+        connected, subprotocol = await communicator.connect()
+        self.assertFalse(connected)
+
+        await communicator.disconnect()
+
+
+class RecentMessagesTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = RecentMessages(size=3, max_rooms=2)
+        self.loads = 0
+
+    async def loader(self):
+        self.loads += 1
+        await asyncio.sleep(0.01)
+        return [["user1", "a", "2024-01-01T00:00:01"], ["user1", "b", "2024-01-01T00:00:02"]]
+
+    async def test_miss_then_hit(self):
+        self.cache.subscribe("room")
+        entries = await self.cache.get("room", self.loader, 3)
+        self.assertEqual([e[1] for e in entries], ["a", "b"])
+
+        self.cache.add("room", ["user2", "c", "2024-01-01T00:00:03"])
+        self.cache.add("room", ["user2", "c", "2024-01-01T00:00:03"])
+        entries = await self.cache.get("room", self.loader, 3)
+        self.assertEqual([e[1] for e in entries], ["a", "b", "c"])
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(self.cache.get_stats()["hits"], 1)
+        self.assertEqual(self.cache.get_stats()["misses"], 1)
+
+    async def test_ring_buffer_keeps_latest_entries(self):
+        self.cache.subscribe("room")
+        await self.cache.get("room", self.loader, 3)
+        self.cache.add("room", ["user2", "d", "2024-01-01T00:00:04"])
+        self.cache.add("room", ["user2", "c", "2024-01-01T00:00:03"])
+
+        entries = await self.cache.get("room", self.loader, 3)
+        self.assertEqual([e[1] for e in entries], ["b", "c", "d"])
+        entries = await self.cache.get("room", self.loader, 2)
+        self.assertEqual([e[1] for e in entries], ["c", "d"])
+
+    async def test_complete_until_entries_are_dropped(self):
+        self.cache.subscribe("room")
+        self.assertFalse(self.cache.is_complete("room"))
+        await self.cache.get("room", self.loader, 3)
+        self.assertTrue(self.cache.is_complete("room"))
+
+        self.cache.add("room", ["user2", "c", "2024-01-01T00:00:03"])
+        self.assertTrue(self.cache.is_complete("room"))
+        self.cache.add("room", ["user2", "d", "2024-01-01T00:00:04"])
+        self.assertFalse(self.cache.is_complete("room"))
+
+        self.cache.subscribe("full")
+        await self.cache.get("full", self.loader, 2)
+        self.assertFalse(self.cache.is_complete("full"))
+
+    async def test_concurrent_misses_share_one_load(self):
+        self.cache.subscribe("room")
+        results = await asyncio.gather(*(self.cache.get("room", self.loader, 3) for _ in range(10)))
+        self.assertEqual(self.loads, 1)
+        self.assertTrue(all(len(entries) == 2 for entries in results))
+
+    async def test_events_during_load_are_kept(self):
+        self.cache.subscribe("room")
+        task = asyncio.create_task(self.cache.get("room", self.loader, 3))
+        await asyncio.sleep(0)
+        self.cache.add("room", ["user2", "c", "2024-01-01T00:00:03"])
+        await task
+
+        entries = await self.cache.get("room", self.loader, 3)
+        self.assertEqual([e[1] for e in entries], ["a", "b", "c"])
+
+    async def test_eviction(self):
+        for room in ["room1", "room2", "room3"]:
+            self.cache.subscribe(room)
+            await self.cache.get(room, self.loader, 3)
+        self.assertEqual(list(self.cache.rooms), ["room2", "room3"])
+
+        # Rooms without a local socket are no longer kept up to date
+        self.cache.unsubscribe("room3")
+        self.assertEqual(list(self.cache.rooms), ["room2"])
+        self.assertEqual(self.cache.get_stats()["evictions"], 2)
+
+        self.cache.max_bytes = 0
+        self.cache.add("room2", ["user2", "c", "2024-01-01T00:00:03"])
+        self.assertEqual(self.cache.get_stats()["rooms"], 0)
+        self.assertEqual(self.cache.get_stats()["bytes"], 0)
+
+    async def test_not_cached_without_subscribers(self):
+        await self.cache.get("room", self.loader, 3)
+        await self.cache.get("room", self.loader, 3)
+        self.assertEqual(self.loads, 2)
+
+
+class MessageWriterTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.room = Room.objects.create(name="testroom")
+
+    def message(self, content):
+        return Message(user=self.user, room=self.room, content=content)
+
+    async def count(self):
+        return await sync_to_async(Message.objects.count)()
+
+    async def test_flush_on_batch_size(self):
+        writer = MessageWriter(batch_size=3, flush_interval=60)
+        await writer.add(self.message("1"))
+        await writer.add(self.message("2"))
+        self.assertEqual(await self.count(), 0)
+
+        await writer.add(self.message("3"))
+        self.assertEqual(await self.count(), 3)
+        self.assertEqual(writer.get_stats()["flushes"], 1)
+        self.assertEqual(writer.get_stats()["pending"], 0)
+
+    async def test_flush_on_interval(self):
+        writer = MessageWriter(batch_size=100, flush_interval=0.05)
+        await writer.add(self.message("1"))
+        self.assertEqual(await self.count(), 0)
+
+        await asyncio.sleep(0.2)
+        self.assertEqual(await self.count(), 1)
+
+    async def test_invalid_message_does_not_block_others(self):
+        writer = MessageWriter(batch_size=3, flush_interval=60)
+        # E.g. the room was deleted while the message was buffered
+        await writer.add(Message(user_id=self.user.pk, room_id=999999, content="invalid"))
+        for i in range(10):
+            await writer.add(self.message(str(i)))
+        await writer.flush()
+
+        self.assertEqual(await self.count(), 10)
+        stats = writer.get_stats()
+        self.assertEqual((stats["dropped"], stats["written"], stats["pending"]), (1, 10, 0))
+
+    async def test_failing_database_is_bounded(self):
+        writer = MessageWriter(batch_size=2, flush_interval=60, max_pending=3)
+        with mock.patch.object(Message.objects, "bulk_create", side_effect=OperationalError):
+            results = [await writer.add(self.message(str(i))) for i in range(5)]
+        # The messages are kept for the next flush, but no more than `max_pending`
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(writer.get_stats()["rejected"], 2)
+
+        await writer.flush()
+        self.assertEqual(await self.count(), 3)
+
+    def test_flush_sync(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60)
+        writer.pending.append(self.message("1"))
+        writer.flush_sync()
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(writer.get_stats()["written"], 1)
+
+
+class FakeRedisPresence(RedisPresence):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.server = fakeredis.FakeServer()
+
+    def create_connection(self):
+        return fakeredis.aioredis.FakeRedis(server=self.server)
+
+    def create_sync_connection(self):
+        return fakeredis.FakeRedis(server=self.server)
+
+
+class MemoryPresenceTestCase(SimpleTestCase):
+    presence_class = MemoryPresence
+
+    def setUp(self):
+        self.presence = self.presence_class(ttl=60)
+
+    async def test_join_and_leave(self):
+        await self.presence.join("room", "channel1", "user1")
+        await self.presence.join("room", "channel2", "user2")
+        await self.presence.join("other", "channel3", "user3")
+        self.assertEqual(await self.presence.list("room"), ["user1", "user2"])
+        self.assertEqual(await self.presence.count("room"), 2)
+
+        await self.presence.leave("room", "channel1", "user1")
+        self.assertEqual(await self.presence.list("room"), ["user2"])
+
+    async def test_count_sync(self):
+        await self.presence.join("room", "channel1", "user1")
+        await self.presence.join("room", "channel2", "user1")
+        await self.presence.join("room", "channel3", "user2")
+        await self.presence.join("other", "channel4", "user3")
+        self.assertEqual(
+            self.presence.count_sync("room", "other", "empty"),
+            {"room": 2, "other": 1, "empty": 0},
+        )
+
+    async def test_user_with_several_sockets(self):
+        await self.presence.join("room", "channel1", "user1")
+        await self.presence.join("room", "channel2", "user1")
+        self.assertEqual(await self.presence.count("room"), 1)
+
+        await self.presence.leave("room", "channel1", "user1")
+        self.assertEqual(await self.presence.list("room"), ["user1"])
+
+    async def test_stale_entries_expire(self):
+        self.presence.ttl = 0.05
+        await self.presence.join("room", "channel1", "user1")
+        self.assertEqual(await self.presence.list("room"), ["user1"])
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(await self.presence.list("room"), [])
+
+        # Joining again refreshes the entry
+        await self.presence.join("room", "channel1", "user1")
+        self.assertEqual(await self.presence.list("room"), ["user1"])
+
+    async def test_channels_of_user(self):
+        await self.presence.join("room", "channel1", "user1")
+        await self.presence.join("other", "channel2", "user1")
+        await self.presence.join("room", "channel3", "user2")
+        self.assertEqual(sorted(await self.presence.channels("user1")), ["channel1", "channel2"])
+
+        await self.presence.leave("room", "channel1", "user1")
+        self.assertEqual(await self.presence.channels("user1"), ["channel2"])
+        self.assertEqual(await self.presence.channels("user3"), [])
+
+    async def test_channels_without_recent_heartbeat(self):
+        self.presence.ttl = 0.2
+        await self.presence.join("room", "channel1", "user1")
+        await asyncio.sleep(0.12)
+        await self.presence.join("room", "channel2", "user1")
+
+        # The socket of the first entry missed its heartbeats, so it is likely gone and
+        # private messages are queued instead of sent to it
+        self.assertEqual(await self.presence.list("room"), ["user1"])
+        self.assertEqual(await self.presence.channels("user1"), ["channel2"])
+
+    async def test_queued_messages(self):
+        self.presence.inbox_size = 2
+        for i in range(3):
+            await self.presence.queue("user1", {"type": "private.message", "message": str(i)})
+
+        messages = await self.presence.take_queued("user1")
+        self.assertEqual([message["message"] for message in messages], ["1", "2"])
+        self.assertEqual(await self.presence.take_queued("user1"), [])
+
+    async def test_queued_messages_expire(self):
+        self.presence.inbox_ttl = 1
+        await self.presence.queue("user1", {"type": "private.message", "message": "1"})
+        await asyncio.sleep(1.1)
+        await self.presence.queue("user2", {"type": "private.message", "message": "2"})
+        self.assertEqual(await self.presence.take_queued("user1"), [])
+        if isinstance(self.presence, MemoryPresence):
+            # Expired inboxes are dropped without waiting for their user
+            self.assertEqual(list(self.presence.inboxes), ["user2"])
+
+    @override_settings(
+        CHAT_PRESENCE={"LOCATION": "redis://presence.internal:6380/0"},
+        CHANNEL_LAYERS={"default": {
+            "BACKEND": "core.layers.ShardedChannelLayer",
+            "CONFIG": {"hosts": [("redis1.internal", 6379), ("redis2.internal", 6379)]},
+        }},
+    )
+    def test_default_backend(self):
+        # The users on other processes are only found if the presence is kept in Redis
+        store = load_presence()
+        self.assertIsInstance(store, RedisPresence)
+        self.assertEqual(store.url, "redis://presence.internal:6380/0")
+        with self.settings(CHANNEL_LAYERS={}):
+            self.assertIsInstance(load_presence(), MemoryPresence)
+        # The server is not taken from the shards of the channel layer
+        with self.settings(CHAT_PRESENCE={}):
+            with self.assertRaises(ImproperlyConfigured):
+                load_presence()
+
+
+class RedisPresenceTestCase(MemoryPresenceTestCase):
+    presence_class = FakeRedisPresence
+
+
+class RoomPresenceTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.room = Room.objects.create(name="testroom")
+
+    def tearDown(self):
+        message_writer.flush_sync()
+
+    async def join_and_leave(self):
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+        online = [await sync_to_async(str)(self.room)]
+
+        await communicator.disconnect()
+        online.append(await sync_to_async(str)(self.room))
+        return online
+
+    def test_presence_does_not_query_database(self):
+        # Only the room and the history are looked up, joining and leaving does not
+        # touch the database
+        with self.assertNumQueries(2):
+            online = async_to_sync(self.join_and_leave)()
+
+        self.assertEqual(online, ["testroom (1)", "testroom (0)"])
+
+    def test_index_view_counts_online_users(self):
+        Room.objects.create(name="otherroom")
+        with mock.patch.object(presence, "count_sync", wraps=presence.count_sync) as count:
+            response = self.client.get("/chat/")
+        count.assert_called_once_with("testroom", "otherroom")
+        self.assertContains(response, "testroom (0)")
+        self.assertContains(response, "otherroom (0)")
+
+
+class BroadcastTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user1", password="password")
+        for name in ["support_1", "support_2", "other"]:
+            Room.objects.create(name=name)
+
+    def tearDown(self):
+        message_writer.flush_sync()
+
+    async def connect(self, room_name):
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{room_name}/")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        for _ in range(3):
+            await communicator.receive_json_from()
+        return communicator
+
+    async def test_broadcast(self):
+        rooms = await match_rooms("support_*")
+        self.assertEqual(sorted(rooms), ["support_1", "support_2"])
+
+        support = await self.connect("support_1")
+        other = await self.connect("other")
+        result = await broadcast(rooms, iter(["Maintenance at 6pm", "Sorry!"]), concurrency=3)
+        self.assertEqual((result["sent"], result["failed"]), (4, 0))
+
+        for message in ["Maintenance at 6pm", "Sorry!"]:
+            response = await support.receive_json_from()
+            self.assertEqual(response["type"], "chat.message")
+            self.assertEqual(response["user"], "ADMIN")
+            self.assertEqual(response["message"], message)
+        self.assertTrue(await other.receive_nothing())
+
+        await support.disconnect()
+        await other.disconnect()
+
+    async def test_rate_limit(self):
+        limiter = RateLimiter(rate=100)
+        start = asyncio.get_running_loop().time()
+        for _ in range(11):
+            await limiter.wait()
+        self.assertGreaterEqual(asyncio.get_running_loop().time() - start, 0.1)
+
+    def test_send_message_command(self):
+        out = StringIO()
+        call_command(
+            "send_message", "--room_pattern", "support_*", "--room_name", "other",
+            "--message", "Hello", stdout=out
+        )
+        self.assertIn("Sent 3 messages to 3 rooms", out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command("send_message", "--room_name", "other")
+
+
+class CodecTestCase(SimpleTestCase):
+    event = {"type": "chat.message", "user": "user1", "message": "Hällo \"world\"", "timestamp": None}
+
+    def test_codecs(self):
+        codec = StdlibCodec()
+        frame = codec.dumps(self.event)
+        self.assertIsInstance(frame, str)
+        self.assertEqual(codec.loads(frame), self.event)
+
+    # orjson is optional, like in `load_codec`
+    @skipUnless(importlib.util.find_spec("orjson"), "orjson is not installed")
+    def test_orjson_codec(self):
+        codec = OrjsonCodec()
+        frame = codec.dumps(self.event)
+        self.assertIsInstance(frame, str)
+        self.assertEqual(codec.loads(frame), self.event)
+        self.assertEqual(StdlibCodec().loads(frame), self.event)
+
+    def test_pre_encoded_frame_is_forwarded(self):
+        sent = []
+
+        class Consumer(CodecMixin):
+            async def send(self, text_data=None, bytes_data=None):
+                sent.append(text_data)
+
+        event = pre_encode(self.event)
+        event["user"] = "changed"
+        async_to_sync(Consumer().send_event)(event)
+        self.assertEqual(StdlibCodec().loads(sent[0]), self.event)
+
+    async def test_batch_window(self):
+        sent = []
+
+        class Consumer(CodecMixin):
+            batch_window = 0.01
+
+            async def send(self, text_data=None, bytes_data=None):
+                sent.append(StdlibCodec().loads(text_data))
+
+        consumer = Consumer()
+        for user in ["user1", "user2"]:
+            await consumer.send_event({**self.event, "user": user})
+        task = consumer.batch_task
+        await task
+        self.assertEqual([event["user"] for event in sent[0]["events"]], ["user1", "user2"])
+
+        # The events of a closed socket are dropped with the task which would send them
+        await consumer.send_event(self.event)
+        task = consumer.batch_task
+        consumer.cancel_batch()
+        await asyncio.sleep(0.02)
+        self.assertTrue(task.cancelled())
+        self.assertEqual(len(sent), 1)
+
+    def test_frame_formats(self):
+        large = {**self.event, "message": "x" * 2000}
+        for name, frame_format in frame_formats.items():
+            for event in [self.event, large]:
+                text_data, bytes_data = frame_format.encode(event)
+                self.assertEqual(frame_format.decode(text_data, bytes_data), event)
+                self.assertEqual(frame_format.encode_event(pre_encode(event)), (text_data, bytes_data))
+
+        self.assertIsInstance(frame_formats["json"].encode(large)[0], str)
+        text_data, bytes_data = frame_formats["json.zlib"].encode(large)
+        self.assertEqual((text_data, bytes_data[:1]), (None, b"\x01"))
+        self.assertLess(len(bytes_data), 200)
+        self.assertEqual(frame_formats["msgpack.zlib"].encode(self.event)[1][:1], b"\x00")
+
+    def test_encode_batch(self):
+        events = [pre_encode(self.event), {**self.event, "user": "user2"}]
+        for frame_format in frame_formats.values():
+            self.assertEqual(
+                frame_format.decode(*frame_format.encode_batch(events)),
+                {"type": "batch", "events": [self.event, {**self.event, "user": "user2"}]},
+            )
+
+
+class Socket:
+    """Stands in for a consumer which records the frames it receives and sends."""
+
+    def __init__(self):
+        self.received, self.sent = [], []
+
+    async def receive(self, text_data=None, bytes_data=None):
+        self.received.append(text_data)
+
+    async def send_json(self, content):
+        self.sent.append(content["message"])
+
+
+class ThrottlingTestCase(SimpleTestCase):
+    class Consumer(ThrottleMixin, Socket):
+        pass
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1000, burst=2)
+        self.assertEqual([bucket.consume() for _ in range(3)], [True, True, False])
+        bucket.updated -= 0.001
+        self.assertTrue(bucket.consume())
+
+    async def test_incoming_frames_are_throttled(self):
+        consumer = self.Consumer()
+        consumer.bucket = TokenBucket(rate=0.001, burst=2)
+        throttled = throttling_stats["throttled"]
+        for i in range(4):
+            await consumer.receive(text_data=str(i))
+
+        self.assertEqual(consumer.received, ["0", "1"])
+        # The client is told once
+        self.assertEqual(consumer.sent, ["Rate limit exceeded"])
+        self.assertEqual(throttling_stats["throttled"] - throttled, 2)
+
+
+class MetricsTestCase(TransactionTestCase):
+    def tearDown(self):
+        message_writer.flush_sync()
+
+    def test_render(self):
+        histogram = Histogram("test_seconds", "Test", ["type"], buckets=[0.1, 1])
+        for value in [0.05, 0.5, 5]:
+            histogram.observe(value, "a")
+        counter = Counter("test_total", "Test", ["type"], max_series=1)
+        counter.inc("a")
+        counter.inc("b", value=2)
+
+        lines = list(histogram.samples()) + list(counter.samples())
+        self.assertEqual(lines, [
+            'test_seconds_bucket{type="a",le="0.1"} 1',
+            'test_seconds_bucket{type="a",le="1"} 2',
+            'test_seconds_bucket{type="a",le="+Inf"} 3',
+            'test_seconds_sum{type="a"} 5.55',
+            'test_seconds_count{type="a"} 3',
+            'test_total{type="a"} 1',
+            'test_total{type="other"} 2',
+        ])
+
+    async def test_consumer_metrics(self):
+        user = await sync_to_async(User.objects.create_user)(username="user1", password="password")
+        await sync_to_async(Room.objects.create)(name="testroom")
+        key = ("ChatConsumer", "message")
+        received = sum(receive_seconds.series.get(key, [[0], 0])[0])
+
+        communicator = WebsocketCommunicator(application, "/ws/chat/testroom/")
+        communicator.scope["user"] = user
+        await communicator.connect()
+        for _ in range(3):
+            await communicator.receive_json_from()
+        await communicator.send_json_to({"message": "Hello"})
+        await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(sum(receive_seconds.series[key][0]) - received, 1)
+        self.assertGreater(sent_messages.series[("ChatConsumer", "chat.message")], 0)
+
+        response = await sync_to_async(self.client.get)("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        for name in ["websocket_connections{consumer=\"ChatConsumer\"} ", "channel_layer_seconds_count"]:
+            self.assertIn(name, response.content.decode())
+
+
+class FrameFormatConsumerTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.room = Room.objects.create(name="testroom")
+
+    def tearDown(self):
+        message_writer.flush_sync()
+
+    async def test_msgpack_subprotocol(self):
+        communicator = WebsocketCommunicator(
+            application, f"/ws/chat/{self.room.name}/", subprotocols=["unknown", "msgpack"]
+        )
+        communicator.scope["user"] = self.user
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual((connected, subprotocol), (True, "msgpack"))
+
+        for message_type in ["user.list", "history", "user.join"]:
+            response = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual(response["type"], message_type)
+
+        await communicator.send_to(bytes_data=msgpack.packb({"message": "Hello"}))
+        response = msgpack.unpackb(await communicator.receive_from())
+        self.assertEqual((response["type"], response["message"]), ("chat.message", "Hello"))
+        await communicator.disconnect()
+
+    # The window is far longer than the timeout of `receive_json_from`, so the batch can
+    # only be flushed because it reached `max_events`
+    @override_settings(WEBSOCKET_BATCHING={"max_window": 60_000, "max_events": 3})
+    async def test_batch_mode(self):
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/?batch=60000")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        for message_type in ["user.list", "history"]:
+            response = await communicator.receive_json_from()
+            self.assertEqual(response["type"], message_type)
+
+        # The `user.join` event of the socket itself is the first event of the batch
+        for i in range(3):
+            await communicator.send_json_to({"message": f"Message {i}"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "batch")
+        self.assertEqual(
+            [event.get("message") for event in response["events"]],
+            [None, "Message 0", "Message 1"],
+        )
+        self.assertEqual(response["events"][0]["type"], "user.join")
+        # The third message waits for the window or the next two messages
+        self.assertTrue(await communicator.receive_nothing(0.5))
+        await communicator.disconnect()
+
+
+class FakeRedisChannelLayer(HybridChannelLayer):
+    def __init__(self, server=None, **kwargs):
+        super().__init__(**kwargs)
+        self.server = server or fakeredis.FakeServer()
+        self.connections = {}
+
+    def connection(self, index):
+        loop = asyncio.get_running_loop()
+        if loop not in self.connections:
+            self.connections[loop] = fakeredis.aioredis.FakeRedis(server=self.server)
+        return self.connections[loop]
+
+
+class HybridChannelLayerTestCase(SimpleTestCase):
+    def setUp(self):
+        # Two layers which share one Redis server, like two processes
+        server = fakeredis.FakeServer()
+        self.layer = FakeRedisChannelLayer(server)
+        self.other_layer = FakeRedisChannelLayer(server)
+
+    async def test_group_send(self):
+        local = await self.layer.new_channel()
+        remote = await self.other_layer.new_channel()
+        await self.layer.group_add("room", local)
+        await self.other_layer.group_add("room", remote)
+
+        await self.layer.group_send("room", {"type": "chat.message", "message": "Hello"})
+        self.assertEqual(self.layer.get_stats(), {"local": 1, "remote": 1, "channels": 1})
+        self.assertEqual((await self.layer.receive(local))["message"], "Hello")
+        self.assertEqual((await self.other_layer.receive(remote))["message"], "Hello")
+
+        await self.layer.send(local, {"type": "private.message"})
+        await self.layer.send(remote, {"type": "private.message"})
+        self.assertEqual((await self.layer.receive(local))["type"], "private.message")
+        self.assertEqual((await self.other_layer.receive(remote))["type"], "private.message")
+        self.assertEqual(self.layer.get_stats(), {"local": 2, "remote": 2, "channels": 1})
+
+        await self.layer.group_discard("room", local)
+        await self.layer.group_send("room", {"type": "chat.message", "message": "Bye"})
+        self.assertEqual(self.layer.get_stats(), {"local": 2, "remote": 3, "channels": 0})
+        self.assertEqual((await self.other_layer.receive(remote))["message"], "Bye")
+        await self.layer.flush()
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "chat.tests.FakeRedisChannelLayer"}})
+class HybridChannelLayerConsumerTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="password")
+        self.user2 = User.objects.create_user(username="user2", password="password")
+        self.room = Room.objects.create(name="testroom")
+
+    def tearDown(self):
+        message_writer.flush_sync()
+
+    async def test_broadcast(self):
+        communicators = []
+        for user in [self.user1, self.user2]:
+            communicator = WebsocketCommunicator(application, f"/ws/chat/{self.room.name}/")
+            communicator.scope["user"] = user
+            await communicator.connect()
+            communicators.append(communicator)
+
+        await communicators[1].send_json_to({"message": "Hello"})
+        for communicator in communicators:
+            response = await communicator.receive_json_from()
+            while response["type"] != "chat.message":
+                response = await communicator.receive_json_from()
+            self.assertEqual(response["message"], "Hello")
+
+        from channels.layers import get_channel_layer
+
+        self.assertEqual(get_channel_layer().get_stats()["remote"], 0)
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    def test_metrics(self):
+        # Without pub/sub groups nothing is published, which is rendered as zero
+        self.assertIn(
+            'channel_layer_messages_total{delivery="published"} 0',
+            registry.render().splitlines(),
+        )
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('channel_layer_messages_total{delivery="remote"}', response.content.decode())
+
+
+class FakeShardedChannelLayer(ShardedChannelLayer):
+    # Fake Redis servers by address, shared by all layers of a test like real hosts
+    servers = {}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.connections = {}
+
+    def connection(self, index):
+        loop = asyncio.get_running_loop()
+        address = self.host_key(self.hosts[index])
+        if (loop, address) not in self.connections:
+            server = self.servers.setdefault(address, fakeredis.FakeServer())
+            self.connections[loop, address] = fakeredis.aioredis.FakeRedis(server=server)
+        return self.connections[loop, address]
+
+
+class ShardedChannelLayerTestCase(SimpleTestCase):
+    hosts = [f"redis://shard{i}:6379" for i in range(3)]
+
+    def setUp(self):
+        FakeShardedChannelLayer.servers = {}
+
+    def test_ring(self):
+        layer = FakeShardedChannelLayer(hosts=self.hosts)
+        bigger = FakeShardedChannelLayer(hosts=self.hosts + ["redis://shard3:6379"])
+        groups = [f"chat_room{i}" for i in range(1000)]
+        indexes = [layer.consistent_hash(group) for group in groups]
+        self.assertEqual(set(indexes), {0, 1, 2})
+        self.assertTrue(all(indexes.count(i) > 200 for i in range(3)))
+
+        # Only the groups which the new host takes over move
+        moved = [
+            group for group, index in zip(groups, indexes) if bigger.consistent_hash(group) != index
+        ]
+        self.assertTrue(all(bigger.consistent_hash(group) == 3 for group in moved))
+        self.assertLess(len(moved), 400)
+
+    async def test_group_send(self):
+        layer = FakeShardedChannelLayer(hosts=self.hosts)
+        other_layer = FakeShardedChannelLayer(hosts=self.hosts)
+        channels = []
+        for i in range(10):
+            channel = await other_layer.new_channel()
+            await other_layer.group_add(f"inbox_user{i}", channel)
+            channels.append(channel)
+
+        for i in range(10):
+            await layer.group_send(f"inbox_user{i}", {"type": "private.message", "index": i})
+        for i, channel in enumerate(channels):
+            self.assertEqual((await other_layer.receive(channel))["index"], i)
+        self.assertEqual(len(self.servers_with_groups("inbox_")), 3)
+        await other_layer.flush()
+
+    async def test_pubsub_group(self):
+        layer = FakeShardedChannelLayer(hosts=self.hosts, pubsub_groups=["chat_"])
+        other_layer = FakeShardedChannelLayer(hosts=self.hosts, pubsub_groups=["chat_"])
+        local = await layer.new_channel()
+        remote = await other_layer.new_channel()
+        await layer.group_add("chat_room", local)
+        await other_layer.group_add("chat_room", remote)
+        await other_layer.group_add("inbox_user", remote)
+
+        await layer.group_send("chat_room", {"type": "chat.message", "message": "Hello"})
+        self.assertEqual((await layer.receive(local))["message"], "Hello")
+        self.assertEqual((await other_layer.receive(remote))["message"], "Hello")
+        self.assertEqual(layer.get_stats()["published"], 1)
+        self.assertEqual(self.servers_with_groups("chat_"), [])
+
+        # The membership in the pub/sub group does not keep the channel local
+        await other_layer.group_discard("chat_room", remote)
+        await other_layer.group_send("inbox_user", {"type": "private.message"})
+        self.assertEqual((await other_layer.receive(remote))["type"], "private.message")
+        self.assertEqual(other_layer.subscriptions, {})
+        await layer.group_discard("chat_room", local)
+        await other_layer.group_discard("inbox_user", remote)
+        await layer.flush()
+        await other_layer.flush()
+
+    async def test_rebalance(self):
+        layer = FakeShardedChannelLayer(hosts=self.hosts[:2])
+        channels = {}
+        for i in range(30):
+            channels[f"inbox_user{i}"] = channel = f"specific.{i}!abc"
+            await layer.group_add(f"inbox_user{i}", channel)
+
+        bigger = FakeShardedChannelLayer(hosts=self.hosts)
+        moved = await bigger.rebalance(self.hosts[:2])
+        self.assertGreater(moved, 0)
+        self.assertEqual(await bigger.rebalance(self.hosts[:2]), 0)
+        for group, channel in channels.items():
+            connection = bigger.connection(bigger.consistent_hash(group))
+            members = await connection.zrange(bigger._group_key(group), 0, -1)
+            self.assertEqual(members, [channel.encode()])
+        await bigger.flush()
+
+    def servers_with_groups(self, prefix):
+        return [
+            address
+            for address, server in FakeShardedChannelLayer.servers.items()
+            if any(key.startswith(f"asgi:group:{prefix}".encode()) for key in server.dbs[0].keys())
+        ]
@@ -1,14 +1,24 @@
 from django.shortcuts import render
 
+from chat.cache import room_cache
 from chat.models import Room
+from chat.presence import presence
 
 
 def index_view(request):
-    context = {"rooms": Room.objects.all()}
+    rooms = list(Room.objects.all())
+    counts = presence.count_sync(*(room.name for room in rooms))
+    for room in rooms:
+        room.online_count = counts[room.name]
+    context = {"rooms": rooms}
     return render(request, "chat/index.html", context)
 
 
 def room_view(request, room_name):
-    chat_room, created = Room.objects.get_or_create(name=room_name)
+    room_id = room_cache.get_id(room_name)
+    if room_id is None:
+        chat_room, created = Room.objects.get_or_create(name=room_name)
+    else:
+        chat_room = Room(pk=room_id, name=room_name)
     context = {"room": chat_room}
     return render(request, "chat/room.html", context)
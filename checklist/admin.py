@@ -1,5 +1,5 @@
 from django.contrib import admin
-from checklist.models import Task, Item
+from checklist.models import Task, TaskMembership, Item
 
 
 class ItemInline(admin.TabularInline):
@@ -7,7 +7,12 @@ class ItemInline(admin.TabularInline):
     extra = 1
 
 
+class TaskMembershipInline(admin.TabularInline):
+    model = TaskMembership
+    extra = 0
+
+
 @admin.register(Task)
 class TaskAdmin(admin.ModelAdmin):
     model = Task
-    inlines = [ItemInline]
+    inlines = [ItemInline, TaskMembershipInline]
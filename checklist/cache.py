@@ -0,0 +1,365 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+from checklist.serializers import ItemSerializer, TaskChangeSerializer
+from core import metrics
+
+TASK_FIELDS = TaskChangeSerializer.Meta.fields
+ITEM_FIELDS = ItemSerializer.Meta.fields
+
+
+class TaskTree:
+    """The serialized tasks and items of one user, which are updated with the same
+    create, update and delete events as the clients.
+
+    Every task and item keeps its revision and deleted ones leave their revision behind,
+    so events which arrive twice or out of order do not undo newer changes. Once there
+    are more of these markers than tasks and items, or at least `min_deleted`, they are
+    pruned and only the highest pruned revision is kept as `floor`. A later event for an
+    unknown task or item at or below the floor may belong to a pruned deletion, so the
+    tree counts as out of date and is loaded again.
+    """
+
+    min_deleted = 100
+
+    def __init__(self, revision=None):
+        self.revision = revision
+        self.tasks = {}
+        self.items = {}
+        self.item_tasks = {}
+        self.deleted = {}
+        self.floor = 0
+        self.snapshot = None
+        # The user and the `TaskTrees.task_users` index while the tree is cached
+        self.user_id = None
+        self.task_users = None
+        self.expires = None
+        # Size of the tree in `TaskTrees.objects`
+        self.counted = 0
+        # Set if the tree was invalidated while it was loaded
+        self.stale = False
+        self.pending = []
+
+    @property
+    def size(self):
+        return len(self.tasks) + len(self.item_tasks) + len(self.deleted)
+
+    def index(self, task_id):
+        if self.task_users is not None:
+            self.task_users.setdefault(task_id, set()).add(self.user_id)
+
+    def unindex(self, task_id):
+        users = self.task_users.get(task_id) if self.task_users is not None else None
+        if users is not None:
+            users.discard(self.user_id)
+            if not users:
+                del self.task_users[task_id]
+
+    def is_unknown(self, data, current):
+        return current is None and self.floor > 0 and (data.get("revision") or 0) <= self.floor
+
+    def is_newer(self, entity, data, current):
+        revision = data.get("revision") or 0
+        if self.deleted.get((entity, data["id"]), -1) >= revision:
+            return False
+        return current is None or current["revision"] < revision
+
+    def put_task(self, data):
+        current = self.tasks.get(data["id"])
+        if self.is_unknown(data, current):
+            return False
+        if not self.is_newer("task", data, current):
+            return True
+        if current is not None:
+            # Events of conditional updates and signals only contain the changed fields
+            data = {**current, **data}
+        elif not set(TASK_FIELDS) <= data.keys():
+            return False
+        self.tasks[data["id"]] = {name: data[name] for name in TASK_FIELDS}
+        if current is None:
+            self.index(data["id"])
+        self.snapshot = None
+        return True
+
+    def put_item(self, data):
+        task_id = self.item_tasks.get(data["id"])
+        current = self.items[task_id][data["id"]] if task_id is not None else None
+        if self.is_unknown(data, current):
+            return False
+        if not self.is_newer("item", data, current):
+            return True
+        if current is not None:
+            # Events of conditional updates only contain the changed fields
+            data = {**current, **data}
+        elif not set(ITEM_FIELDS) <= data.keys():
+            return False
+        if ("task", data["task"]) in self.deleted:
+            return True
+        if task_id is not None and task_id != data["task"]:
+            del self.items[task_id][data["id"]]
+        self.items.setdefault(data["task"], {})[data["id"]] = {
+            name: data[name] for name in ITEM_FIELDS
+        }
+        self.item_tasks[data["id"]] = data["task"]
+        self.snapshot = None
+        return True
+
+    def delete(self, entity, pk, revision):
+        key = (entity, pk)
+        self.deleted[key] = max(self.deleted.get(key, 0), revision or 0)
+        if entity == "task":
+            if self.tasks.pop(pk, None) is not None:
+                self.unindex(pk)
+            for item_id in self.items.pop(pk, {}):
+                self.item_tasks.pop(item_id, None)
+        else:
+            task_id = self.item_tasks.pop(pk, None)
+            if task_id is not None:
+                del self.items[task_id][pk]
+        if len(self.deleted) > max(self.min_deleted, len(self.tasks) + len(self.item_tasks)):
+            self.floor = max(self.floor, *self.deleted.values())
+            self.deleted.clear()
+        self.snapshot = None
+
+    def apply(self, event, revision=None):
+        """Applies a `task.*`, `item.*` or `batch` event. Returns `False` if the tree
+        misses the item of a partial update and is therefore out of date."""
+        if event["type"] == "batch":
+            revision = event.get("revision")
+            return all([self.apply(sub_event, revision) for sub_event in event["events"]])
+        entity, action = event["type"].split(".")
+        if entity not in ("task", "item"):
+            return True
+        if action == "delete":
+            self.delete(entity, event["id"], event.get("revision", revision))
+            return True
+        put = self.put_task if entity == "task" else self.put_item
+        if put(event):
+            return True
+        if self.revision is not None:
+            return False
+        # The tree is being loaded and the entity may still arrive with the snapshot
+        self.pending.append((put, event))
+        return True
+
+    def fill(self, message):
+        """Adds the tasks of a `task.list` message and the partial updates which arrived
+        while it was loaded."""
+        for task in message["tasks"]:
+            self.put_task(task)
+            for item in task["item_set"]:
+                self.put_item(item)
+        self.stale = self.stale or not all(put(event) for put, event in self.pending)
+        self.pending = []
+
+    def render(self):
+        """Returns the `task.list` message of the tree in the order of `get_task_list`."""
+        if self.snapshot is None:
+            tasks = []
+            for pk in sorted(self.tasks):
+                items = self.items.get(pk, {})
+                task = {"id": pk, "item_set": [items[i] for i in sorted(items)]}
+                task.update(
+                    (name, value) for name, value in self.tasks[pk].items() if name != "id"
+                )
+                tasks.append(task)
+            self.snapshot = {"type": "task.list", "revision": self.revision, "tasks": tasks}
+        return self.snapshot
+
+
+class TaskTrees:
+    """In-process cache of the `task.list` snapshots of users, which serves the snapshot
+    on connect and in the views without querying the database.
+
+    A user is loaded on the first request and afterwards kept up to date from the events
+    which the receivers broadcast, the `batch` events of bulk writes and the model
+    signals of saves and deletes outside the consumers, e.g. in the admin. While this
+    process has a socket of the user, the consumers see the events of other processes as
+    well. Otherwise the entry expires `timeout` seconds after it was loaded or the last
+    socket closed, which bounds how long changes made by other processes may be missed.
+    Users are evicted in LRU order if there are more than `max_users` users or their
+    trees hold more than `max_objects` tasks, items and markers of deletions.
+
+    The snapshots are shared and must not be modified. Their revision is the one at
+    which the tree was loaded, so clients which sync from it may receive some changes
+    again.
+    """
+
+    def __init__(self, max_users=1000, max_objects=200_000, timeout=60):
+        self.max_users = max_users
+        self.max_objects = max_objects
+        self.timeout = timeout
+        self.trees = OrderedDict()
+        self.loading = {}
+        self.subscribers = Counter()
+        self.objects = 0
+        # The users whose cached tree contains a task by the id of the task
+        self.task_users = {}
+        self.lock = threading.RLock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def subscribe(self, user_id):
+        with self.lock:
+            self.subscribers[user_id] += 1
+            tree = self.trees.get(user_id)
+            if tree is not None:
+                tree.expires = None
+
+    def unsubscribe(self, user_id):
+        with self.lock:
+            self.subscribers[user_id] -= 1
+            if self.subscribers[user_id] <= 0:
+                del self.subscribers[user_id]
+                tree = self.trees.get(user_id)
+                if tree is not None:
+                    tree.expires = time.monotonic() + self.timeout
+
+    def tracks(self, user_id):
+        """Returns whether events of the user are applied, i.e. the user is cached or
+        being loaded."""
+        return user_id in self.trees or user_id in self.loading
+
+    def users_of(self, task_id):
+        """Returns the users whose cached tree contains the task."""
+        with self.lock:
+            return list(self.task_users.get(task_id, ()))
+
+    def task_of(self, user_id, item_id):
+        """Returns the task of an item in the cached tree of the user or `None`."""
+        with self.lock:
+            tree = self.trees.get(user_id)
+            return None if tree is None else tree.item_tasks.get(item_id)
+
+    def get(self, user_id):
+        """Returns the `task.list` message of the user or `None` on a miss."""
+        with self.lock:
+            tree = self.trees.get(user_id)
+            if tree is not None and tree.expires is not None and tree.expires <= time.monotonic():
+                self.evict(user_id)
+                tree = None
+            if tree is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.trees.move_to_end(user_id)
+            return tree.render()
+
+    def load(self, user, loader):
+        """Returns the `task.list` message which `loader()` reads from the database and
+        caches it. Events which arrive while the tasks are loaded are applied on top."""
+        tree = TaskTree()
+        with self.lock:
+            self.loading.setdefault(user.pk, []).append(tree)
+        try:
+            message = loader()
+        except Exception:
+            with self.lock:
+                self.stop_loading(user.pk, tree)
+            raise
+
+        with self.lock:
+            self.stop_loading(user.pk, tree)
+            tree.revision = message["revision"]
+            tree.fill(message)
+            if user.pk in self.trees or tree.stale:
+                # Another load finished first and is up to date since
+                return tree.render()
+            if user.pk not in self.subscribers:
+                tree.expires = time.monotonic() + self.timeout
+            self.trees[user.pk] = tree
+            tree.user_id, tree.task_users = user.pk, self.task_users
+            for task_id in tree.tasks:
+                tree.index(task_id)
+            self.resize(tree)
+            self.shrink()
+            return tree.render()
+
+    def stop_loading(self, user_id, tree):
+        self.loading[user_id].remove(tree)
+        if not self.loading[user_id]:
+            del self.loading[user_id]
+
+    def apply(self, user_id, event):
+        """Applies a create, update, delete or `batch` event of the user."""
+        with self.lock:
+            for pending in self.loading.get(user_id, []):
+                pending.apply(event)
+            tree = self.trees.get(user_id)
+            if tree is None:
+                return
+            if tree.apply(event):
+                self.resize(tree)
+                self.shrink()
+            else:
+                self.evict(user_id)
+
+    def resize(self, tree):
+        self.objects += tree.size - tree.counted
+        tree.counted = tree.size
+
+    def evict(self, user_id):
+        tree = self.trees.pop(user_id, None)
+        if tree is not None:
+            for task_id in tree.tasks:
+                tree.unindex(task_id)
+            tree.task_users = None
+            self.objects -= tree.counted
+            self.stats["evictions"] += 1
+
+    def invalidate(self, user_id):
+        """Drops the tree of the user, which is loaded again on the next request."""
+        with self.lock:
+            self.evict(user_id)
+            for tree in self.loading.get(user_id, []):
+                tree.stale = True
+
+    def shrink(self):
+        while self.trees and (
+            len(self.trees) > self.max_users or self.objects > self.max_objects
+        ):
+            self.evict(next(iter(self.trees)))
+
+    def clear(self):
+        with self.lock:
+            for tree in self.trees.values():
+                tree.task_users = None
+            self.trees.clear()
+            self.task_users.clear()
+            self.objects = 0
+
+    def get_stats(self):
+        return {**self.stats, "users": len(self.trees), "objects": self.objects}
+
+
+task_trees = TaskTrees(**getattr(settings, "CHECKLIST_TASK_TREES", {}))
+
+
+@metrics.registry.collector
+def collect_stats():
+    stats = task_trees.get_stats()
+    return [
+        metrics.collected(
+            metrics.Counter,
+            "checklist_task_tree_requests_total",
+            "Requests of cached task trees by result",
+            ["result"],
+            {("hit",): stats["hits"], ("miss",): stats["misses"]},
+        ),
+        metrics.collected(
+            metrics.Counter,
+            "checklist_task_tree_evictions_total",
+            "Task trees evicted from the cache",
+            [],
+            {(): stats["evictions"]},
+        ),
+        metrics.collected(
+            metrics.Gauge,
+            "checklist_task_tree_objects",
+            "Cached tasks, items and markers of deletions",
+            [],
+            {(): stats["objects"]},
+        ),
+    ]
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from collections import Counter
+
+from django.conf import settings
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+config = getattr(settings, "CHECKLIST_COALESCING", {})
+
+# Number of update events which were merged into a later one and not broadcast, for all
+# sockets of this process
+stats = Counter()
+
+
+@metrics.registry.collector
+def collect_stats():
+    return [
+        metrics.collected(
+            metrics.Counter,
+            "checklist_coalesced_updates_total",
+            "Update events which were merged into a later update of the same entity",
+            [],
+            {(): stats["coalesced"]},
+        )
+    ]
+
+
+class UpdateCoalescer:
+    """Broadcasts the events of one socket and merges successive `update` events of the
+    same entity.
+
+    The first update of an entity is sent at once and opens a window of `window` seconds.
+    Further updates of the entity within the window are merged into one event, which is
+    sent with the final state when the window ends and opens the next window. So a client
+    which types a task name receives at most one update per window instead of every
+    intermediate state. Any other event, e.g. a create, a delete or a batch, first sends
+    the pending updates, so creates and deletes keep their order relative to updates.
+
+    Merged updates are sent by a task of the coalescer, so an exception raised by `send`
+    does not reach the sender of the update. It is passed with the event to `on_error`,
+    e.g. to reply with an error message, and the other pending updates are still sent.
+    """
+
+    max_windows = 256
+
+    def __init__(self, send, window, on_error=None):
+        self.send = send
+        self.window = window
+        self.on_error = on_error
+        self.pending = {}
+        self.windows = {}
+        self.lock = asyncio.Lock()
+        self.timer = None
+
+    async def put(self, event):
+        entity, _, action = event["type"].partition(".")
+        if action != "update":
+            async with self.lock:
+                await self.send_pending()
+                await self.send(event)
+            return
+
+        loop = asyncio.get_running_loop()
+        key = (entity, event["id"])
+        async with self.lock:
+            if key in self.pending:
+                # Events of conditional updates only contain the changed fields
+                self.pending[key] = {**self.pending[key], **event}
+                stats["coalesced"] += 1
+            elif self.windows.get(key, 0) > loop.time():
+                self.pending[key] = event
+                if self.timer is None or self.timer.done():
+                    self.timer = asyncio.create_task(self.run())
+            else:
+                self.open_window(key, loop.time())
+                await self.send(event)
+
+    def open_window(self, key, now):
+        if len(self.windows) >= self.max_windows:
+            self.windows = {
+                k: end for k, end in self.windows.items() if end > now or k in self.pending
+            }
+        self.windows[key] = now + self.window
+
+    async def send_pending(self, keys=None):
+        now = asyncio.get_running_loop().time()
+        for key in list(self.pending) if keys is None else keys:
+            self.open_window(key, now)
+            await self.send(self.pending.pop(key))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            end = min(self.windows[key] for key in self.pending)
+            await asyncio.sleep(max(0, end - loop.time()))
+            async with self.lock:
+                now = loop.time()
+                for key in [k for k in self.pending if self.windows[k] <= now]:
+                    self.open_window(key, now)
+                    event = self.pending.pop(key)
+                    try:
+                        await self.send(event)
+                    except Exception as e:
+                        await self.report(event, e)
+
+    async def report(self, event, error):
+        logger.error("Failed to send a coalesced %s event", event["type"], exc_info=error)
+        if self.on_error is not None:
+            try:
+                await self.on_error(event, error)
+            except Exception:
+                logger.exception("Failed to report a coalesced %s event", event["type"])
+
+    async def close(self):
+        """Sends the pending updates, e.g. when the socket disconnects."""
+        async with self.lock:
+            await self.send_pending()
+            if self.timer is not None:
+                self.timer.cancel()
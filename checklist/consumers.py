@@ -1,64 +1,226 @@
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+import asyncio
+import functools
+from urllib.parse import parse_qs
 
-from checklist.models import Task
-from checklist.receivers import ItemReceiver, TaskReceiver, ReceiverMixin
-from checklist.serializers import TaskSerializer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
+from checklist.cache import task_trees
+from checklist.receivers import (
+    AsyncReceiverMixin,
+    ItemReceiver,
+    MembershipReceiver,
+    TaskReceiver,
+)
+from checklist.sync import get_changes, get_item_task, get_task_ids, load_task, load_task_list
+from core.codecs import CodecMixin, pre_encode
+from core.metrics import MetricsMixin
+from core.throttling import ThrottleMixin
+
+
+def get_user_group(user_id):
+    return f"checklist_{user_id}"
+
+
+def get_task_group(task_id):
+    return f"checklist_task_{task_id}"
+
+
+class ChecklistConsumer(
+    MetricsMixin, ThrottleMixin, CodecMixin, AsyncReceiverMixin, AsyncJsonWebsocketConsumer
+):
+    """Consumer of the checklists of a user, which owns tasks and may be a member of the
+    tasks of other users.
+
+    Every task has a group for the events of the task and its items, which the sockets of
+    its owner and members join. A socket computes its tasks once on connect and afterwards
+    follows its `task.create`, `task.delete` and `member.*` events, so an event reaches
+    only the sockets of the users who share its task. The group of the user receives the
+    `task.create` events of the user and the `member.*` events of the memberships of the
+    user.
+    """
 
-class ChecklistConsumer(ReceiverMixin, JsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(args, kwargs)
         self.group_name = None
+        self.task_ids = set()
         self.receivers = {}
 
     def get_receiver(self, entity):
         return self.receivers.get(entity)
 
-    def connect(self):
+    async def connect(self):
         self.user = self.scope["user"]
-        self.accept()
+        await self.accept()
 
         if self.user.is_authenticated:
-            self.group_name = f"checklist_{self.user.pk}"
+            self.group_name = get_user_group(self.user.pk)
 
-            async_to_sync(self.channel_layer.group_add)(
+            await self.channel_layer.group_add(
                 self.group_name, self.channel_name
             )
-
-            queryset = Task.objects.filter(user=self.user)
-            self.task_list(
-                {"type": "task.list", "tasks": TaskSerializer(queryset, many=True).data}
-            )
+            # While the user has a socket, its events keep the cached task tree up to date
+            task_trees.subscribe(self.user.pk)
+
+            # The task groups are joined before the snapshot is read, so that no event of
+            # a task gets lost in between
+            message = task_trees.get(self.user.pk)
+            if message is None:
+                task_ids = await database_sync_to_async(get_task_ids)(self.user)
+            else:
+                task_ids = [task["id"] for task in message["tasks"]]
+            await self.join_tasks(*task_ids)
+
+            # A reconnecting client passes the last revision it has seen as `?since=`
+            # and only receives what changed in the meantime
+            since = self.get_since()
+            if since is None:
+                message = task_trees.get(self.user.pk)
+                if message is None:
+                    message = await database_sync_to_async(task_trees.load)(
+                        self.user, functools.partial(load_task_list, self.user)
+                    )
+                await self.task_list(message)
+            else:
+                await self.sync(await database_sync_to_async(get_changes)(self.user, since))
 
             self.receivers = {
                 "task": TaskReceiver(user=self.user),
                 "item": ItemReceiver(user=self.user),
+                "member": MembershipReceiver(user=self.user),
             }
 
-    def disconnect(self, close_code):
+    def get_since(self):
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        try:
+            return int(query["since"][0])
+        except (KeyError, ValueError):
+            return None
+
+    async def receive_json(self, data):
+        if data.get("type") == "sync.since" and self.user.is_authenticated:
+            try:
+                since = int(data["revision"])
+            except (KeyError, TypeError, ValueError):
+                await self.send_json(
+                    {"type": "error", "message": "'sync.since' requires a revision"}
+                )
+                return
+            await self.sync(await database_sync_to_async(get_changes)(self.user, since))
+            return
+        await super().receive_json(data)
+
+    async def disconnect(self, close_code):
         if self.user.is_authenticated:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 self.group_name, self.channel_name
             )
-
-    def task_list(self, event):
-        self.send_json(event)
-
-    def task_create(self, event):
-        self.send_json(event)
-
-    def task_update(self, event):
-        self.send_json(event)
-
-    def task_delete(self, event):
-        self.send_json(event)
-
-    def item_create(self, event):
-        self.send_json(event)
-
-    def item_update(self, event):
-        self.send_json(event)
-
-    def item_delete(self, event):
-        self.send_json(event)
+            await self.leave_tasks(*self.task_ids)
+            task_trees.unsubscribe(self.user.pk)
+
+    async def join_tasks(self, *task_ids):
+        # The groups are joined concurrently, so that a connect waits for about one round
+        # trip to the channel layer instead of one per task
+        task_ids = set(task_ids) - self.task_ids
+        self.task_ids |= task_ids
+        await asyncio.gather(*(
+            self.channel_layer.group_add(get_task_group(task_id), self.channel_name)
+            for task_id in task_ids
+        ))
+
+    async def leave_tasks(self, *task_ids):
+        task_ids = set(task_ids) & self.task_ids
+        self.task_ids -= task_ids
+        await asyncio.gather(*(
+            self.channel_layer.group_discard(get_task_group(task_id), self.channel_name)
+            for task_id in task_ids
+        ))
+
+    async def get_event_group(self, event):
+        """Returns the group which a `task.*`, `item.*` or `member.*` event is sent to."""
+        entity, _, action = event["type"].partition(".")
+        if entity == "member":
+            return get_user_group(event["user_id"])
+        if entity == "task":
+            if action == "create":
+                # The other sockets of the user join the group of the task on receipt
+                await self.join_tasks(event["id"])
+                return self.group_name
+            return get_task_group(event["id"])
+
+        # The events of conditional updates do not contain the task of the item
+        task_id = event.get("task") or task_trees.task_of(self.user.pk, event["id"])
+        if task_id is None:
+            task_id = await database_sync_to_async(get_item_task)(event["id"])
+        return self.group_name if task_id is None else get_task_group(task_id)
+
+    async def send_to_group(self, event):
+        if event["type"] == "batch":
+            # The events of a batch are sent as one `batch` event per group
+            groups = {}
+            for sub_event in event["events"]:
+                groups.setdefault(await self.get_event_group(sub_event), []).append(sub_event)
+            for group, events in groups.items():
+                await self.channel_layer.group_send(group, pre_encode({**event, "events": events}))
+            return
+
+        group = await self.get_event_group(event)
+        if event["type"].startswith("member.") and event["user_id"] != self.user.pk:
+            # The owner who shares a task is told directly
+            await self.send_json(event)
+        await self.channel_layer.group_send(group, pre_encode(event))
+
+    async def task_list(self, event):
+        await self.send_json(event)
+
+    async def sync(self, event):
+        await self.send_json(event)
+
+    async def batch(self, event):
+        events = event["events"]
+        await self.join_tasks(*(e["id"] for e in events if e["type"] == "task.create"))
+        task_trees.apply(self.user.pk, event)
+        await self.send_event(event)
+        await self.leave_tasks(*(e["id"] for e in events if e["type"] == "task.delete"))
+
+    async def task_create(self, event):
+        await self.join_tasks(event["id"])
+        task_trees.apply(self.user.pk, event)
+        await self.send_event(event)
+
+    async def task_update(self, event):
+        task_trees.apply(self.user.pk, event)
+        await self.send_event(event)
+
+    async def task_delete(self, event):
+        task_trees.apply(self.user.pk, event)
+        await self.send_event(event)
+        await self.leave_tasks(event["id"])
+
+    async def item_create(self, event):
+        task_trees.apply(self.user.pk, event)
+        await self.send_event(event)
+
+    async def item_update(self, event):
+        task_trees.apply(self.user.pk, event)
+        await self.send_event(event)
+
+    async def item_delete(self, event):
+        task_trees.apply(self.user.pk, event)
+        await self.send_event(event)
+
+    async def member_create(self, event):
+        # The task was shared with the user, whose client receives it like a new task
+        await self.join_tasks(event["task"])
+        self.receivers["item"].task_ids = None
+        task = await database_sync_to_async(load_task)(event["task"])
+        if task is not None:
+            await self.send_json({**task, "type": "task.create"})
+
+    async def member_delete(self, event):
+        # The task was unshared or the user left it
+        await self.leave_tasks(event["task"])
+        self.receivers["item"].task_ids = None
+        await self.send_json(
+            {"type": "task.delete", "id": event["task"], "revision": event["revision"]}
+        )
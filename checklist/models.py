@@ -1,14 +1,138 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import connections, models, router, transaction
 
 
-class Task(models.Model):
+class TaskQuerySet(models.QuerySet):
+    def accessible_by(self, user):
+        """Filters the tasks which `user` owns or which are shared with `user`."""
+        shared = TaskMembership.objects.filter(user=user).values("task")
+        return self.filter(models.Q(user=user) | models.Q(pk__in=shared))
+
+    def with_items(self):
+        """Loads the users and items which the `TaskSerializer` needs, so that a list
+        of tasks is serialized with two queries regardless of its size."""
+        return self.select_related("user").prefetch_related(
+            models.Prefetch(
+                "item_set", queryset=Item.objects.select_related("done_by").order_by("id")
+            )
+        )
+
+
+class RevisionedModel(models.Model):
+    """Base of the models whose rows carry a revision, which `checklist.signals` takes
+    from the `Revision` counter before the row is saved."""
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        # The revision is taken and the row is written in one transaction, see `Revision`
+        with transaction.atomic(using=kwargs.get("using")):
+            super().save(*args, **kwargs)
+
+
+class Task(RevisionedModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=128)
+    revision = models.BigIntegerField(default=0)
+
+    objects = TaskQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "revision"], name="checklist_task_revision_idx"),
+        ]
+
+
+class TaskMembership(RevisionedModel):
+    """Shares a task with a user other than its owner. Members can rename the task and
+    create, update and delete its items; only the owner can delete it and share it."""
+
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name="memberships")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    revision = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "task"], name="checklist_membership_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "revision"], name="checklist_membership_rev_idx"),
+        ]
 
 
-class Item(models.Model):
+class Item(RevisionedModel):
     name = models.CharField(max_length=128)
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
     done_at = models.DateTimeField(null=True, blank=True)
     done_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    revision = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["task", "revision"], name="checklist_item_revision_idx"),
+        ]
+
+
+class Tombstone(models.Model):
+    """Marks the deletion of a task or item, so that clients which sync the changes
+    since a revision learn about deleted entities."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    entity = models.CharField(max_length=16)
+    object_id = models.BigIntegerField()
+    revision = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "revision"], name="checklist_tombstone_idx"),
+        ]
+
+
+class Revision(models.Model):
+    """Counter of the revisions of tasks and items. Every save and delete of a task or
+    item takes the next value, so revisions increase monotonically across all users.
+
+    `next` must run in the transaction which writes the rows of the revision. The update
+    locks the counter row until that transaction commits, so changes become visible in
+    the order of their revisions and a client which has seen revision N has also seen
+    every change up to N. In exchange the counter serializes all checklist writes: a
+    write of any task waits for every other transaction which took a revision before it
+    to commit, so the write throughput is bounded by the rate at which such transactions
+    commit one after another, see `benchmarks.checklist_revisions`.
+    """
+
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def current(cls, using=None):
+        queryset = cls.objects.using(using).filter(pk=1)
+        return queryset.values_list("value", flat=True).first() or 0
+
+    @classmethod
+    def next(cls, count=1, using=None):
+        """Reserves `count` revisions on the database `using` and returns the last of them."""
+        using = using or router.db_for_write(cls)
+        connection = connections[using]
+        if (
+            connection.vendor in ("postgresql", "sqlite")
+            and connection.features.can_return_columns_from_insert
+        ):
+            # Increments and reads the counter in one statement instead of a transaction
+            # with an update and a select
+            table = connection.ops.quote_name(cls._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET "value" = "value" + %s WHERE "id" = 1 RETURNING "value"',
+                    [count],
+                )
+                row = cursor.fetchone()
+            if row is not None:
+                return row[0]
+
+        with transaction.atomic(using=using):
+            queryset = cls.objects.using(using).filter(pk=1)
+            if not queryset.update(value=models.F("value") + count):
+                cls.objects.using(using).create(pk=1, value=count)
+                return count
+            return cls.current(using)
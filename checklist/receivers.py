@@ -1,14 +1,39 @@
-from asgiref.sync import async_to_sync
-
-from checklist.models import Item, Task
-from checklist.serializers import ItemSerializer, TaskSerializer
+from channels.db import database_sync_to_async
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.deletion import Collector
+from rest_framework.exceptions import ValidationError
+
+from checklist import coalescing
+from checklist.cache import task_trees
+from checklist.coalescing import UpdateCoalescer
+from checklist.models import Item, Revision, Task, TaskMembership
+from checklist.serializers import ItemSerializer, TaskMembershipSerializer, TaskSerializer
+from core.codecs import pre_encode
+from core.metrics import database_seconds, timed
 
 
 class ReceiverError(Exception):
     pass
 
 
+class ConflictError(ReceiverError):
+    """Raised if an update carries a `revision` which is not the current revision of the
+    object. `data` is the serialized current state of the object."""
+
+    def __init__(self, message, data):
+        super().__init__(message)
+        self.data = data
+
+
 class Receiver:
+    """Processes the create, update and delete actions of an entity.
+
+    The async actions `acreate`, `aupdate` and `adelete` run the sync action in one
+    thread hop, so all queries of an action share a single database thread switch.
+    """
+
     def create(self, data):
         raise NotImplementedError
 
@@ -18,6 +43,15 @@ class Receiver:
     def delete(self, data):
         raise NotImplementedError
 
+    async def acreate(self, data):
+        return await database_sync_to_async(self.create)(data)
+
+    async def aupdate(self, data):
+        return await database_sync_to_async(self.update)(data)
+
+    async def adelete(self, data):
+        return await database_sync_to_async(self.delete)(data)
+
 
 class GenericReceiver(Receiver):
     """A generic receiver class which uses functionalities of the `rest_framework` to 
@@ -28,6 +62,8 @@ class GenericReceiver(Receiver):
     which can be used to validate and serialize objects of/for the corresponding Django model. 
     """
     serializer_class = None
+    # Fields which an update may change through the fast path of `partial_update`
+    partial_update_fields = ()
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
@@ -36,37 +72,262 @@ class GenericReceiver(Receiver):
     def get_queryset():
         raise NotImplementedError
 
-    def get_object(self, pk):
-        return self.get_queryset().get(pk=pk)
+    def get_object(self, pk, queryset=None):
+        queryset = self.get_queryset() if queryset is None else queryset
+        try:
+            return queryset.get(pk=pk)
+        except ObjectDoesNotExist:
+            raise ReceiverError(f"No object found with id {pk}")
+
+    def get_partial_object(self, pk):
+        """Returns the object for `partial_update`. Can be overridden to avoid the joins
+        of `get_queryset`."""
+        return self.get_object(pk)
+
+    def get_update_queryset(self):
+        """Returns the queryset which `conditional_update` updates. Can be overridden to
+        avoid the joins of `get_queryset`."""
+        return self.get_queryset()
+
+    def get_delete_queryset(self):
+        """Returns the queryset of the objects which the user may delete."""
+        return self.get_queryset()
+
+    def get_deleted_data(self, instance):
+        """Hook to add fields of a deleted object to the result of a delete action."""
+        return {}
+
+    def get_create_data(self, data):
+        """Hook to complete the data of a create action before it is validated."""
+        return data
 
-    def create(self, data):
-        serializer = self.serializer_class(data=data)
+    def get_update_data(self, instance, data):
+        """Hook to complete the data of an update action before it is validated."""
+        return data
+
+    def validate(self, data, instance=None):
+        serializer = self.serializer_class(instance=instance, data=data)
         if not serializer.is_valid():
             raise ReceiverError(str(serializer.errors))
+        return serializer
+
+    @timed(database_seconds, "checklist.create")
+    def create(self, data):
+        serializer = self.validate(self.get_create_data(data))
         serializer.save()
         data = serializer.data.copy()
         return data
 
+    @timed(database_seconds, "checklist.update")
     def update(self, data):
-        instance = self.get_object(pk=data["id"])
-        return self.perform_update(instance, data)
+        """Updates an object. If `data` contains the `revision` of the object which the
+        client has seen, the update only succeeds if the object was not changed since and
+        raises a `ConflictError` otherwise."""
+        revision = data.pop("revision", None)
+        if revision is not None and not isinstance(revision, int):
+            raise ReceiverError("The revision must be an integer")
+
+        fields = set(data) - {"id"}
+        if fields and fields <= set(self.partial_update_fields):
+            if revision is not None:
+                return self.conditional_update(data, revision)
+            return self.partial_update(data)
+
+        if revision is None:
+            return self.perform_update(self.get_object(pk=data["id"]), data)
+
+        # The row stays locked until the update is written, so that no concurrent update
+        # commits between the check of the revision and the write
+        with transaction.atomic():
+            instance = self.get_object(
+                pk=data["id"], queryset=self.get_queryset().select_for_update()
+            )
+            self.check_revision(instance, revision)
+            return self.perform_update(instance, data)
+
+    def check_revision(self, instance, revision):
+        if instance.revision != revision:
+            raise ConflictError(
+                f"Revision {revision} is outdated", self.serializer_class(instance).data.copy()
+            )
+
+    def get_partial_update_changes(self, instance, changes):
+        """Hook to add derived fields to the validated changes of `partial_update`.
+        `instance` is `None` for a `conditional_update`, which does not read the object."""
+        return changes
+
+    def validate_partial(self, data):
+        """Validates the changed fields of a partial update and returns the changes by
+        attribute."""
+        fields = self.serializer_class().fields
+        changes, errors = {}, {}
+        for name, value in data.items():
+            if name == "id":
+                continue
+            try:
+                changes[fields[name].source] = fields[name].run_validation(value)
+            except ValidationError as e:
+                errors[name] = e.detail
+        if errors:
+            raise ReceiverError(str(errors))
+        return changes
+
+    def partial_update(self, data):
+        """Fast path for updates which only change fields of `partial_update_fields`.
+
+        Only the changed fields are validated, so related fields of the serializer do not
+        query the database, and only the changed columns are written.
+        """
+        instance = self.get_partial_object(pk=data["id"])
+        changes = self.get_partial_update_changes(instance, self.validate_partial(data))
+        for attr, value in changes.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=[*changes, "revision"])
+        return self.serializer_class(instance).data.copy()
+
+    def conditional_update(self, data, revision):
+        """Variant of `partial_update` for clients which pass the revision they have seen.
+
+        The changes are written with one `UPDATE ... WHERE id = ? AND revision = ?`
+        without reading the object first, so concurrent updates of the same object do not
+        overwrite each other. Only the object is read if nothing matched, to tell a
+        conflict from a missing object. Since the object is not read, the returned data
+        only contains the id, the changed fields and the new revision.
+        """
+        changes = self.get_partial_update_changes(None, self.validate_partial(data))
+        with transaction.atomic():
+            changes["revision"] = Revision.next()
+            queryset = self.get_update_queryset().filter(pk=data["id"], revision=revision)
+            if not queryset.update(**changes):
+                # Raises if the object is missing or changed. Otherwise the queryset missed
+                # it, e.g. because of cached owner checks which `get_partial_object`
+                # refreshed.
+                self.check_revision(self.get_partial_object(pk=data["id"]), revision)
+                queryset = self.get_update_queryset().filter(pk=data["id"], revision=revision)
+                if not queryset.update(**changes):
+                    self.check_revision(self.get_partial_object(pk=data["id"]), revision)
+                    raise ReceiverError(f"No object found with id {data['id']}")
+
+        result = {"id": data["id"]}
+        for name, field in self.serializer_class().fields.items():
+            if field.source in changes:
+                value = changes[field.source]
+                result[name] = None if value is None else field.to_representation(value)
+        return result
 
     def perform_update(self, instance, data):
-        serializer = self.serializer_class(instance=instance, data=data)
-        if not serializer.is_valid():
-            raise ReceiverError(str(serializer.errors))
-
+        serializer = self.validate(self.get_update_data(instance, data), instance=instance)
         serializer.save()
         data = serializer.data.copy()
         return data
 
+    @timed(database_seconds, "checklist.delete")
     def delete(self, data):
-        instance = self.get_object(pk=data["id"])
+        instance = self.get_object(pk=data["id"], queryset=self.get_delete_queryset())
         instance.delete()
-        return {"id": data["id"]}
+        # The revision of the tombstone, see `checklist.signals`
+        return {"id": data["id"], **self.get_deleted_data(instance), "revision": instance.revision}
+
+    @timed(database_seconds, "checklist.bulk")
+    def bulk(self, action, data_list):
+        """Runs `action` for a list of `data` dicts with a fixed number of queries for
+        reading and writing the instances. Validation still runs per operation.
+
+        Returns a list which contains the serialized data or the `ReceiverError` of each
+        operation in the order of `data_list`. The caller is responsible for running
+        this method in a transaction.
+        """
+        return getattr(self, f"bulk_{action}")(data_list)
+
+    def get_objects(self, data_list, queryset=None):
+        """Returns the instances referenced by the `id` of the `data` dicts or a
+        `ReceiverError` for each `data` which does not reference an existing object."""
+        queryset = self.get_queryset() if queryset is None else queryset
+        ids = [data.get("id") for data in data_list]
+        objects = queryset.in_bulk([pk for pk in ids if isinstance(pk, int)])
+        return [
+            objects.get(pk) if pk in objects else ReceiverError(f"No object found with id {pk}")
+            for pk in ids
+        ]
+
+    def set_revisions(self, instances):
+        """Assigns revisions to instances which are written without `save`."""
+        instances = list({id(instance): instance for instance in instances}.values())
+        last = Revision.next(len(instances)) if instances else 0
+        for i, instance in enumerate(instances):
+            instance.revision = last - len(instances) + 1 + i
+        return instances
+
+    def bulk_create(self, data_list):
+        model = self.serializer_class.Meta.model
+        results = []
+        for data in data_list:
+            try:
+                serializer = self.validate(self.get_create_data(data))
+                results.append(model(**serializer.validated_data))
+            except ReceiverError as e:
+                results.append(e)
+
+        instances = [r for r in results if not isinstance(r, ReceiverError)]
+        model.objects.bulk_create(self.set_revisions(instances))
+        return [
+            r if isinstance(r, ReceiverError) else self.serializer_class(r).data.copy()
+            for r in results
+        ]
+
+    def bulk_update(self, data_list):
+        model = self.serializer_class.Meta.model
+        queryset = self.get_queryset()
+        if any(data.get("revision") is not None for data in data_list):
+            # The rows stay locked until the batch is written, see `update`
+            queryset = queryset.select_for_update()
+        results = []
+        for instance, data in zip(self.get_objects(data_list, queryset=queryset), data_list):
+            if isinstance(instance, ReceiverError):
+                results.append(instance)
+                continue
+            try:
+                if data.get("revision") is not None:
+                    self.check_revision(instance, data.pop("revision"))
+                serializer = self.validate(self.get_update_data(instance, data), instance=instance)
+            except ReceiverError as e:
+                results.append(e)
+                continue
+            for attr, value in serializer.validated_data.items():
+                setattr(instance, attr, value)
+            results.append(instance)
+
+        instances = [r for r in results if not isinstance(r, ReceiverError)]
+        fields = [f.name for f in model._meta.concrete_fields if not f.primary_key]
+        model.objects.bulk_update(self.set_revisions(instances), fields)
+        return [
+            r if isinstance(r, ReceiverError) else self.serializer_class(r).data.copy()
+            for r in results
+        ]
+
+    def bulk_delete(self, data_list):
+        queryset = self.get_delete_queryset()
+        objects = self.get_objects(data_list, queryset=queryset)
+        results = [
+            r if isinstance(r, ReceiverError) else {"id": r.pk, **self.get_deleted_data(r)}
+            for r in objects
+        ]
+        instances = [r for r in objects if not isinstance(r, ReceiverError)]
+        if instances:
+            # The signals receive these instances and set the revisions of the tombstones
+            collector = Collector(using=queryset.db, origin=queryset)
+            collector.collect(instances)
+            collector.delete()
+        for result, instance in zip(results, objects):
+            if not isinstance(result, ReceiverError):
+                result["revision"] = instance.revision
+        return results
 
 
 class ReceiverMixin:
+    """Maps the `ENTITY.ACTION` messages of a consumer to the actions of its receivers and
+    processes `batch` messages, see `AsyncReceiverMixin` for the consumer side."""
+
     @property
     def allow_actions(self):
         return ["create", "update", "delete"]
@@ -76,65 +337,278 @@ class ReceiverMixin:
         from the`GenericReicver` class."""
         raise NotImplementedError
 
-    def receive_json(self, data):
+    def get_receiver_action(self, message_type):
+        """Returns the receiver and the action for a message type `ENTITY.ACTION`."""
+        split = message_type.split(".")
+        if len(split) != 2:
+            msg = "Format must by 'ENTITY.ACTION'"
+            raise ReceiverError(msg)
+
+        entity, action = split
+        receiver = self.get_receiver(entity)
+
+        if not receiver:
+            msg = f"No entity found with name {entity}"
+            raise ReceiverError(msg)
+
+        if action not in self.allow_actions:
+            msg = f"No action found with name {action}"
+            raise ReceiverError(msg)
+
+        return receiver, action
+
+    def get_conflict_message(self, message_type, error):
+        """Returns the `ENTITY.conflict` message with the current state of the object,
+        which is only sent to the client whose update lost."""
+        entity = message_type.split(".")[0]
+        return {**error.data, "type": f"{entity}.conflict"}
+
+    def process_batch(self, operations):
+        """Writes a batch and returns the `batch` event and the `error` message, each of
+        which is `None` if there are no successful or failed operations, and the
+        `ENTITY.conflict` messages of the updates whose revision is outdated."""
+        groups = {}
+        errors = {}
+        for index, data in enumerate(operations):
+            message_type = data.pop("type", "") if isinstance(data, dict) else ""
+            try:
+                receiver, action = self.get_receiver_action(message_type)
+            except ReceiverError as e:
+                errors[index] = (message_type, e)
+                continue
+            groups.setdefault((message_type, action), (receiver, []))[1].append((index, data))
+
+        events = {}
+        with transaction.atomic():
+            for (message_type, action), (receiver, group) in groups.items():
+                results = receiver.bulk(action, [data for _, data in group])
+                for (index, _), result in zip(group, results):
+                    if isinstance(result, ReceiverError):
+                        errors[index] = (message_type, result)
+                    else:
+                        events[index] = {**result, "type": message_type}
+
+        event = error = None
+        conflicts = [
+            self.get_conflict_message(message_type, e)
+            for index, (message_type, e) in sorted(errors.items())
+            if isinstance(e, ConflictError)
+        ]
+        if events:
+            event = {
+                "type": "batch",
+                "revision": Revision.current(),
+                "events": [events[index] for index in sorted(events)],
+            }
+            # Bulk writes do not send the model signals which update the task trees
+            task_trees.apply(self.user.pk, event)
+        if errors:
+            msg = f"{len(errors)} of {len(operations)} batch operations cannot be processed"
+            error = {
+                "type": "error",
+                "message": msg,
+                "errors": [
+                    {
+                        "index": index,
+                        "message": f"Message type '{message_type}' cannot be processed: {e}",
+                    }
+                    for index, (message_type, e) in sorted(errors.items())
+                ],
+            }
+        return event, error, conflicts
+
+
+class AsyncReceiverMixin(ReceiverMixin):
+    """Extends an `AsyncJsonWebsocketConsumer` to work with the receivers of the
+    `ReceiverMixin`. It awaits the async actions of the receivers instead of blocking the
+    consumer.
+
+    If `coalesce_window` is set, successive updates of the same entity within that many
+    seconds are broadcast as one event with the final state, see `UpdateCoalescer`.
+    """
+
+    coalesce_window = coalescing.config.get("window")
+    coalescer = None
+
+    async def broadcast(self, event):
+        if self.coalesce_window is None:
+            await self.send_to_group(event)
+            return
+        if self.coalescer is None:
+            self.coalescer = UpdateCoalescer(
+                self.send_to_group, self.coalesce_window, self.send_broadcast_error
+            )
+        await self.coalescer.put(event)
+
+    async def send_broadcast_error(self, event, error):
+        """Tells the client that an event of its message, which was sent after its
+        `coalesce_window`, could not be broadcast."""
+        msg = f"Message type '{event['type']}' cannot be broadcast: {error}"
+        await self.send_json({"type": "error", "message": msg})
+
+    async def send_to_group(self, event):
+        await self.channel_layer.group_send(self.group_name, pre_encode(event))
+
+    async def websocket_disconnect(self, message):
+        if self.coalescer is not None:
+            await self.coalescer.close()
+        await super().websocket_disconnect(message)
+
+    async def receive_json(self, data):
         message_type = data.pop("type")
+        if message_type == "batch":
+            return await self.receive_batch(data.get("operations"))
+
         try:
             if self.user.is_authenticated:
-                split = message_type.split(".")
-                if len(split) != 2:
-                    msg = "Format must by 'ENTITY.ACTION'"
-                    raise ReceiverError(msg)
-
-                entity, action = split
-                receiver = self.get_receiver(entity)
-
-                if not receiver:
-                    msg = f"No entity found with name {entity}"
-                    raise ReceiverError(msg)
-
-                if action not in self.allow_actions:
-                    msg = f"No action found with name {action}"
-                    raise ReceiverError(msg)
-
-                data = getattr(receiver, action)(data)
+                receiver, action = self.get_receiver_action(message_type)
+                data = await getattr(receiver, f"a{action}")(data)
                 data["type"] = message_type
-                async_to_sync(self.channel_layer.group_send)(
-                    self.group_name,
-                    data,
-                )
+                await self.broadcast(data)
 
+        except ConflictError as e:
+            await self.send_json(self.get_conflict_message(message_type, e))
         except ReceiverError as e:
             msg = f"Message type '{message_type}' cannot be processed: " + str(e)
-            self.send_json({"type": "error", "message": msg})
+            await self.send_json({"type": "error", "message": msg})
+
+    async def receive_batch(self, operations):
+        """Processes a list of `ENTITY.ACTION` operations in one transaction.
+
+        The operations are grouped by entity and action, so that each group is written
+        with one bulk query, and the results are broadcast as one `batch` event. Failed
+        operations are reported to the sender in one `error` message which lists the
+        error of each failed operation by its index.
+        """
+        if not self.user.is_authenticated:
+            return
+        if not isinstance(operations, list) or not operations:
+            await self.send_json(
+                {"type": "error", "message": "'batch' requires a list of operations"}
+            )
+            return
+
+        event, error, conflicts = await database_sync_to_async(self.process_batch)(operations)
+        if event:
+            await self.broadcast(event)
+        for message in conflicts:
+            await self.send_json(message)
+        if error:
+            await self.send_json(error)
 
 
 class TaskReceiver(GenericReceiver):
     serializer_class = TaskSerializer
+    partial_update_fields = ("name",)
 
     def get_queryset(self):
+        return Task.objects.accessible_by(self.user)
+
+    def get_delete_queryset(self):
+        # Members may rename a task, but only its owner may delete it
         return Task.objects.filter(user=self.user)
 
-    def create(self, data):
+    def get_create_data(self, data):
         data["user"] = self.user
-        return super().create(data)
+        return data
 
-    def update(self, data):
-        data["user"] = self.user
-        return super().update(data)
+    def get_update_data(self, instance, data):
+        data["user"] = instance.user
+        return data
 
 
 class ItemReceiver(GenericReceiver):
     serializer_class = ItemSerializer
+    partial_update_fields = ("done_at",)
 
-    def get_queryset(self):
-        return Item.objects.filter(task__user=self.user)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.task_ids = None
 
-    def create(self, data):
+    def get_queryset(self):
+        return Item.objects.filter(task__in=Task.objects.accessible_by(self.user))
+
+    def get_task_ids(self, refresh=False):
+        """Returns the ids of the tasks which the user owns or is a member of, which are
+        cached per connection."""
+        if self.task_ids is None or refresh:
+            self.task_ids = set(
+                Task.objects.accessible_by(self.user).values_list("pk", flat=True)
+            )
+        return self.task_ids
+
+    def has_task(self, task_id):
+        """Returns whether the user may access the task, refreshing the cached ids if
+        the task is not among them."""
+        return task_id in self.get_task_ids() or task_id in self.get_task_ids(refresh=True)
+
+    def get_partial_object(self, pk):
+        # Looks the item up by its primary key and checks the owner against the cached
+        # task ids instead of joining the task table
+        try:
+            instance = Item.objects.get(pk=pk)
+        except Item.DoesNotExist:
+            raise ReceiverError(f"No object found with id {pk}")
+        if not self.has_task(instance.task_id):
+            raise ReceiverError(f"No object found with id {pk}")
+        return instance
+
+    def validate(self, data, instance=None):
+        # Items may only be created in tasks which the user owns or is a member of
+        serializer = super().validate(data, instance=instance)
+        task = serializer.validated_data.get("task")
+        if task is not None and not self.has_task(task.pk):
+            raise ReceiverError(f"No task found with id {task.pk}")
+        return serializer
+
+    def get_update_queryset(self):
+        return Item.objects.filter(task_id__in=self.get_task_ids())
+
+    def get_deleted_data(self, instance):
+        # The task of the event selects the group which it is broadcast to
+        return {"task": instance.task_id}
+
+    def get_partial_update_changes(self, instance, changes):
+        changes["done_by"] = self.user if changes.get("done_at") else None
+        return changes
+
+    def get_create_data(self, data):
         data["done_by"] = self.user
-        return super().create(data)
+        return data
 
-    def perform_update(self, instance, data):
-        data["task"] = instance.task.pk
+    def get_update_data(self, instance, data):
+        data["task"] = instance.task_id
         data["name"] = instance.name
-        data["done_by"] = self.user.username if instance.done_at else None
-        return super().perform_update(instance, data)
+        data["done_by"] = self.user.username if data.get("done_at") else None
+        return data
+
+
+class MembershipReceiver(GenericReceiver):
+    """Shares a task with another user. The owner of a task may add and remove members
+    and a member may leave a task. Memberships are not changed by batches."""
+
+    serializer_class = TaskMembershipSerializer
+
+    def get_queryset(self):
+        return TaskMembership.objects.filter(Q(task__user=self.user) | Q(user=self.user))
+
+    @timed(database_seconds, "checklist.create")
+    def create(self, data):
+        serializer = self.validate(data)
+        task, user = serializer.validated_data["task"], serializer.validated_data["user"]
+        if task.user_id != self.user.pk:
+            raise ReceiverError(f"No object found with id {task.pk}")
+        if user.pk == task.user_id:
+            raise ReceiverError("The owner of a task cannot be a member")
+        serializer.save()
+        # The id of the member selects the group which the event is sent to
+        return {**serializer.data, "user_id": user.pk}
+
+    def update(self, data):
+        raise ReceiverError("Memberships cannot be updated")
+
+    def get_deleted_data(self, instance):
+        return {"task": instance.task_id, "user_id": instance.user_id}
+
+    def bulk(self, action, data_list):
+        return [ReceiverError("Memberships cannot be changed in a batch") for _ in data_list]
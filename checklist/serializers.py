@@ -1,7 +1,7 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
 
-from checklist.models import Item, Task
+from checklist.models import Item, Task, TaskMembership
 
 
 class ItemSerializer(serializers.ModelSerializer):
@@ -11,7 +11,8 @@ class ItemSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Item
-        fields = ["id", "done_at", "done_by", "name", "task"]
+        fields = ["id", "done_at", "done_by", "name", "task", "revision"]
+        read_only_fields = ["revision"]
 
 
 class TaskSerializer(serializers.ModelSerializer):
@@ -22,4 +23,22 @@ class TaskSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Task
-        fields = ["id", "item_set", "name", "user"]
+        fields = ["id", "item_set", "name", "user", "revision"]
+        read_only_fields = ["revision"]
+
+
+class TaskChangeSerializer(TaskSerializer):
+    """Serializes a task without its items, which are synced separately."""
+    item_set = None
+
+    class Meta(TaskSerializer.Meta):
+        fields = ["id", "name", "user", "revision"]
+
+
+class TaskMembershipSerializer(serializers.ModelSerializer):
+    user = serializers.SlugRelatedField(slug_field="username", queryset=User.objects.all())
+
+    class Meta:
+        model = TaskMembership
+        fields = ["id", "task", "user", "revision"]
+        read_only_fields = ["revision"]
@@ -0,0 +1,155 @@
+import functools
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from checklist.cache import task_trees
+from checklist.models import Item, Revision, Task, TaskMembership, Tombstone
+from checklist.serializers import ItemSerializer
+
+
+@receiver(pre_save, sender=Task)
+@receiver(pre_save, sender=Item)
+@receiver(pre_save, sender=TaskMembership)
+def set_revision(sender, instance, using=None, **kwargs):
+    instance.revision = Revision.next(using=using)
+
+
+def get_task_users(task_id):
+    """Returns the ids of the owner and the members of a task with one query."""
+    rows = Task.objects.filter(pk=task_id).values_list("user_id", "memberships__user_id")
+    users = []
+    for owner, member in rows:
+        if not users:
+            users.append(owner)
+        if member is not None:
+            users.append(member)
+    return users
+
+
+def create_tombstones(user_ids, entity, object_id, revision):
+    Tombstone.objects.bulk_create(
+        Tombstone(user_id=user_id, entity=entity, object_id=object_id, revision=revision)
+        for user_id in user_ids
+    )
+
+
+@receiver(pre_delete, sender=Task)
+def collect_task_members(sender, instance, **kwargs):
+    # The memberships are deleted before the task, so the members are read beforehand
+    instance.member_ids = list(instance.memberships.values_list("user_id", flat=True))
+
+
+@receiver(post_delete, sender=Task)
+def create_task_tombstone(sender, instance, using=None, **kwargs):
+    instance.revision = Revision.next(using=using)
+    create_tombstones(
+        [instance.user_id, *getattr(instance, "member_ids", [])],
+        "task",
+        instance.pk,
+        instance.revision,
+    )
+
+
+@receiver(post_delete, sender=Item)
+def create_item_tombstone(sender, instance, origin=None, using=None, **kwargs):
+    # The items of a deleted task are covered by the tombstone of the task
+    if isinstance(origin, Task):
+        return
+
+    user_ids = get_task_users(instance.task_id)
+    if not user_ids:
+        return
+
+    instance.revision = Revision.next(using=using)
+    create_tombstones(user_ids, "item", instance.pk, instance.revision)
+
+
+@receiver(post_delete, sender=TaskMembership)
+def create_membership_tombstone(sender, instance, origin=None, using=None, **kwargs):
+    # A member whose membership ends syncs the task as deleted. Deleted tasks and users
+    # are covered by their own tombstones or need none.
+    if isinstance(origin, (Task, User)):
+        return
+    instance.revision = Revision.next(using=using)
+    create_tombstones([instance.user_id], "task", instance.task_id, instance.revision)
+
+
+# The task trees are updated once the transaction is committed. The receivers below are
+# connected after the tombstone receivers, which set the revision of a deletion.
+def get_tracked_users(task_id):
+    """Returns the users with a cached task tree which contains the task and, while trees
+    are loaded, the owner and members of the task whose tree is being loaded."""
+    user_ids = set(task_trees.users_of(task_id))
+    if task_trees.loading:
+        # The tasks of users which are being loaded are not known yet
+        user_ids.update(u for u in get_task_users(task_id) if task_trees.tracks(u))
+    return user_ids
+
+
+def apply_on_commit(user_ids, event):
+    for user_id in user_ids:
+        transaction.on_commit(functools.partial(task_trees.apply, user_id, event))
+
+
+def invalidate_on_commit(user_ids):
+    for user_id in user_ids:
+        if task_trees.tracks(user_id):
+            transaction.on_commit(functools.partial(task_trees.invalidate, user_id))
+
+
+@receiver(post_save, sender=Task)
+def update_task_trees_task(sender, instance, created=False, update_fields=None, **kwargs):
+    if not created and (update_fields is None or "user" in update_fields):
+        # The owner may have changed, e.g. in the admin, so the trees are loaded again
+        invalidate_on_commit(get_tracked_users(instance.pk) | {instance.user_id})
+        return
+
+    event = {
+        "type": "task.update",
+        "id": instance.pk,
+        "name": instance.name,
+        "revision": instance.revision,
+    }
+    if Task.user.is_cached(instance):
+        event["user"] = instance.user.username
+    if created:
+        user_ids = {instance.user_id} if task_trees.tracks(instance.user_id) else set()
+    else:
+        user_ids = get_tracked_users(instance.pk)
+    apply_on_commit(user_ids, event)
+
+
+@receiver(post_save, sender=Item)
+def update_task_trees_item(sender, instance, **kwargs):
+    user_ids = get_tracked_users(instance.task_id)
+    if user_ids:
+        apply_on_commit(user_ids, {**ItemSerializer(instance).data, "type": "item.update"})
+
+
+@receiver(post_delete, sender=Task)
+def delete_task_trees_task(sender, instance, **kwargs):
+    user_ids = set(task_trees.users_of(instance.pk))
+    user_ids.update(
+        u for u in [instance.user_id, *getattr(instance, "member_ids", [])]
+        if task_trees.tracks(u)
+    )
+    event = {"type": "task.delete", "id": instance.pk, "revision": instance.revision}
+    apply_on_commit(user_ids, event)
+
+
+@receiver(post_delete, sender=Item)
+def delete_task_trees_item(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, Task):
+        return
+    user_ids = get_tracked_users(instance.task_id)
+    event = {"type": "item.delete", "id": instance.pk, "revision": instance.revision}
+    apply_on_commit(user_ids, event)
+
+
+@receiver(post_save, sender=TaskMembership)
+@receiver(post_delete, sender=TaskMembership)
+def invalidate_member_task_tree(sender, instance, **kwargs):
+    invalidate_on_commit([instance.user_id])
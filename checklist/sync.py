@@ -0,0 +1,79 @@
+from django.db.models import Q
+
+from checklist.cache import task_trees
+from checklist.models import Item, Revision, Task, TaskMembership, Tombstone
+from checklist.serializers import ItemSerializer, TaskChangeSerializer, TaskSerializer
+from core.metrics import database_seconds, timed
+
+
+def get_task_list(user):
+    """Returns the `task.list` message with the full task tree of `user`, which is served
+    from `checklist.cache.task_trees` if the user is cached."""
+    message = task_trees.get(user.pk)
+    if message is None:
+        message = task_trees.load(user, lambda: load_task_list(user))
+    return message
+
+
+@timed(database_seconds, "checklist.task_list")
+def load_task_list(user):
+    """Reads the `task.list` message of `user` from the database."""
+    # The revision is read first, so that changes which happen while the tasks are
+    # loaded are sent again by the next sync rather than getting lost.
+    revision = Revision.current()
+    queryset = Task.objects.accessible_by(user).with_items().order_by("id")
+    return {
+        "type": "task.list",
+        "revision": revision,
+        "tasks": TaskSerializer(queryset, many=True).data,
+    }
+
+
+def get_task_ids(user):
+    """Returns the ids of the tasks which `user` owns or is a member of."""
+    return list(Task.objects.accessible_by(user).values_list("pk", flat=True))
+
+
+def load_task(task_id):
+    """Returns the serialized task with its items or `None` if it does not exist."""
+    task = Task.objects.filter(pk=task_id).with_items().first()
+    return None if task is None else TaskSerializer(task).data
+
+
+def get_item_task(item_id):
+    """Returns the id of the task of an item or `None` if it does not exist."""
+    return Item.objects.filter(pk=item_id).values_list("task_id", flat=True).first()
+
+
+@timed(database_seconds, "checklist.sync")
+def get_changes(user, since):
+    """Returns the `sync` message with the tasks and items of `user` which were created
+    or updated after the revision `since` and the ids of the ones deleted after it.
+
+    Tasks which were shared with `user` after `since` are sent with all their items and
+    tasks which were unshared have a tombstone of the member.
+    """
+    revision = Revision.current()
+    accessible = Task.objects.accessible_by(user)
+    shared = TaskMembership.objects.filter(user=user, revision__gt=since).values("task")
+    tasks = accessible.filter(Q(revision__gt=since) | Q(pk__in=shared)).select_related("user")
+    items = Item.objects.filter(
+        Q(revision__gt=since) | Q(task__in=shared), task__in=accessible
+    ).select_related("done_by")
+    tombstones = Tombstone.objects.filter(user=user, revision__gt=since)
+
+    tasks = TaskChangeSerializer(tasks, many=True).data
+    # A task which was unshared and shared again is not deleted
+    task_ids = {task["id"] for task in tasks}
+    deleted = {"task": [], "item": []}
+    for entity, object_id in tombstones.values_list("entity", "object_id"):
+        if entity != "task" or object_id not in task_ids:
+            deleted[entity].append(object_id)
+
+    return {
+        "type": "sync",
+        "revision": revision,
+        "tasks": tasks,
+        "items": ItemSerializer(items, many=True).data,
+        "deleted": deleted,
+    }
@@ -1,10 +1,28 @@
+import asyncio
 from asyncio.exceptions import TimeoutError
-from asgiref.sync import sync_to_async
+from unittest import mock
+import zlib
+
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError
 from django.test import TransactionTestCase
 
-from checklist.models import Task, Item
+from checklist.cache import TaskTrees, task_trees
+from checklist.consumers import ChecklistConsumer
+from checklist.models import Task, TaskMembership, Item, Revision, Tombstone
+from checklist.receivers import (
+    ConflictError,
+    ItemReceiver,
+    MembershipReceiver,
+    ReceiverError,
+    TaskReceiver,
+)
+from checklist.serializers import TaskSerializer
+from checklist.sync import get_changes, get_task_list, load_task_list
 from core.asgi import application
 
 User = get_user_model()
@@ -12,6 +30,7 @@ User = get_user_model()
 
 class ChecklistConsumerTestCase(TransactionTestCase):
     def setUp(self):
+        task_trees.clear()
         self.user = User.objects.create_user(username="user1", password="password")
         self.task = Task.objects.create(
             name="Test Task",
@@ -45,3 +64,834 @@ class ChecklistConsumerTestCase(TransactionTestCase):
         with self.assertRaises(TimeoutError):
             await communicator.receive_json_from()
         await communicator.disconnect()
+
+    async def test_actions(self):
+        communicator = WebsocketCommunicator(application, "/ws/checklist/")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"type": "item.create", "task": self.task.pk, "name": "Item 2"})
+        response = await communicator.receive_json_from()
+        self.assertEqual((response["type"], response["name"]), ("item.create", "Item 2"))
+
+        done_at = "2024-01-01T00:00:00Z"
+        await communicator.send_json_to({"type": "item.update", "id": response["id"], "done_at": done_at})
+        response = await communicator.receive_json_from()
+        self.assertEqual((response["type"], response["done_at"]), ("item.update", done_at))
+
+        await communicator.send_json_to({"type": "item.delete", "id": response["id"]})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "item.delete")
+
+        await communicator.send_json_to({"type": "item.delete", "id": response["id"]})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "error")
+        await communicator.disconnect()
+
+    async def test_msgpack_zlib_subprotocol(self):
+        await sync_to_async(Item.objects.bulk_create)(
+            [Item(task=self.task, name=f"Item {i}") for i in range(50)]
+        )
+        communicator = WebsocketCommunicator(
+            application, "/ws/checklist/", subprotocols=["msgpack.zlib"]
+        )
+        communicator.scope["user"] = self.user
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual((connected, subprotocol), (True, "msgpack.zlib"))
+
+        # The snapshot is above the compression threshold
+        response = await communicator.receive_from()
+        self.assertEqual(response[:1], b"\x01")
+        response = msgpack.unpackb(zlib.decompress(response[1:]))
+        self.assertEqual(response["type"], "task.list")
+
+        await communicator.send_to(
+            bytes_data=b"\x00" + msgpack.packb({"type": "task.create", "name": "Task 2"})
+        )
+        response = await communicator.receive_from()
+        self.assertEqual(response[:1], b"\x00")
+        self.assertEqual(msgpack.unpackb(response[1:])["name"], "Task 2")
+        await communicator.disconnect()
+
+
+class TaskListSnapshotTestCase(TransactionTestCase):
+    def setUp(self):
+        task_trees.clear()
+        self.user = User.objects.create_user(username="user1", password="password")
+
+    def create_tasks(self, tasks, items):
+        for i in range(tasks):
+            task = Task.objects.create(name=f"Task {i}", user=self.user)
+            Item.objects.bulk_create(
+                [Item(task=task, name=f"Item {j}", done_by=self.user) for j in range(items)]
+            )
+
+    def test_snapshot_query_count_is_constant(self):
+        for tasks, items in [(1, 1), (5, 3), (20, 10)]:
+            Task.objects.all().delete()
+            self.create_tasks(tasks, items)
+
+            with self.assertNumQueries(2):
+                data = TaskSerializer(
+                    Task.objects.filter(user=self.user).with_items(), many=True
+                ).data
+            self.assertEqual(len(data), tasks)
+            self.assertEqual(sum(len(task["item_set"]) for task in data), tasks * items)
+            self.assertEqual(data[0]["item_set"][0]["done_by"], "user1")
+
+    def test_connect_query_count(self):
+        self.create_tasks(10, 5)
+
+        async def connect():
+            communicator = WebsocketCommunicator(application, "/ws/checklist/")
+            communicator.scope["user"] = self.user
+            await communicator.connect()
+            response = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return response
+
+        # The ids of the task groups, the current revision and the task tree
+        with self.assertNumQueries(4):
+            response = async_to_sync(connect)()
+        self.assertEqual(len(response["tasks"]), 10)
+
+        # The task tree is cached afterwards
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(connect)(), response)
+
+
+class SyncTestCase(TransactionTestCase):
+    def setUp(self):
+        task_trees.clear()
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.other_user = User.objects.create_user(username="user2", password="password")
+        self.task = Task.objects.create(name="Task", user=self.user)
+        self.item1 = Item.objects.create(task=self.task, name="Item 1")
+        self.item2 = Item.objects.create(task=self.task, name="Item 2")
+        self.revision = Revision.current()
+
+    def test_revisions_increase(self):
+        self.assertEqual(self.item2.revision, self.revision)
+        self.task.save()
+        self.assertGreater(self.task.revision, self.revision)
+        self.item1.save()
+        self.assertGreater(self.item1.revision, self.task.revision)
+
+    def test_changes_since(self):
+        self.item1.name = "Item 1 updated"
+        self.item1.save()
+        item2_id = self.item2.pk
+        self.item2.delete()
+        new_task = Task.objects.create(name="New Task", user=self.user)
+        Task.objects.create(name="Other Task", user=self.other_user)
+
+        changes = get_changes(self.user, self.revision)
+        self.assertEqual(changes["type"], "sync")
+        self.assertEqual(changes["revision"], Revision.current())
+        self.assertEqual([task["id"] for task in changes["tasks"]], [new_task.pk])
+        self.assertEqual([item["name"] for item in changes["items"]], ["Item 1 updated"])
+        self.assertEqual(changes["deleted"], {"task": [], "item": [item2_id]})
+
+        changes = get_changes(self.user, changes["revision"])
+        self.assertEqual((changes["tasks"], changes["items"]), ([], []))
+        self.assertEqual(changes["deleted"], {"task": [], "item": []})
+
+    def test_revision_is_taken_in_transaction_of_write(self):
+        # A failed write rolls its revision back, so no later revision commits before it
+        with self.assertRaises(IntegrityError):
+            Item.objects.create(task_id=12345, name="Invalid")
+        self.assertEqual(Revision.current(), self.revision)
+
+    def test_deleted_task_has_single_tombstone(self):
+        task_id = self.task.pk
+        self.task.delete()
+        self.assertEqual(
+            list(Tombstone.objects.values_list("entity", "object_id")), [("task", task_id)]
+        )
+
+    async def test_connect_with_since(self):
+        await sync_to_async(Item.objects.filter(pk=self.item1.pk).delete)()
+        communicator = WebsocketCommunicator(application, f"/ws/checklist/?since={self.revision}")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "sync")
+        self.assertEqual(response["deleted"]["item"], [self.item1.pk])
+
+        await communicator.send_json_to({"type": "sync.since", "revision": response["revision"]})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "sync")
+        self.assertEqual(response["deleted"]["item"], [])
+
+        await communicator.send_json_to({"type": "sync.since"})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "error")
+        await communicator.disconnect()
+
+
+class PartialUpdateTestCase(TransactionTestCase):
+    def setUp(self):
+        task_trees.clear()
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.other_user = User.objects.create_user(username="user2", password="password")
+        self.task = Task.objects.create(name="Task", user=self.user)
+        self.item = Item.objects.create(task=self.task, name="Item")
+        self.receiver = ItemReceiver(user=self.user)
+        self.receiver.get_task_ids()
+
+    def test_partial_update(self):
+        done_at = "2024-01-01T00:00:00Z"
+        # Item lookup, then the revision and the item update in one transaction, whose
+        # BEGIN and COMMIT are queries on SQLite
+        with self.assertNumQueries(5):
+            data = self.receiver.update({"id": self.item.pk, "done_at": done_at})
+        self.assertEqual(data["done_at"], done_at)
+        self.assertEqual(data["done_by"], "user1")
+        self.assertEqual(data["revision"], Revision.current())
+
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.done_by, self.user)
+        self.assertEqual(self.item.revision, Revision.current())
+
+        self.receiver.update({"id": self.item.pk, "done_at": None})
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.done_at, self.item.done_by), (None, None))
+
+    def test_partial_update_validates_fields(self):
+        with self.assertRaises(ReceiverError):
+            self.receiver.update({"id": self.item.pk, "done_at": "yesterday"})
+
+    def test_partial_update_of_other_user(self):
+        task = Task.objects.create(name="Other Task", user=self.other_user)
+        item = Item.objects.create(task=task, name="Other Item")
+        with self.assertRaises(ReceiverError):
+            self.receiver.update({"id": item.pk, "done_at": None})
+
+    def test_conditional_update(self):
+        done_at = "2024-01-01T00:00:00Z"
+        # Revision update and item update in one transaction without reading the item
+        with self.assertNumQueries(4):
+            data = self.receiver.update(
+                {"id": self.item.pk, "done_at": done_at, "revision": self.item.revision}
+            )
+        self.assertEqual(
+            data,
+            {
+                "id": self.item.pk,
+                "done_at": done_at,
+                "done_by": "user1",
+                "revision": Revision.current(),
+            },
+        )
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.done_by, self.item.revision), (self.user, data["revision"]))
+
+    def test_conditional_update_conflict(self):
+        revision = self.item.revision
+        self.receiver.update({"id": self.item.pk, "done_at": None, "revision": revision})
+
+        with self.assertRaises(ConflictError) as context:
+            self.receiver.update(
+                {"id": self.item.pk, "done_at": "2024-01-01T00:00:00Z", "revision": revision}
+            )
+        self.item.refresh_from_db()
+        self.assertEqual(context.exception.data["revision"], self.item.revision)
+        self.assertIsNone(self.item.done_at)
+
+        # A missing object is not a conflict
+        with self.assertRaisesMessage(ReceiverError, "No object found"):
+            self.receiver.update({"id": 12345, "done_at": None, "revision": revision})
+        with self.assertRaises(ReceiverError):
+            self.receiver.update({"id": self.item.pk, "done_at": None, "revision": "1"})
+
+    async def test_conflict_reply(self):
+        communicators = []
+        for _ in range(2):
+            communicator = WebsocketCommunicator(application, "/ws/checklist/")
+            communicator.scope["user"] = self.user
+            await communicator.connect()
+            await communicator.receive_json_from()
+            communicators.append(communicator)
+
+        # Both clients toggle the item they have seen at the same revision
+        for communicator in communicators:
+            await communicator.send_json_to({
+                "type": "item.update",
+                "id": self.item.pk,
+                "done_at": "2024-01-01T00:00:00Z",
+                "revision": self.item.revision,
+            })
+            await asyncio.sleep(0.1)
+
+        first, second = communicators
+        response = await first.receive_json_from()
+        self.assertEqual(response["type"], "item.update")
+        self.assertEqual(await second.receive_json_from(), response)
+        conflict = await second.receive_json_from()
+        self.assertEqual(conflict["type"], "item.conflict")
+        self.assertEqual(
+            (conflict["revision"], conflict["name"]), (response["revision"], "Item")
+        )
+        self.assertTrue(await first.receive_nothing())
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    def test_partial_update_of_new_task(self):
+        task = Task.objects.create(name="New Task", user=self.user)
+        item = Item.objects.create(task=task, name="New Item")
+        data = self.receiver.update({"id": item.pk, "done_at": None})
+        self.assertEqual(data["id"], item.pk)
+
+        item = Item.objects.create(task=Task.objects.create(name="Task", user=self.user))
+        data = self.receiver.update({"id": item.pk, "done_at": None, "revision": item.revision})
+        self.assertEqual(data["id"], item.pk)
+
+
+class BatchTestCase(TransactionTestCase):
+    def setUp(self):
+        task_trees.clear()
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.task = Task.objects.create(name="Task", user=self.user)
+        self.items = Item.objects.bulk_create(
+            [Item(task=self.task, name=f"Item {i}") for i in range(5)]
+        )
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(application, "/ws/checklist/")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        return communicator
+
+    async def test_batch(self):
+        communicator = await self.connect()
+        done_at = "2024-01-01T00:00:00Z"
+        revision = await sync_to_async(Revision.current)()
+        await communicator.send_json_to({
+            "type": "batch",
+            "operations": [
+                *({"type": "item.update", "id": item.pk, "done_at": done_at} for item in self.items[:3]),
+                {"type": "item.create", "task": self.task.pk, "name": "New Item"},
+                {"type": "item.delete", "id": self.items[4].pk},
+                {"type": "item.delete", "id": 12345},
+                {"type": "unknown"},
+            ],
+        })
+
+        # The errors are sent directly to the sender and may arrive before the broadcast
+        responses = {}
+        for _ in range(2):
+            response = await communicator.receive_json_from()
+            responses[response["type"]] = response
+
+        response = responses["batch"]
+        self.assertEqual(
+            [event["type"] for event in response["events"]],
+            ["item.update"] * 3 + ["item.create", "item.delete"],
+        )
+        self.assertEqual(response["events"][0]["done_at"], done_at)
+        self.assertGreater(response["events"][0]["revision"], revision)
+        self.assertEqual(response["revision"], await sync_to_async(Revision.current)())
+
+        response = responses["error"]
+        self.assertEqual([error["index"] for error in response["errors"]], [5, 6])
+
+        with self.assertRaises(TimeoutError):
+            await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        done = await sync_to_async(Item.objects.filter(done_at__isnull=False).count)()
+        self.assertEqual(done, 3)
+        names = await sync_to_async(list)(Item.objects.order_by("id").values_list("name", flat=True))
+        self.assertEqual(names, ["Item 0", "Item 1", "Item 2", "Item 3", "New Item"])
+        tombstones = await sync_to_async(Tombstone.objects.count)()
+        self.assertEqual(tombstones, 1)
+        # The deletion carries the revision of its tombstone, like a single `item.delete`
+        tombstone = await Tombstone.objects.aget()
+        self.assertEqual(responses["batch"]["events"][4]["revision"], tombstone.revision)
+
+    async def test_batch_conflict(self):
+        communicator = await self.connect()
+        item = self.items[0]
+        await sync_to_async(Item.objects.filter(pk=item.pk).update)(
+            name="Renamed", revision=10**6
+        )
+        await communicator.send_json_to({
+            "type": "batch",
+            "operations": [
+                {"type": "item.update", "id": item.pk, "done_at": None, "revision": item.revision},
+                {"type": "item.update", "id": self.items[1].pk, "done_at": None},
+            ],
+        })
+
+        responses = {}
+        for _ in range(3):
+            response = await communicator.receive_json_from()
+            responses[response["type"]] = response
+        self.assertEqual(len(responses["batch"]["events"]), 1)
+        self.assertEqual([error["index"] for error in responses["error"]["errors"]], [0])
+        # The sender receives the current state of the item like for a single update
+        conflict = responses["item.conflict"]
+        self.assertEqual((conflict["name"], conflict["revision"]), ("Renamed", 10**6))
+        await communicator.disconnect()
+
+    async def test_invalid_batch(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({"type": "batch", "operations": []})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "error")
+        await communicator.disconnect()
+
+
+class TaskTreeCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        task_trees.clear()
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.other_user = User.objects.create_user(username="user2", password="password")
+        self.task = Task.objects.create(name="Task", user=self.user)
+        self.items = [Item.objects.create(task=self.task, name=f"Item {i}") for i in range(3)]
+
+    def assertCacheConsistent(self, user, hit=True):
+        hits = task_trees.stats["hits"]
+        cached = get_task_list(user)
+        self.assertEqual(task_trees.stats["hits"], hits + hit)
+        self.assertEqual(cached["tasks"], load_task_list(user)["tasks"])
+
+    async def send(self, communicator, messages):
+        for message in messages:
+            await communicator.send_json_to(message)
+            await communicator.receive_json_from()
+
+    def test_served_without_queries(self):
+        message = get_task_list(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_task_list(self.user), message)
+        self.assertEqual(message["tasks"], load_task_list(self.user)["tasks"])
+
+    def test_consistent_with_consumer_actions(self):
+        done_at = "2024-01-01T00:00:00Z"
+
+        async def run():
+            communicator = WebsocketCommunicator(application, "/ws/checklist/")
+            communicator.scope["user"] = self.user
+            await communicator.connect()
+            await communicator.receive_json_from()
+            await self.send(communicator, [
+                {"type": "task.create", "name": "New Task"},
+                {"type": "task.update", "id": self.task.pk, "name": "Renamed"},
+                {"type": "item.create", "task": self.task.pk, "name": "New Item"},
+                {"type": "item.update", "id": self.items[0].pk, "done_at": done_at},
+                {"type": "item.update", "id": self.items[1].pk, "done_at": done_at, "name": "x"},
+                {"type": "item.delete", "id": self.items[2].pk},
+                {"type": "batch", "operations": [
+                    {"type": "item.create", "task": self.task.pk, "name": "Batch Item"},
+                    {"type": "item.update", "id": self.items[0].pk, "done_at": None},
+                    {"type": "item.delete", "id": self.items[1].pk},
+                ]},
+            ])
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+        self.assertCacheConsistent(self.user)
+
+    def test_consistent_with_conditional_updates(self):
+        get_task_list(self.user)
+        receiver = ItemReceiver(user=self.user)
+        data = receiver.update(
+            {"id": self.items[0].pk, "done_at": None, "revision": self.items[0].revision}
+        )
+        task_trees.apply(self.user.pk, {**data, "type": "item.update"})
+        self.assertCacheConsistent(self.user)
+
+        # An update of an item which the tree misses drops the tree
+        task_trees.apply(self.user.pk, {"type": "item.update", "id": 12345, "revision": 10**6})
+        self.assertIsNone(task_trees.get(self.user.pk))
+
+    def test_consistent_with_model_signals(self):
+        get_task_list(self.user)
+        get_task_list(self.other_user)
+
+        # Changes outside the consumers, e.g. in the admin
+        task = Task.objects.create(name="Admin Task", user=self.user)
+        Item.objects.create(task=task, name="Admin Item")
+        self.items[0].name = "Renamed"
+        self.items[0].save()
+        self.items[1].delete()
+        task.delete()
+        self.assertCacheConsistent(self.user)
+
+        # The trees of both users are loaded again when the task moves
+        self.task.user = self.other_user
+        self.task.save()
+        self.assertCacheConsistent(self.user, hit=False)
+        self.assertCacheConsistent(self.other_user, hit=False)
+
+    def test_changes_during_load(self):
+        def loader():
+            message = load_task_list(self.user)
+            # Committed after the tasks were read, but before the tree is cached
+            Item.objects.filter(pk=self.items[0].pk).get().delete()
+            Task.objects.create(name="Late Task", user=self.user)
+            return message
+
+        task_trees.load(self.user, loader)
+        self.assertCacheConsistent(self.user)
+
+    def test_lru_eviction(self):
+        users = [self.user, self.other_user, User.objects.create_user(username="user3")]
+        cache = TaskTrees(max_users=2, max_objects=5)
+        for user in users:
+            cache.load(user, lambda: load_task_list(user))
+        self.assertIsNone(cache.get(self.user.pk))
+        self.assertIsNotNone(cache.get(self.other_user.pk))
+
+        # The task and three items of the first user
+        cache.load(self.user, lambda: load_task_list(self.user))
+        self.assertEqual(list(cache.trees), [self.other_user.pk, self.user.pk])
+        self.assertEqual(cache.get_stats()["objects"], 4)
+
+        # Growing beyond `max_objects` evicts the least recently used users first
+        for pk in [100, 101]:
+            event = {"type": "item.create", "id": pk, "task": self.task.pk, "revision": 10**6}
+            event.update(name="Item", done_at=None, done_by=None)
+            cache.apply(self.user.pk, event)
+        self.assertEqual(
+            cache.get_stats(),
+            {"hits": 1, "misses": 1, "evictions": 4, "users": 0, "objects": 0},
+        )
+
+    def test_deletion_markers_are_pruned(self):
+        cache = TaskTrees()
+        cache.load(self.user, lambda: load_task_list(self.user))
+        tree = cache.trees[self.user.pk]
+        tree.min_deleted = 5
+        for pk in range(100, 150):
+            event = {"type": "item.create", "id": pk, "task": self.task.pk, "revision": pk}
+            event.update(name="Item", done_at=None, done_by=None)
+            cache.apply(self.user.pk, event)
+            cache.apply(self.user.pk, {"type": "item.delete", "id": pk, "revision": pk})
+
+        # The markers are counted and pruned instead of growing with every deletion
+        self.assertLessEqual(len(tree.deleted), 5)
+        self.assertEqual(cache.get_stats()["objects"], tree.size)
+        self.assertEqual(tree.size, 4 + len(tree.deleted))
+
+        # A new item above the floor is added, while a late event at or below the floor
+        # may belong to a pruned deletion and drops the tree
+        fields = {"type": "item.create", "task": self.task.pk, "name": "Item", "done_at": None, "done_by": None}
+        cache.apply(self.user.pk, {**fields, "id": 200, "revision": 200})
+        self.assertEqual(len(cache.get(self.user.pk)["tasks"][0]["item_set"]), 4)
+        cache.apply(self.user.pk, {**fields, "id": 100, "revision": 100})
+        self.assertIsNone(cache.get(self.user.pk))
+
+    def test_users_of_task(self):
+        cache = TaskTrees()
+        for user in [self.user, self.other_user]:
+            cache.load(user, lambda: load_task_list(user))
+        self.assertEqual(cache.users_of(self.task.pk), [self.user.pk])
+
+        event = {"type": "task.create", "id": 100, "name": "Task", "revision": 10**6}
+        cache.apply(self.other_user.pk, {**event, "user": "user2"})
+        self.assertEqual(cache.users_of(100), [self.other_user.pk])
+        cache.apply(self.other_user.pk, {"type": "task.delete", "id": 100, "revision": 10**6 + 1})
+        self.assertEqual(cache.users_of(100), [])
+
+        cache.invalidate(self.user.pk)
+        self.assertEqual(cache.users_of(self.task.pk), [])
+        self.assertEqual(cache.task_users, {})
+
+    def test_expiry_without_sockets(self):
+        cache = TaskTrees(timeout=0)
+        cache.load(self.user, lambda: load_task_list(self.user))
+        self.assertIsNone(cache.get(self.user.pk))
+
+        cache.subscribe(self.user.pk)
+        cache.load(self.user, lambda: load_task_list(self.user))
+        self.assertIsNotNone(cache.get(self.user.pk))
+        cache.unsubscribe(self.user.pk)
+        self.assertIsNone(cache.get(self.user.pk))
+
+    def test_task_list_view(self):
+        response = self.client.get("/checklist/tasks/")
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.user)
+        response = self.client.get("/checklist/tasks/")
+        self.assertEqual(response.json()["tasks"], load_task_list(self.user)["tasks"])
+        self.assertEqual(task_trees.get_stats()["users"], 1)
+
+
+class CoalescingTestCase(TransactionTestCase):
+    def setUp(self):
+        task_trees.clear()
+        self.user = User.objects.create_user(username="user1", password="password")
+        self.task = Task.objects.create(name="Task", user=self.user)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(application, "/ws/checklist/")
+        communicator.scope["user"] = self.user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        return communicator
+
+    async def receive_all(self, communicator):
+        responses = []
+        while not await communicator.receive_nothing(0.3):
+            responses.append(await communicator.receive_json_from())
+        return responses
+
+    async def rename(self, communicator, count):
+        for i in range(count):
+            await communicator.send_json_to(
+                {"type": "task.update", "id": self.task.pk, "name": f"Name {i}"}
+            )
+
+    async def test_updates_are_coalesced(self):
+        sender, other = await self.connect(), await self.connect()
+        await self.rename(sender, 5)
+
+        # The first update is sent at once and the final state when the window ends
+        responses = await self.receive_all(other)
+        self.assertEqual([r["name"] for r in responses], ["Name 0", "Name 4"])
+        self.assertEqual(await self.receive_all(sender), responses)
+        await sender.disconnect()
+        await other.disconnect()
+
+    async def test_delete_is_sent_after_pending_updates(self):
+        sender, other = await self.connect(), await self.connect()
+        await self.rename(sender, 3)
+        await sender.send_json_to({"type": "task.delete", "id": self.task.pk})
+
+        responses = [await other.receive_json_from() for _ in range(3)]
+        self.assertEqual(
+            [(r["type"], r.get("name")) for r in responses],
+            [("task.update", "Name 0"), ("task.update", "Name 2"), ("task.delete", None)],
+        )
+        self.assertTrue(await other.receive_nothing(0.3))
+        await sender.disconnect()
+        await other.disconnect()
+
+    async def test_pending_updates_are_sent_on_disconnect(self):
+        sender, other = await self.connect(), await self.connect()
+        await self.rename(sender, 3)
+        await other.receive_json_from()
+        await sender.disconnect()
+        self.assertEqual((await other.receive_json_from())["name"], "Name 2")
+        await other.disconnect()
+
+    async def test_failed_update_is_reported(self):
+        send_to_group = ChecklistConsumer.send_to_group
+
+        async def fail_last(consumer, event):
+            if event.get("name") == "Name 2":
+                raise ValueError("Group is unavailable")
+            await send_to_group(consumer, event)
+
+        with mock.patch.object(ChecklistConsumer, "send_to_group", fail_last):
+            sender = await self.connect()
+            with self.assertLogs("checklist.coalescing", "ERROR"):
+                await self.rename(sender, 3)
+                responses = await self.receive_all(sender)
+            await sender.disconnect()
+        self.assertEqual(
+            [(r["type"], r.get("name")) for r in responses],
+            [("task.update", "Name 0"), ("error", None)],
+        )
+        self.assertEqual(
+            responses[1]["message"],
+            "Message type 'task.update' cannot be broadcast: Group is unavailable",
+        )
+
+    async def test_disabled(self):
+        with mock.patch.object(ChecklistConsumer, "coalesce_window", None):
+            sender, other = await self.connect(), await self.connect()
+            await self.rename(sender, 3)
+            responses = await self.receive_all(other)
+            await sender.disconnect()
+            await other.disconnect()
+        self.assertEqual([r["name"] for r in responses], ["Name 0", "Name 1", "Name 2"])
+
+
+class SharingTestCase(TransactionTestCase):
+    def setUp(self):
+        task_trees.clear()
+        self.owner = User.objects.create_user(username="owner", password="password")
+        self.member = User.objects.create_user(username="member", password="password")
+        self.stranger = User.objects.create_user(username="stranger", password="password")
+        self.task = Task.objects.create(name="Task", user=self.owner)
+        self.item = Item.objects.create(task=self.task, name="Item")
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(application, "/ws/checklist/")
+        communicator.scope["user"] = user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        return communicator
+
+    async def test_events_reach_only_sharers(self):
+        owner, member, stranger = [
+            await self.connect(user) for user in (self.owner, self.member, self.stranger)
+        ]
+        await owner.send_json_to(
+            {"type": "member.create", "task": self.task.pk, "user": "member"}
+        )
+        response = await owner.receive_json_from()
+        self.assertEqual((response["type"], response["user"]), ("member.create", "member"))
+
+        # The member receives the shared task with its items
+        response = await member.receive_json_from()
+        self.assertEqual((response["type"], response["id"]), ("task.create", self.task.pk))
+        self.assertEqual([item["name"] for item in response["item_set"]], ["Item"])
+
+        await member.send_json_to(
+            {"type": "item.update", "id": self.item.pk, "done_at": "2024-01-01T00:00:00Z"}
+        )
+        response = await owner.receive_json_from()
+        self.assertEqual((response["type"], response["done_by"]), ("item.update", "member"))
+        self.assertEqual(await member.receive_json_from(), response)
+
+        # Members may rename, but not delete a task
+        await member.send_json_to({"type": "task.update", "id": self.task.pk, "name": "Shared"})
+        response = await owner.receive_json_from()
+        self.assertEqual((response["name"], response["user"]), ("Shared", "owner"))
+        await member.receive_json_from()
+        await member.send_json_to({"type": "task.delete", "id": self.task.pk})
+        self.assertEqual((await member.receive_json_from())["type"], "error")
+        self.assertTrue(await stranger.receive_nothing())
+
+        # After unsharing, the member no longer receives the events of the task
+        membership_id = await sync_to_async(TaskMembership.objects.values_list("pk").get)()
+        await owner.send_json_to({"type": "member.delete", "id": membership_id[0]})
+        self.assertEqual((await owner.receive_json_from())["type"], "member.delete")
+        response = await member.receive_json_from()
+        self.assertEqual((response["type"], response["id"]), ("task.delete", self.task.pk))
+        await owner.send_json_to({"type": "item.update", "id": self.item.pk, "done_at": None})
+        await owner.receive_json_from()
+        self.assertTrue(await member.receive_nothing())
+
+        await member.send_json_to({"type": "item.update", "id": self.item.pk, "done_at": None})
+        self.assertEqual((await member.receive_json_from())["type"], "error")
+        for communicator in (owner, member, stranger):
+            await communicator.disconnect()
+
+    async def test_connect_joins_shared_tasks(self):
+        await sync_to_async(TaskMembership.objects.create)(task=self.task, user=self.member)
+        member = await self.connect(self.member)
+        owner = await self.connect(self.owner)
+
+        await owner.send_json_to({"type": "item.create", "task": self.task.pk, "name": "New"})
+        response = await owner.receive_json_from()
+        self.assertEqual(await member.receive_json_from(), response)
+
+        # A conditional update only contains the changed fields
+        await owner.send_json_to({
+            "type": "item.update",
+            "id": response["id"],
+            "done_at": None,
+            "revision": response["revision"],
+        })
+        response = await owner.receive_json_from()
+        self.assertEqual(await member.receive_json_from(), response)
+        for communicator in (owner, member):
+            await communicator.disconnect()
+
+    async def test_task_groups_are_joined_concurrently(self):
+        for i in range(5):
+            await sync_to_async(Task.objects.create)(name=f"Task {i}", user=self.owner)
+        layer = get_channel_layer()
+        group_add = layer.group_add
+        in_flight = []
+        peak = 0
+
+        async def slow_group_add(group, channel):
+            nonlocal peak
+            in_flight.append(group)
+            peak = max(peak, len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(group)
+            await group_add(group, channel)
+
+        with mock.patch.object(layer, "group_add", slow_group_add):
+            communicator = await self.connect(self.owner)
+        # The user group and then the groups of the six tasks at once
+        self.assertEqual(peak, 6)
+        await communicator.disconnect()
+
+    def test_permissions(self):
+        receiver = MembershipReceiver(user=self.member)
+        with self.assertRaisesMessage(ReceiverError, "No object found"):
+            receiver.create({"task": self.task.pk, "user": "stranger"})
+        with self.assertRaisesMessage(ReceiverError, "cannot be a member"):
+            MembershipReceiver(user=self.owner).create({"task": self.task.pk, "user": "owner"})
+
+        data = MembershipReceiver(user=self.owner).create(
+            {"task": self.task.pk, "user": "member"}
+        )
+        self.assertEqual(data["user_id"], self.member.pk)
+        with self.assertRaises(ReceiverError):
+            MembershipReceiver(user=self.owner).create({"task": self.task.pk, "user": "member"})
+        with self.assertRaises(ReceiverError):
+            TaskReceiver(user=self.member).delete({"id": self.task.pk})
+        with self.assertRaises(ReceiverError):
+            TaskReceiver(user=self.stranger).update({"id": self.task.pk, "name": "x"})
+
+        # Strangers cannot add items to the task, neither one by one nor in a batch
+        receiver = ItemReceiver(user=self.stranger)
+        with self.assertRaisesMessage(ReceiverError, "No task found"):
+            receiver.create({"task": self.task.pk, "name": "Injected"})
+        results = receiver.bulk("create", [{"task": self.task.pk, "name": "Injected"}])
+        self.assertIsInstance(results[0], ReceiverError)
+        self.assertEqual(list(Item.objects.values_list("name", flat=True)), ["Item"])
+        ItemReceiver(user=self.member).create({"task": self.task.pk, "name": "Shared"})
+
+        # A member may leave a task
+        receiver = MembershipReceiver(user=self.member)
+        self.assertEqual(receiver.delete({"id": data["id"]})["task"], self.task.pk)
+        self.assertFalse(TaskMembership.objects.exists())
+
+    def test_task_list_and_cache_of_members(self):
+        self.assertEqual(get_task_list(self.member)["tasks"], [])
+        membership = TaskMembership.objects.create(task=self.task, user=self.member)
+
+        # Sharing drops the tree of the member, which is loaded again
+        self.assertIsNone(task_trees.get(self.member.pk))
+        self.assertEqual(get_task_list(self.member)["tasks"], get_task_list(self.owner)["tasks"])
+
+        # Changes of the shared task update the trees of the owner and the member
+        self.item.name = "Renamed"
+        self.item.save()
+        Item.objects.create(task=self.task, name="New")
+        self.task.name = "Renamed"
+        self.task.save(update_fields=["name", "revision"])
+        for user in (self.owner, self.member):
+            self.assertEqual(get_task_list(user)["tasks"], load_task_list(user)["tasks"])
+
+        membership.delete()
+        self.assertEqual(get_task_list(self.member)["tasks"], [])
+
+    def test_sync_of_members(self):
+        revision = Revision.current()
+        TaskMembership.objects.create(task=self.task, user=self.member)
+
+        # A shared task is sent with all its items
+        changes = get_changes(self.member, revision)
+        self.assertEqual([task["id"] for task in changes["tasks"]], [self.task.pk])
+        self.assertEqual([item["id"] for item in changes["items"]], [self.item.pk])
+
+        revision = changes["revision"]
+        TaskMembership.objects.get().delete()
+        changes = get_changes(self.member, revision)
+        self.assertEqual((changes["tasks"], changes["items"]), ([], []))
+        self.assertEqual(changes["deleted"], {"task": [self.task.pk], "item": []})
+
+        # Deletes of the task and its items leave tombstones for the members
+        TaskMembership.objects.create(task=self.task, user=self.member)
+        revision = Revision.current()
+        task_id, item_id = self.task.pk, self.item.pk
+        self.item.delete()
+        self.task.delete()
+        for user in (self.owner, self.member):
+            changes = get_changes(user, revision)
+            self.assertEqual(changes["deleted"], {"task": [task_id], "item": [item_id]})
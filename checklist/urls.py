@@ -4,4 +4,5 @@ from checklist import views
 
 urlpatterns = [
     path("", views.index_view, name="checklist-index"),
+    path("tasks/", views.task_list_view, name="checklist-tasks"),
 ]
@@ -1,5 +1,16 @@
+from django.http import JsonResponse
 from django.shortcuts import render
 
+from checklist.sync import get_task_list
+
 
 def index_view(request):
     return render(request, "checklist/index.html")
+
+
+def task_list_view(request):
+    """Returns the `task.list` message of the user, which is usually served from the
+    cache of task trees."""
+    if not request.user.is_authenticated:
+        return JsonResponse({"type": "error", "message": "Not logged in"}, status=403)
+    return JsonResponse(get_task_list(request.user))
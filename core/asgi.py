@@ -13,18 +13,20 @@ from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
-import chat.routing
-import checklist.routing
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+# Sets up Django before the consumers import models, so that the application can also
+# be served by a standalone ASGI server such as `daphne core.asgi:application`
+django_asgi_app = get_asgi_application()
 
+import chat.routing  # noqa: E402
+import checklist.routing  # noqa: E402
 
 websocket_urlpatterns = chat.routing.websocket_urlpatterns
 websocket_urlpatterns += checklist.routing.websocket_urlpatterns
 
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
+        "http": django_asgi_app,
         "websocket": AuthMiddlewareStack(
             URLRouter(websocket_urlpatterns)
         )
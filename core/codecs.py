@@ -0,0 +1,304 @@
+import asyncio
+import functools
+import json
+import logging
+import zlib
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class StdlibCodec:
+    """Encodes and decodes JSON frames with the `json` module of the standard library."""
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(",", ":"))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """Encodes and decodes JSON frames with `orjson`, which has to be installed."""
+
+    def __init__(self):
+        import orjson
+
+        self.orjson = orjson
+
+    def dumps(self, obj):
+        return self.orjson.dumps(obj).decode()
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+
+class MsgspecCodec:
+    """Encodes and decodes JSON frames with `msgspec`, which has to be installed."""
+
+    def __init__(self):
+        import msgspec
+
+        self.encoder = msgspec.json.Encoder()
+        self.decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj):
+        return self.encoder.encode(obj).decode()
+
+    def loads(self, data):
+        return self.decoder.decode(data)
+
+
+def load_codec():
+    """Returns the codec configured by the `JSON_CODEC` setting. Without a configured
+    backend `orjson` is used if it is installed and the standard library otherwise."""
+    config = getattr(settings, "JSON_CODEC", {})
+    if "BACKEND" in config:
+        return import_string(config["BACKEND"])(**config.get("CONFIG", {}))
+    try:
+        return OrjsonCodec()
+    except ImportError:
+        return StdlibCodec()
+
+
+codec = load_codec()
+
+
+def pre_encode(event):
+    """Adds the encoded frame of a channel layer event to the event, so that every
+    consumer of a group forwards the same frame instead of encoding the event again."""
+    return {**event, "frame": codec.dumps(event)}
+
+
+class FrameFormat:
+    """Encoding of the WebSocket frames of a connection, which the client selects through
+    the WebSocket subprotocol.
+
+    Text formats send text frames and binary formats binary frames. If `compress` is set,
+    payloads of at least `threshold` bytes are compressed with zlib and sent as binary
+    frames whose first byte is `1`; other binary frames start with `0`. Text frames are
+    always accepted as JSON, so a client may fall back to JSON for single messages.
+    """
+
+    binary = False
+
+    def __init__(self, compress=False, threshold=1024, level=6, max_size=1024 * 1024):
+        self.compress = compress
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+        self.encode_frame = functools.lru_cache(maxsize=128)(self._encode_frame)
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def pack(self, data):
+        """Returns the `(text_data, bytes_data)` of the frame for the encoded `data`."""
+        if self.compress:
+            raw = data.encode() if isinstance(data, str) else data
+            if len(raw) >= self.threshold:
+                return None, b"\x01" + zlib.compress(raw, self.level)
+            if self.binary:
+                return None, b"\x00" + raw
+        return (None, data) if self.binary else (data, None)
+
+    def encode(self, obj):
+        return self.pack(self.dumps(obj))
+
+    def _encode_frame(self, frame):
+        return self.encode(codec.loads(frame))
+
+    def encode_event(self, event):
+        """Encodes a channel layer event. Pre-encoded JSON frames are converted once per
+        process and format instead of once per consumer."""
+        frame = event.get("frame")
+        if frame is None:
+            return self.encode(event)
+        return self.encode_frame(frame)
+
+    def encode_batch(self, events):
+        """Encodes several channel layer events as one `batch` frame."""
+        return self.encode({
+            "type": "batch",
+            "events": [
+                codec.loads(event["frame"]) if "frame" in event else event for event in events
+            ],
+        })
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is not None:
+            return codec.loads(text_data)
+        data = bytes_data
+        if self.compress:
+            if data[:1] == b"\x01":
+                decompressor = zlib.decompressobj()
+                data = decompressor.decompress(data[1:], self.max_size)
+                if decompressor.unconsumed_tail:
+                    raise ValueError(f"Decompressed frame exceeds {self.max_size} bytes")
+            else:
+                data = data[1:]
+        return self.loads(data)
+
+
+class JsonFormat(FrameFormat):
+    def dumps(self, obj):
+        return codec.dumps(obj)
+
+    def loads(self, data):
+        return codec.loads(data)
+
+    def _encode_frame(self, frame):
+        # The frame is already JSON
+        return self.pack(frame)
+
+    def encode_batch(self, events):
+        # Joins the pre-encoded frames instead of decoding and encoding them again
+        frames = ",".join(event.get("frame") or codec.dumps(event) for event in events)
+        return self.pack(f'{{"type":"batch","events":[{frames}]}}')
+
+
+class MsgpackFormat(FrameFormat):
+    """MessagePack frames, which requires `msgpack` to be installed."""
+
+    binary = True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        import msgpack
+
+        self.msgpack = msgpack
+
+    def dumps(self, obj):
+        return self.msgpack.packb(obj)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data)
+
+
+def load_frame_formats():
+    """Returns the frame formats by subprotocol. The options of the `WEBSOCKET_FRAMES`
+    setting are passed to the formats which compress their payloads."""
+    config = getattr(settings, "WEBSOCKET_FRAMES", {})
+    formats = {}
+    for name, backend in [("json", JsonFormat), ("msgpack", MsgpackFormat)]:
+        try:
+            formats[name] = backend()
+            formats[f"{name}.zlib"] = backend(compress=True, **config)
+        except ImportError:
+            pass
+    return formats
+
+
+frame_formats = load_frame_formats()
+
+
+def log_task_exception(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Failed to send a batch", exc_info=task.exception())
+
+
+class CodecMixin:
+    """Mixin for async WebSocket consumers which encodes and decodes frames in the frame
+    format negotiated through the subprotocol and forwards pre-encoded events.
+
+    The consumer handles decoded messages in `receive_json` and sends with `send_json`
+    or, for channel layer events, `send_event`. If `batch_window` is set, events are
+    coalesced into `{"type": "batch", "events": [...]}` frames.
+    """
+
+    frame_format = frame_formats["json"]
+    # Seconds for which `send_event` gathers events into one `batch` frame, or `None`
+    batch_window = None
+    # Events after which a batch is sent early, by default the `max_events` of the
+    # `WEBSOCKET_BATCHING` setting
+    batch_size = None
+    pending_events = None
+    batch_task = None
+
+    def get_batch_window(self):
+        """Returns the batch window the client asks for with `?batch=<milliseconds>`,
+        limited to the `max_window` of the `WEBSOCKET_BATCHING` setting."""
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        try:
+            window = int(query["batch"][0])
+        except (KeyError, ValueError):
+            return None
+        max_window = getattr(settings, "WEBSOCKET_BATCHING", {}).get("max_window", 50)
+        return min(window, max_window) / 1000 if window > 0 else None
+
+    def get_batch_size(self):
+        if self.batch_size is not None:
+            return self.batch_size
+        return getattr(settings, "WEBSOCKET_BATCHING", {}).get("max_events", 100)
+
+    def select_subprotocol(self):
+        """Returns the first subprotocol offered by the client which is a known frame
+        format, or `None` for plain JSON."""
+        for subprotocol in self.scope.get("subprotocols", []):
+            if subprotocol in frame_formats:
+                return subprotocol
+        return None
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None:
+            subprotocol = self.select_subprotocol()
+        self.frame_format = frame_formats.get(subprotocol, frame_formats["json"])
+        await super().accept(subprotocol, headers)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        await self.receive_json(self.frame_format.decode(text_data, bytes_data), **kwargs)
+
+    async def send_json(self, content, close=False):
+        # Pending events are sent first to keep the order of the frames
+        await self.flush_events()
+        text_data, bytes_data = self.frame_format.encode(content)
+        await self.send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def send_event(self, event):
+        """Sends a channel layer event. In batching mode the event is sent with the other
+        events which arrive within `batch_window` seconds or up to `batch_size` events."""
+        if self.batch_window is None:
+            text_data, bytes_data = self.frame_format.encode_event(event)
+            await self.send(text_data=text_data, bytes_data=bytes_data)
+            return
+
+        if not self.pending_events:
+            self.pending_events = []
+            self.batch_task = asyncio.create_task(self.flush_later())
+            self.batch_task.add_done_callback(log_task_exception)
+        self.pending_events.append(event)
+        if len(self.pending_events) >= self.get_batch_size():
+            await self.flush_events()
+
+    async def flush_later(self):
+        await asyncio.sleep(self.batch_window)
+        self.batch_task = None
+        await self.flush_events()
+
+    async def flush_events(self):
+        events = self.pending_events
+        if not events:
+            return
+        self.pending_events = []
+        self.cancel_batch_task()
+        if len(events) == 1:
+            text_data, bytes_data = self.frame_format.encode_event(events[0])
+        else:
+            text_data, bytes_data = self.frame_format.encode_batch(events)
+        await self.send(text_data=text_data, bytes_data=bytes_data)
+
+    def cancel_batch_task(self):
+        if self.batch_task is not None:
+            self.batch_task.cancel()
+            self.batch_task = None
+
+    def cancel_batch(self):
+        """Drops the pending events of a closed socket."""
+        self.pending_events = []
+        self.cancel_batch_task()
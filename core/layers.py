@@ -0,0 +1,335 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+from collections import Counter, defaultdict
+
+from channels.layers import get_channel_layer
+from channels_redis.core import RedisChannelLayer
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """Redis channel layer which delivers messages for the channels of this process
+    directly in memory and uses Redis only for the channels of other processes.
+
+    Group memberships are still stored in Redis, so a `group_send` costs one query for
+    the members of the group. Messages for the members in this process are put into
+    their receive buffers without being serialized, the same way the Redis layer
+    delivers one message to several channels of a process. Receivers therefore share
+    the message and must not modify it. A channel counts as a local member from its
+    first `group_add` until it is discarded from its last group.
+
+    The Redis layer lets one of the waiting consumers read the process-wide Redis
+    queue, which would not wake up for a message delivered in memory. Instead, one
+    reader task per event loop moves the messages from Redis into the receive buffers
+    and every consumer only waits for its own buffer.
+    """
+
+    def __init__(self, idle_timeout=1, **kwargs):
+        super().__init__(**kwargs)
+        self.idle_timeout = idle_timeout
+        self.channel_groups = defaultdict(set)
+        self.reader = None
+        self.receivers = 0
+        self.stats = Counter()
+
+    def is_local(self, channel):
+        return f"{self.client_prefix}!" in channel
+
+    def deliver(self, channel, message):
+        self.receive_buffer[channel].put_nowait(message)
+        self.stats["local"] += 1
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        if self.is_local(channel):
+            self.channel_groups[channel].add(group)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        groups = self.channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.channel_groups[channel]
+
+    async def send(self, channel, message):
+        if channel in self.channel_groups:
+            assert "__asgi_channel__" not in message
+            self.deliver(channel, dict(message))
+            return
+        self.stats["remote"] += 1
+        await super().send(channel, message)
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # `RedisChannelLayer.group_send` passes the members of the group through this
+        # method before it writes the message to Redis, so local members are taken out
+        # here. Local channels without a group are left over from consumers which did
+        # not discard their groups and are dropped.
+        remote = []
+        local_message = dict(message)
+        for channel in channel_names:
+            if not self.is_local(channel):
+                remote.append(channel)
+            elif channel in self.channel_groups:
+                self.deliver(channel, local_message)
+        self.stats["remote"] += len(remote)
+        return super()._map_channel_keys_to_connection(remote, message)
+
+    async def receive(self, channel):
+        if "!" not in channel:
+            return await super().receive(channel)
+        assert self.is_local(channel), "Wrong client prefix"
+
+        loop = asyncio.get_running_loop()
+        if self.reader is None or self.reader.get_loop() is not loop or self.reader.done():
+            self.reader = loop.create_task(self.read(self.non_local_name(channel)))
+        self.receivers += 1
+        try:
+            return await self.receive_buffer[channel].get()
+        finally:
+            if channel in self.receive_buffer and self.receive_buffer[channel].empty():
+                del self.receive_buffer[channel]
+            self.receivers -= 1
+            if self.receivers == 0:
+                loop.call_later(self.idle_timeout, self.stop_idle_reader)
+
+    async def read(self, channel):
+        """Moves the messages of the Redis queue of this process into the receive buffers
+        of their channels."""
+        while True:
+            try:
+                message_channel, message = await self.receive_single(channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to receive from %s", channel)
+                await asyncio.sleep(1)
+                continue
+            if not isinstance(message_channel, list):
+                message_channel = [message_channel]
+            for name in message_channel:
+                self.receive_buffer[name].put_nowait(message)
+
+    def stop_idle_reader(self):
+        # A message which is read while the reader is cancelled stays in the backup
+        # queue of the Redis layer and is read again by the next reader
+        if self.receivers == 0 and self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+
+    async def flush(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            await asyncio.gather(self.reader, return_exceptions=True)
+            self.reader = None
+        await super().flush()
+
+    def get_stats(self):
+        return {**self.stats, "channels": len(self.channel_groups)}
+
+
+@metrics.registry.collector
+def collect_stats():
+    layer = get_channel_layer()
+    if not isinstance(layer, HybridChannelLayer):
+        return []
+    stats = layer.get_stats()
+    return [
+        metrics.collected(
+            metrics.Counter,
+            "channel_layer_messages_total",
+            "Messages delivered in memory, sent through Redis or published",
+            ["delivery"],
+            # Deliveries which did not happen yet, e.g. without pub/sub groups, are missing
+            {(d,): stats.get(d, 0) for d in ["local", "remote", "published"]},
+        ),
+        metrics.collected(
+            metrics.Gauge,
+            "channel_layer_local_channels",
+            "Channels of this process which are members of a group",
+            [],
+            {(): stats["channels"]},
+        ),
+    ]
+
+
+class ShardedChannelLayer(HybridChannelLayer):
+    """Hybrid channel layer which spreads groups and channels over several Redis hosts
+    with a hash ring.
+
+    The Redis layer maps keys to hosts by ranges of a hash, so adding a host moves about
+    half of the keys. On the ring every host owns `virtual_nodes` points and a key
+    belongs to the next point, so adding or removing one of n hosts only moves about
+    1/n of the keys. `rebalance` moves the group memberships which changed their host.
+
+    Groups whose name starts with one of `pubsub_groups` are not stored in Redis at all.
+    A `group_send` publishes the message once on the host of the group and every process
+    with members in the group subscribes to it and delivers the message to its members
+    in memory. This suits large groups such as chat rooms, since the cost of a send no
+    longer grows with the number of members, but members only receive messages while
+    their process is subscribed and the capacity of a channel is not checked.
+    """
+
+    def __init__(self, virtual_nodes=64, pubsub_groups=(), **kwargs):
+        super().__init__(**kwargs)
+        self.virtual_nodes = virtual_nodes
+        self.pubsub_groups = tuple(pubsub_groups)
+        self.ring = self.build_ring(self.hosts)
+        self.group_channels = defaultdict(set)
+        self.subscriptions = {}
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, str):
+            value = value.encode("utf8")
+        return int.from_bytes(hashlib.md5(value).digest()[:8], "big")
+
+    @staticmethod
+    def host_key(host):
+        return host.get("address") or repr(sorted(host.items()))
+
+    def build_ring(self, hosts):
+        points = sorted(
+            (self.hash(f"{self.host_key(host)}#{i}"), index)
+            for index, host in enumerate(hosts)
+            for i in range(self.virtual_nodes)
+        )
+        return [point for point, _ in points], [index for _, index in points]
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        points, indexes = self.ring
+        return indexes[bisect.bisect(points, self.hash(value)) % len(points)]
+
+    def is_pubsub_group(self, group):
+        return group.startswith(self.pubsub_groups) if self.pubsub_groups else False
+
+    def pubsub_key(self, group):
+        return f"{self.prefix}:pubsub:{group}"
+
+    async def group_add(self, group, channel):
+        if not self.is_pubsub_group(group):
+            return await super().group_add(group, channel)
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.is_local(channel), "Pub/sub groups only accept channels of this process"
+        if not self.group_channels[group]:
+            await self.subscribe(group)
+        self.group_channels[group].add(channel)
+        self.channel_groups[channel].add(group)
+
+    async def group_discard(self, group, channel):
+        if not self.is_pubsub_group(group):
+            return await super().group_discard(group, channel)
+        channels = self.group_channels.get(group)
+        if channels is None or channel not in channels:
+            return
+        channels.discard(channel)
+        self.channel_groups[channel].discard(group)
+        if not self.channel_groups[channel]:
+            del self.channel_groups[channel]
+        if not channels:
+            del self.group_channels[group]
+            await self.unsubscribe(group)
+
+    async def group_send(self, group, message):
+        if not self.is_pubsub_group(group):
+            return await super().group_send(group, message)
+        assert self.valid_group_name(group), "Group name not valid"
+        local_message = dict(message)
+        for channel in self.group_channels.get(group, ()):
+            self.deliver(channel, local_message)
+        connection = self.connection(self.consistent_hash(group))
+        payload = self.serialize({"origin": self.client_prefix, "message": message})
+        await connection.publish(self.pubsub_key(group), payload)
+        self.stats["published"] += 1
+
+    async def subscribe(self, group):
+        """Subscribes the running event loop to a pub/sub group on the host of the group.
+        Every host has one subscription with a listener task per event loop."""
+        loop = asyncio.get_running_loop()
+        index = self.consistent_hash(group)
+        subscription = self.subscriptions.get(index)
+        if subscription is None or subscription["loop"] is not loop:
+            pubsub = self.connection(index).pubsub(ignore_subscribe_messages=True)
+            subscription = {"loop": loop, "pubsub": pubsub, "groups": set(), "listener": None}
+            self.subscriptions[index] = subscription
+        subscription["groups"].add(group)
+        await subscription["pubsub"].subscribe(self.pubsub_key(group))
+        if subscription["listener"] is None:
+            subscription["listener"] = loop.create_task(self.listen(subscription["pubsub"]))
+
+    async def unsubscribe(self, group):
+        index = self.consistent_hash(group)
+        subscription = self.subscriptions.get(index)
+        if subscription is None or subscription["loop"] is not asyncio.get_running_loop():
+            return
+        subscription["groups"].discard(group)
+        if subscription["groups"]:
+            await subscription["pubsub"].unsubscribe(self.pubsub_key(group))
+            return
+        del self.subscriptions[index]
+        subscription["listener"].cancel()
+        await subscription["pubsub"].aclose()
+
+    async def listen(self, pubsub):
+        prefix = len(self.pubsub_key(""))
+        while True:
+            try:
+                message = await pubsub.get_message(timeout=1)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to receive from the pub/sub groups")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            payload = self.deserialize(message["data"])
+            if payload["origin"] == self.client_prefix:
+                continue
+            group = message["channel"].decode("utf8")[prefix:]
+            for channel in self.group_channels.get(group, ()):
+                self.deliver(channel, payload["message"])
+
+    async def flush(self):
+        for subscription in self.subscriptions.values():
+            subscription["listener"].cancel()
+            await asyncio.gather(subscription["listener"], return_exceptions=True)
+            await subscription["pubsub"].aclose()
+        self.subscriptions = {}
+        self.group_channels.clear()
+        await super().flush()
+
+    async def rebalance(self, old_hosts):
+        """Moves the group memberships stored on the `old_hosts` to the host the ring of
+        this layer assigns them to and returns the number of moved groups."""
+        old_layer = type(self)(
+            hosts=old_hosts, prefix=self.prefix, virtual_nodes=self.virtual_nodes
+        )
+        new_hosts = {self.host_key(host): index for index, host in enumerate(self.hosts)}
+        moved = 0
+        for old_index, host in enumerate(old_layer.hosts):
+            if self.host_key(host) in new_hosts:
+                source = self.connection(new_hosts[self.host_key(host)])
+            else:
+                source = old_layer.connection(old_index)
+            prefix = self._group_key("")
+            async for key in source.scan_iter(match=prefix + b"*"):
+                index = self.consistent_hash(key[len(prefix):].decode("utf8"))
+                if self.host_key(self.hosts[index]) == self.host_key(host):
+                    continue
+                members = await source.zrange(key, 0, -1, withscores=True)
+                if members:
+                    target = self.connection(index)
+                    await target.zadd(key, dict(members))
+                    await target.expire(key, self.group_expiry)
+                await source.delete(key)
+                moved += 1
+        await old_layer.close_pools()
+        return moved
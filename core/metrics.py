@@ -0,0 +1,286 @@
+import asyncio
+import bisect
+import functools
+import time
+
+from django.conf import settings
+
+config = getattr(settings, "METRICS", {})
+enabled = config.get("enabled", True)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """A metric with one series of values per combination of label values. Label values
+    beyond `max_series` combinations are counted as `"other"`, so that values which
+    come from clients cannot grow the registry without limit."""
+
+    type = None
+
+    def __init__(self, name, help, labels=(), max_series=200):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.max_series = max_series
+        self.series = {}
+
+    def key(self, labels):
+        if labels not in self.series and len(self.series) >= self.max_series:
+            return ("other",) * len(self.labels)
+        return labels
+
+    def format_labels(self, values, **extra):
+        pairs = [*zip(self.labels, values), *extra.items()]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        for labels, value in self.series.items():
+            yield f"{self.name}{self.format_labels(labels)} {value}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, value=1):
+        key = self.key(labels)
+        self.series[key] = self.series.get(key, 0) + value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, value=1):
+        self.inc(*labels, value=-value)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=None, **kwargs):
+        super().__init__(name, help, labels, **kwargs)
+        self.buckets = tuple(buckets or config.get("buckets", DEFAULT_BUCKETS))
+
+    def observe(self, value, *labels):
+        key = self.key(labels)
+        series = self.series.get(key)
+        if series is None:
+            # Counts per bucket, the last one for values above all buckets, and the sum
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{self.format_labels(labels, le=bound)} {cumulative}"
+            yield f"{self.name}_sum{self.format_labels(labels)} {total}"
+            yield f"{self.name}_count{self.format_labels(labels)} {cumulative}"
+
+
+class Registry:
+    """The metrics of the process and collectors, which are functions that return
+    metrics of counters kept elsewhere, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        metrics = [*self.metrics]
+        for collector in self.collectors:
+            metrics.extend(collector())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def collected(metric_class, name, help, labels, values):
+    """Returns a metric with the given values by label values, for collectors."""
+    metric = metric_class(name, help, labels)
+    metric.series = dict(values)
+    return metric
+
+
+connections = registry.register(
+    Gauge("websocket_connections", "Open WebSocket connections", ["consumer"])
+)
+connect_seconds = registry.register(
+    Histogram("websocket_connect_seconds", "Duration of connect handlers", ["consumer"])
+)
+receive_seconds = registry.register(
+    Histogram(
+        "websocket_receive_seconds",
+        "Duration of the handlers of received messages by message type",
+        ["consumer", "type"],
+    )
+)
+sent_messages = registry.register(
+    Counter("websocket_sent_messages_total", "Sent messages by type", ["consumer", "type"])
+)
+channel_layer_seconds = registry.register(
+    Histogram("channel_layer_seconds", "Duration of channel layer calls", ["operation"])
+)
+database_seconds = registry.register(
+    Histogram(
+        "database_seconds",
+        "Duration of database operations including their serialization",
+        ["operation"],
+    )
+)
+
+
+def timed(histogram, *labels):
+    """Decorator which observes the duration of every call of a function or coroutine
+    function in `histogram`. If metrics are disabled, the function is not wrapped."""
+
+    def decorator(func):
+        if not enabled:
+            return func
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, *labels)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, *labels)
+
+        return wrapper
+
+    return decorator
+
+
+class InstrumentedChannelLayer:
+    """Proxy of a channel layer which observes the duration of sends and group changes."""
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    async def send(self, channel, message):
+        start = time.perf_counter()
+        await self.layer.send(channel, message)
+        channel_layer_seconds.observe(time.perf_counter() - start, "send")
+
+    async def group_send(self, group, message):
+        start = time.perf_counter()
+        await self.layer.group_send(group, message)
+        channel_layer_seconds.observe(time.perf_counter() - start, "group_send")
+
+    async def group_add(self, group, channel):
+        start = time.perf_counter()
+        await self.layer.group_add(group, channel)
+        channel_layer_seconds.observe(time.perf_counter() - start, "group_add")
+
+    async def group_discard(self, group, channel):
+        start = time.perf_counter()
+        await self.layer.group_discard(group, channel)
+        channel_layer_seconds.observe(time.perf_counter() - start, "group_discard")
+
+
+@functools.lru_cache(maxsize=None)
+def instrument_channel_layer(layer):
+    return InstrumentedChannelLayer(layer)
+
+
+def message_type(content):
+    if isinstance(content, dict) and isinstance(content.get("type", ""), str):
+        return content.get("type") or "message"
+    return "invalid"
+
+
+def instrument_receive_json(func):
+    @functools.wraps(func)
+    async def receive_json(self, content, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(self, content, **kwargs)
+        finally:
+            receive_seconds.observe(
+                time.perf_counter() - start, type(self).__name__, message_type(content)
+            )
+
+    return receive_json
+
+
+class ConsumerMetricsMixin:
+    """Mixin for async WebSocket consumers which records the open connections, the
+    duration of `connect` and of `receive_json` by message type, the sent messages by
+    type and the duration of the channel layer calls of the consumer."""
+
+    accepted = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The consumer implements `receive_json` itself, so it is wrapped here
+        if "receive_json" in cls.__dict__:
+            cls.receive_json = instrument_receive_json(cls.receive_json)
+
+    async def websocket_connect(self, message):
+        if self.channel_layer is not None:
+            self.channel_layer = instrument_channel_layer(self.channel_layer)
+        start = time.perf_counter()
+        try:
+            await super().websocket_connect(message)
+        finally:
+            connect_seconds.observe(time.perf_counter() - start, type(self).__name__)
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        self.accepted = True
+        connections.inc(type(self).__name__)
+
+    async def websocket_disconnect(self, message):
+        if self.accepted:
+            self.accepted = False
+            connections.dec(type(self).__name__)
+        await super().websocket_disconnect(message)
+
+    async def send_json(self, content, close=False):
+        sent_messages.inc(type(self).__name__, message_type(content))
+        await super().send_json(content, close)
+
+    async def send_event(self, event):
+        sent_messages.inc(type(self).__name__, event["type"])
+        await super().send_event(event)
+
+
+class NoMetricsMixin:
+    """Takes the place of the `ConsumerMetricsMixin` if metrics are disabled."""
+
+
+MetricsMixin = ConsumerMetricsMixin if enabled else NoMetricsMixin
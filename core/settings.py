@@ -75,15 +75,110 @@ TEMPLATES = [
 WSGI_APPLICATION = "core.wsgi.application"
 ASGI_APPLICATION = "core.asgi.application"
 
+# The layer delivers messages for sockets of the same process in memory and only uses
+# Redis for the sockets of other processes. Groups and channels are spread over the
+# `hosts` with a hash ring; run `manage.py rebalance_channel_layer` after changing them.
+# Groups which start with one of `pubsub_groups` (e.g. "chat_") are sent with one
+# Redis PUBLISH instead of one write per member, see `core.layers`
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "core.layers.ShardedChannelLayer",
         "CONFIG": {
             "hosts": [("127.0.0.1", 6379)],
+            "pubsub_groups": [],
         },
     },
 }
 
+# Presence store for the online users of chat rooms and the routing of private messages,
+# see `chat.presence`. Without a `BACKEND`, `chat.presence.RedisPresence` on the Redis
+# server at `LOCATION` is used with a Redis layer and `MemoryPresence` otherwise. The
+# presence is not sharded, so all entries and inboxes are kept on this one server.
+CHAT_PRESENCE = {
+    "LOCATION": "redis://127.0.0.1:6379/0",
+    "CONFIG": {
+        "ttl": 60,
+        # Private messages kept per offline user and seconds until they expire
+        "inbox_size": 100,
+        "inbox_ttl": 7 * 24 * 60 * 60,
+    },
+}
+
+# Number of messages which are replayed when a user joins a chat room
+CHAT_HISTORY_LIMIT = 50
+
+# In-process ring buffers of the recent messages of each chat room, see
+# `chat.cache.RecentMessages`
+CHAT_RECENT_MESSAGES = {
+    "size": CHAT_HISTORY_LIMIT,
+    "max_rooms": 1000,
+    "max_bytes": 16 * 1024 * 1024,
+}
+
+# Cache of the primary keys of chat rooms by name, see `chat.cache.RoomCache`
+CHAT_ROOM_CACHE = {
+    "timeout": 300,
+}
+
+# Write-behind buffer for chat messages, see `chat.persistence.MessageWriter`
+CHAT_MESSAGE_WRITER = {
+    "batch_size": 100,
+    "flush_interval": 0.5,
+    # Messages which may wait for a failing database before new ones are rejected
+    "max_pending": 10_000,
+}
+
+# In-process cache of the task trees of the checklist users, see
+# `checklist.cache.TaskTrees`. Users without a socket in the process expire after
+# `timeout` seconds.
+CHECKLIST_TASK_TREES = {
+    "max_users": 1000,
+    "max_objects": 200_000,
+    "timeout": 60,
+}
+
+# Successive updates of the same task or item by one socket within `window` seconds are
+# broadcast as one event with the final state, see `checklist.coalescing`. `None` sends
+# every update at once.
+CHECKLIST_COALESCING = {
+    "window": 0.1,
+}
+
+# JSON codec of the consumers, see `core.codecs`. Without a backend orjson is used if
+# it is installed and the `json` module otherwise.
+JSON_CODEC = {}
+
+# Compression of the `json.zlib` and `msgpack.zlib` frame formats, see `core.codecs`
+WEBSOCKET_FRAMES = {
+    "threshold": 1024,
+    "level": 6,
+}
+
+# Limits of the `?batch=<milliseconds>` mode of the chat, see `core.codecs.CodecMixin`
+WEBSOCKET_BATCHING = {
+    "max_window": 50,
+    "max_events": 100,
+}
+
+# Limits of every socket of the chat and the checklist, see `core.throttling`. Incoming
+# frames are limited per socket and per user by token buckets of `rate` frames per
+# second with bursts of `burst` frames. A rate of `None` turns the limit off. Outgoing
+# frames are only bounded if the server waits for slow sockets, see `ThrottleMixin`.
+WEBSOCKET_THROTTLING = {
+    "rate": 20,
+    "burst": 40,
+    "user_rate": 50,
+    "user_burst": 100,
+}
+
+# Timing histograms and counters of the consumers, served in the Prometheus text format
+# under /metrics/, see `core.metrics`. If disabled, nothing is instrumented at all.
+METRICS = {
+    "enabled": True,
+    # Upper bounds of the buckets of the timing histograms in seconds
+    "buckets": [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5],
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
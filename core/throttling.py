@@ -0,0 +1,106 @@
+import time
+import weakref
+from collections import Counter
+
+from django.conf import settings
+
+from core import metrics
+
+config = getattr(settings, "WEBSOCKET_THROTTLING", {})
+
+# Number of throttled incoming frames of all sockets of this process
+stats = Counter()
+
+
+@metrics.registry.collector
+def collect_stats():
+    return [
+        metrics.collected(
+            metrics.Counter,
+            "websocket_limited_frames_total",
+            "Throttled incoming frames",
+            ["reason"],
+            {(reason,): count for reason, count in stats.items()},
+        )
+    ]
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average and bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, tokens=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+# The buckets of the users, shared by all sockets of a user in this process and dropped
+# with the last socket
+user_buckets = weakref.WeakValueDictionary()
+
+
+def get_user_bucket(user):
+    if config.get("user_rate", 50) is None:
+        return None
+    bucket = user_buckets.get(user.pk)
+    if bucket is None:
+        bucket = TokenBucket(config.get("user_rate", 50), config.get("user_burst", 100))
+        user_buckets[user.pk] = bucket
+    return bucket
+
+
+class ThrottleMixin:
+    """Mixin for async WebSocket consumers which limits the incoming frames of a socket
+    and its user.
+
+    Incoming frames beyond the token buckets of the socket or the user are dropped and
+    the client is told once with an `error` message until a frame is accepted again.
+    A rate of `None` turns the limit off.
+
+    Outgoing frames are not bounded here, since an ASGI application cannot see how much
+    the server buffers for a socket. With a server which waits for the client while
+    sending, like uvicorn, a slow socket stops its consumer from reading its channel,
+    so at most the `capacity` of the channel layer is buffered and further events are
+    dropped by the layer. Daphne never waits, so it buffers the frames of a slow socket
+    without limit.
+    """
+
+    throttle_rate = config.get("rate", 20)
+    throttle_burst = config.get("burst", 40)
+
+    bucket = None
+    user_bucket = None
+    throttled = False
+
+    async def websocket_connect(self, message):
+        if self.throttle_rate is not None:
+            self.bucket = TokenBucket(self.throttle_rate, self.throttle_burst)
+        user = self.scope.get("user")
+        if user is not None and user.is_authenticated:
+            self.user_bucket = get_user_bucket(user)
+        await super().websocket_connect(message)
+
+    def allow_frame(self):
+        if self.bucket is not None and not self.bucket.consume():
+            return False
+        return self.user_bucket is None or self.user_bucket.consume()
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if not self.allow_frame():
+            stats["throttled"] += 1
+            if not self.throttled:
+                self.throttled = True
+                await self.send_json({"type": "error", "message": "Rate limit exceeded"})
+            return
+        self.throttled = False
+        await super().receive(text_data, bytes_data, **kwargs)
@@ -18,8 +18,13 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from core import metrics, views
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("chat/", include("chat.urls")),
     path("checklist/", include("checklist.urls"))
 ]
+
+if metrics.enabled:
+    urlpatterns.append(path("metrics/", views.metrics_view, name="metrics"))
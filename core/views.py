@@ -0,0 +1,7 @@
+from django.http import HttpResponse
+
+from core.metrics import registry
+
+
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4")